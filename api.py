@@ -1,13 +1,15 @@
 #encoding: UTF-8
 import json
 import requests
+import numpy as np
 import pandas as pd
 
 import time
 from datetime import datetime, timedelta
 
-from Queue import Queue, Empty, PriorityQueue
-from threading import Thread, Timer
+from collections import deque, OrderedDict
+from threading import (Thread, Timer, Lock, Condition, Event,
+current_thread)
 from errors import (OANDA_RequestError, OANDA_EnvError, 
 OANDA_DataConstructorError)
 
@@ -254,6 +256,8 @@ class Bar(BaseDataContainer):
 	* ask_open, ask_high, ask_low, ask_close: floats; an ohlc bar 
 	  for the ask side. 
 	* instrument: string; instrument ID.
+	* granularity: string; OANDA granularity, e.g. 'M1', '' if the span
+	  is not one of GRANULARITY_SECONDS.
 	* start, end: datetime.datetime() object; defines the start and end
 	  for the maintainance. These are calculated when constucted, and remain
 	  constant during the lifespan of self.
@@ -277,6 +281,7 @@ class Bar(BaseDataContainer):
 	ask_close = -1
 
 	instrument = ''
+	granularity = ''
 
 	def __init__(self, tick, start, span=timedelta(minutes=1)):
 		"""
@@ -296,6 +301,7 @@ class Bar(BaseDataContainer):
 		try:
 			# !only uses bid ask in tick, start was transferred separately.
 			assert type(tick) == Tick
+			self.instrument = tick.instrument
 			bid, ask = tick.bid, tick.ask
 			self.bid_open, self.bid_high, self.bid_low, self.bid_close = \
 				bid, bid, bid, bid
@@ -309,11 +315,37 @@ class Bar(BaseDataContainer):
 			msg = '[BAR]: Unable to construct bar; ' + str(e)
 			raise OANDA_DataConstructorError(msg)
 
+	@classmethod
+	def from_ohlc(cls, instrument, granularity, start, ohlc):
+		"""
+		reload constructor, from a closed bar of BarAggregator.
+
+		parameters
+		----------
+		* instrument: string; instrument ID.
+		* granularity: string; a key of GRANULARITY_SECONDS.
+		* start: integer; Unix timestamp (seconds) of the bar start.
+		* ohlc: array-like; bid open, high, low, close, then ask open,
+		  high, low, close.
+		"""
+		bar = cls.__new__(cls)
+		bar.instrument = instrument
+		bar.granularity = granularity
+		bar.span = timedelta(seconds=GRANULARITY_SECONDS[granularity])
+		bar.start = datetime.fromtimestamp(start)
+		bar.end = bar.start + bar.span
+		bar.bid_open, bar.bid_high, bar.bid_low, bar.bid_close, \
+			bar.ask_open, bar.ask_high, bar.ask_low, bar.ask_close = \
+			[float(x) for x in ohlc]
+		return bar
+
 	def view(self):
 		"""
 		view data method.
 		"""
 		bar_view = {
+			'instrument': self.instrument,
+			'granularity': self.granularity,
 			'start': str(self.start),
 			'end': str(self.end),
 			'bid_ohlc': [self.bid_open, self.bid_high, 
@@ -352,6 +384,271 @@ class Bar(BaseDataContainer):
 			return 0
 
 
+# seconds per bar of the supported OANDA granularities.
+GRANULARITY_SECONDS = {
+	'S5': 5, 'S10': 10, 'S15': 15, 'S30': 30,
+	'M1': 60, 'M2': 120, 'M4': 240, 'M5': 300, 'M10': 600, 'M15': 900,
+	'M30': 1800, 'H1': 3600, 'H2': 7200, 'H3': 10800, 'H4': 14400,
+	'H6': 21600, 'H8': 28800, 'H12': 43200, 'D': 86400
+}
+
+
+class TimerWheel(object):
+	"""
+	Hashed timer wheel.
+	Timers hash into slots by deadline, advance() only visits the slots
+	between the last and the current time, so scheduling is O(1) and
+	advancing costs the timers that fire, not all timers. Deadlines a
+	whole turn or more ahead share slots and stay until due.
+
+	privates
+	--------
+	* slots: list; of lists of (deadline, key) tuples.
+	* resolution: integer; seconds per slot.
+	* now: integer; last slot tick advanced to, None before the first.
+	* expired: list; timers scheduled at or before now, fired by the
+	  next advance().
+	"""
+
+	def __init__(self, slots=4096, resolution=1):
+		"""
+		constructor.
+
+		parameters
+		----------
+		* slots: integer; number of slots, default 4096.
+		* resolution: integer; seconds per slot, default 1.
+		"""
+		self.slots = [[] for _ in xrange(slots)]
+		self.resolution = resolution
+		self.now = None
+		self.expired = []
+
+	def schedule(self, deadline, key):
+		"""
+		add a timer.
+
+		parameters
+		----------
+		* deadline: integer; Unix timestamp in seconds.
+		* key: any sortable; returned by advance() when due.
+		"""
+		tick = deadline // self.resolution
+		if self.now is not None and tick <= self.now:
+			self.expired.append((deadline, key))
+		else:
+			self.slots[tick % len(self.slots)].append((deadline, key))
+
+	def advance(self, now):
+		"""
+		move the wheel to now.
+
+		parameters
+		----------
+		* now: integer; Unix timestamp in seconds.
+
+		returns
+		-------
+		* list; (deadline, key) of timers due by now, sorted.
+		"""
+		tick, n = now // self.resolution, len(self.slots)
+		if self.now is None or tick - self.now >= n:
+			visit = xrange(n)
+		else:
+			visit = (t % n for t in xrange(self.now + 1, tick + 1))
+		due, self.expired = self.expired, []
+		for i in visit:
+			slot = self.slots[i]
+			if slot:
+				due += [timer for timer in slot if timer[0] <= now]
+				slot[:] = [timer for timer in slot if timer[0] > now]
+		self.now = tick if self.now is None else max(self.now, tick)
+		return sorted(due)
+
+
+class BarAggregator(object):
+	"""
+	Bar aggregation engine of the live stream.
+	Keeps the bid/ask ohlc of the open bar of every (instrument,
+	granularity) in two arrays, rows grow as new instruments show up.
+	Only the finest granularity is updated by ticks; a closed bar is
+	rolled up into the next coarser granularity (high = max, low = min,
+	close = last), so one tick costs the same whatever the number of
+	granularities, and coarse bars are complete when they close.
+
+	Bars are aligned to multiples of their span since epoch, and close
+	when a tick of a later bar arrives, or by flush(time) at their end:
+	every open bar has a timer at its end in a TimerWheel, so flush()
+	visits due bars only. Ticks older than the last flush() are late
+	for their closed bars, and dropped (counted in dropped).
+
+	privates
+	--------
+	* granularities: list; granularity strings, finest first. Every
+	  span divides the next one.
+	* spans: list; seconds per bar of granularities.
+	* rows: dictionary; {instrument: row index}.
+	* instruments: list; instrument of each row.
+	* ohlc: np.ndarray; rows x granularities x 8, bid ohlc then ask
+	  ohlc of the open bars.
+	* starts: np.ndarray; rows x granularities, Unix timestamp of the
+	  open bars, -1 if no bar is open.
+	* wheel: TimerWheel() object; (end, (level, row, start)) timers of
+	  open bars; those of bars already closed by ticks are skipped.
+	* watermark: integer; time of the last flush().
+	* dropped: integer; late ticks dropped so far.
+
+	examples
+	--------
+	>> agg = BarAggregator(['S5', 'M1', 'M5', 'H1'])
+	>> for bar in agg.push(tick): # closed bars, fine to coarse.
+	>>     q.put(BarEvent(bar))
+	"""
+	# column slices of the ohlc array.
+	_OPEN = [0, 4]
+	_HIGH = [1, 5]
+	_LOW = [2, 6]
+	_CLOSE = [3, 7]
+
+	def __init__(self, granularities=('S5', 'M1', 'M5', 'H1'), capacity=32):
+		"""
+		constructor.
+
+		parameters
+		----------
+		* granularities: list; granularity strings, keys of
+		  GRANULARITY_SECONDS, default S5, M1, M5, H1.
+		* capacity: integer; initial number of instrument rows.
+		"""
+		try:
+			spans = sorted((GRANULARITY_SECONDS[g], g) for g in granularities)
+			assert spans
+			for (fine, _), (coarse, _) in zip(spans[:-1], spans[1:]):
+				assert coarse % fine == 0
+		except (KeyError, AssertionError):
+			msg = '[BARAGGREGATOR]: Unable to construct aggregator; ' + \
+					'granularities must be nested, got ' + str(granularities)
+			raise OANDA_DataConstructorError(msg)
+		self.spans = [span for span, g in spans]
+		self.granularities = [g for span, g in spans]
+		self.rows = dict()
+		self.instruments = []
+		self.ohlc = np.zeros((capacity, len(spans), 8))
+		self.starts = np.empty((capacity, len(spans)), dtype=np.int64)
+		self.starts.fill(-1)
+		self.wheel = TimerWheel()
+		self.watermark = 0
+		self.dropped = 0
+
+	def _open(self, row, level, start):
+		"""
+		mark the bar of (row, level) open from start, set its timer.
+		"""
+		self.starts[row, level] = start
+		self.wheel.schedule(start + self.spans[level], (level, row, start))
+
+	def _row(self, instrument):
+		"""
+		row of an instrument, appended and grown on first sight.
+		"""
+		row = self.rows.get(instrument)
+		if row is None:
+			row = len(self.instruments)
+			if row == len(self.starts):
+				self.ohlc = np.concatenate([self.ohlc, np.zeros_like(self.ohlc)])
+				grown = np.empty_like(self.starts)
+				grown.fill(-1)
+				self.starts = np.concatenate([self.starts, grown])
+			self.rows[instrument] = row
+			self.instruments.append(instrument)
+		return row
+
+	def _close(self, row, level, bars):
+		"""
+		close the open bar of (row, level) into bars, roll it up into
+		the next coarser level.
+		"""
+		start = int(self.starts[row, level])
+		fine = self.ohlc[row, level]
+		bars.append(Bar.from_ohlc(self.instruments[row],
+								  self.granularities[level], start, fine))
+		self.starts[row, level] = -1
+		if level + 1 < len(self.spans):
+			coarse = self.ohlc[row, level + 1]
+			if self.starts[row, level + 1] < 0:
+				coarse[:] = fine
+				self._open(row, level + 1,
+						   start - start % self.spans[level + 1])
+			else:
+				coarse[self._HIGH] = np.maximum(coarse[self._HIGH],
+												fine[self._HIGH])
+				coarse[self._LOW] = np.minimum(coarse[self._LOW],
+											   fine[self._LOW])
+				coarse[self._CLOSE] = fine[self._CLOSE]
+
+	def push(self, tick):
+		"""
+		update the bars of the tick's instrument.
+
+		parameters
+		----------
+		* tick: Tick(BaseDataContainer) object.
+
+		returns
+		-------
+		* list; Bar() objects closed by this tick, fine to coarse.
+		"""
+		t = int(tick.time) // 1000000
+		if t < self.watermark:
+			self.dropped += 1
+			return []
+		row = self._row(tick.instrument)
+		bars = []
+		# walk up while the tick is past the open bar; a level closed by
+		# flush() may still have an open coarser bar to check.
+		for level, span in enumerate(self.spans):
+			start = self.starts[row, level]
+			if start < 0:
+				continue
+			if t - t % span <= start:
+				break
+			self._close(row, level, bars)
+
+		bid, ask = tick.bid, tick.ask
+		bar = self.ohlc[row, 0]
+		if self.starts[row, 0] < 0:
+			bar[:4], bar[4:] = bid, ask
+			self._open(row, 0, t - t % self.spans[0])
+		else:
+			bar[1], bar[2], bar[3] = max(bar[1], bid), min(bar[2], bid), bid
+			bar[5], bar[6], bar[7] = max(bar[5], ask), min(bar[6], ask), ask
+		return bars
+
+	def flush(self, time):
+		"""
+		close every open bar that ends at or before time, e.g. on a
+		heartbeat, when quiet instruments receive no later tick.
+
+		parameters
+		----------
+		* time: integer; Unix timestamp in seconds.
+
+		returns
+		-------
+		* list; Bar() objects closed, fine to coarse.
+		"""
+		self.watermark = max(self.watermark, time)
+		bars = []
+		# closing a bar may open a coarser one that is due as well.
+		due = self.wheel.advance(time)
+		while due:
+			for end, (level, row, start) in due:
+				if self.starts[row, level] == start:
+					self._close(row, level, bars)
+			due = self.wheel.advance(time)
+		return bars
+
+
 class HistBar(BaseDataContainer):
 	"""
 
@@ -449,59 +746,311 @@ class FillEvent(BaseEvent):
 	pass
 	
 
+class ConflatingSubscriber(object):
+	"""
+	Latest-value delivery to a slow listener.
+	Keeps one slot per instrument with its latest tick, a new tick
+	overwrites the slot and marks it dirty. The listener runs on its own
+	thread and, each time it is free, receives the dirty slots in the
+	order they were first dirtied; so it always sees the freshest price
+	of every instrument instead of a backlog. Bars are conflated by
+	instrument and granularity, heartbeats with each other; any other
+	event is delivered as is, in order, never conflated.
+
+	privates
+	--------
+	* func: function; the listener, f(event).
+	* _slots: collections.OrderedDict object; {slot key: latest
+	  event} of dirty slots, see _key().
+	* _cond: threading.Condition object; guards _slots.
+	* _active_flag: boolean; whether active or not.
+	* _thrd: threading.Thread object; delivery thread.
+	* conflated: integer; events overwritten before delivery.
+	"""
+
+	def __init__(self, func):
+		"""
+		Constructor
+
+		parameters
+		----------
+		* func: function; the listener, f(event).
+		"""
+		self.func = func
+		self._slots = OrderedDict()
+		self._cond = Condition()
+		self._active_flag = False
+		self._thrd = None
+		self.conflated = 0
+
+	@staticmethod
+	def _key(event):
+		"""
+		slot key of an event, a fresh object for events that are not
+		conflated, so they get a slot of their own.
+		"""
+		instrument = EventQueue._tick_instrument(event)
+		if instrument is not None:
+			return event.head, instrument
+		if EventQueue._is_heartbeat(event):
+			return event.head
+		if isinstance(event, BarEvent):
+			return event.head, event.instrument, event.body.granularity
+		return object()
+
+	def push(self, event):
+		"""
+		overwrite the slot of the event, O(1); called by EventQueue.
+		"""
+		key = self._key(event)
+		with self._cond:
+			if key in self._slots:
+				self.conflated += 1
+			self._slots[key] = event
+			self._cond.notify()
+
+	def _run(self):
+		""" delivery thread. """
+		while self._active_flag:
+			with self._cond:
+				if not self._slots:
+					self._cond.wait(0.1)
+				events, self._slots = self._slots.values(), OrderedDict()
+			for event in events:
+				self.func(event)
+
+	def open(self):
+		""" start delivering. """
+		if not self._active_flag:
+			self._active_flag = True
+			self._thrd = Thread(target=self._run, name='_THRD_CONFLATE')
+			self._thrd.daemon = True
+			self._thrd.start()
+
+	def kill(self):
+		""" stop delivering, and wait for the delivery thread. """
+		if self._active_flag:
+			with self._cond:
+				self._active_flag = False
+				self._cond.notify()
+			self._thrd.join()
+
+
 class EventQueue(object):
 	"""
 	Generic EventQueue implementation, maintains main event
 	queue of the system; register functions to speecific events;
 	push events and distribute em to listeners.
 
+	The queue is bounded. The distributing thread wakes when events
+	arrive and drains up to batch events per wake-up, so listeners keep
+	up with bursts at one lock round trip per batch. When the queue is
+	full, put() follows the overflow policy:
+		- 'block': wait for room.
+		- 'drop_heartbeat': drop the incoming heartbeat, or the oldest
+		  queued one, then block if there is none.
+		- 'coalesce': a tick replaces the queued tick of its instrument,
+		  keeping its place in the queue; otherwise as 'drop_heartbeat'.
+	The bound holds in every state: where no room can come, i.e. before
+	open(), after kill(), or in a listener of this very queue, put()
+	drops the event (counted in dropped) instead of blocking. Listeners
+	must not rely on putting into their own queue when it is full.
+
 	privates
 	--------
-	* _queue: Queue.Queue object; the main event queue.
+	* _queue: collections.deque object; queued events, each in a
+	  one-element list so that coalesce can swap it in place.
+	* _ticks: dictionary; {instrument: cell of its queued tick}.
+	* _cond: threading.Condition object; guards the queue, signals
+	  arrivals and room.
+	* _capacity: integer; maximum number of queued events.
+	* _batch: integer; maximum events drained per wake-up.
+	* _overflow: string; overflow policy, one of OVERFLOW_POLICIES.
 	* _active_flag: boolean; whether active or not.
 	* _thrd: threading.Thread object; event engine thread.
-	* _listeners: dictionary;
-				mapping from event type to handlers' list,
-				shaped like: {'ETYPE_ODR': [<func1>, <func2],
-					   		  'ETYPE_SGNL': [<func_handle_sign>]}
+	* _listeners: dictionary; dispatch table,
+				mapping from (event type, instrument) to handlers' list,
+				instrument None for handlers of all instruments,
+				shaped like: {('ETYPE_MKT', 'USD_CAD'): [<func1>],
+							  ('ETYPE_ODR', None): [<func1>, <func2],
+					   		  ('ETYPE_SGNL', None): [<func_handle_sign>]}
+				an event looks up its own instrument and None only,
+				so handlers of other instruments cost nothing.
+	* _conflating: dictionary; {listener: ConflatingSubscriber() object}
+	  of listeners bound with conflate=True.
+	* dropped, coalesced: integer; events lost to the overflow policy.
 
 	"""
+	OVERFLOW_POLICIES = ('block', 'drop_heartbeat', 'coalesce')
 
-	# event queue and timer instances.
-	_queue = Queue()
+	def __init__(self, capacity=10000, batch=64, overflow='block'):
+		"""
+		Constructor
 
-	# empty place holders.
-	_active_flag = False
-	_thrd = None
-	_listeners = dict()
+		parameters
+		----------
+		* capacity: integer; maximum number of queued events, default
+		  10000.
+		* batch: integer; maximum events handled per wake-up, default 64.
+		* overflow: string; one of OVERFLOW_POLICIES, default 'block'.
+		"""
+		if capacity < 1:
+			msg = '[EVENTQUEUE]: Unable to construct event queue; ' + \
+					'capacity must be at least 1, got ' + str(capacity)
+			raise OANDA_DataConstructorError(msg)
+		if overflow not in self.OVERFLOW_POLICIES:
+			msg = '[EVENTQUEUE]: Unable to construct event queue; ' + \
+					'unknown overflow policy ' + str(overflow)
+			raise OANDA_DataConstructorError(msg)
+		self._queue = deque()
+		self._ticks = dict()
+		self._cond = Condition()
+		self._capacity = capacity
+		self._batch = max(1, batch)
+		self._overflow = overflow
+		self._active_flag = False
+		self._listeners = dict()
+		self._conflating = dict()
+		self.dropped = 0
+		self.coalesced = 0
+		self._thrd = Thread(target=self.distribute, name='_THRD_EVENT')
+		self._thrd.daemon = True
 
-	def __init__(self):
-		""" Constructor """
+	def __len__(self):
+		return len(self._queue)
 
-		self._thrd = Thread(target=self.distribute, name='_THRD_EVENT')
+	@staticmethod
+	def _tick_instrument(event):
+		"""
+		instrument of a tick market event, None for other events.
+		"""
+		if isinstance(event, MarketEvent) and not event.is_heartbeat:
+			return event.body.get('tick', {}).get('instrument')
+		return None
+
+	@staticmethod
+	def _event_instrument(event):
+		"""
+		instrument of a tick or of an event with an instrument attribute
+		(e.g. BarEvent), None for others.
+		"""
+		return EventQueue._tick_instrument(event) or \
+			getattr(event, 'instrument', None) or None
+
+	@staticmethod
+	def _is_heartbeat(event):
+		return isinstance(event, MarketEvent) and event.is_heartbeat
+
+	def _make_room(self, event):
+		"""
+		apply the overflow policy to a full queue; called with the
+		lock held.
+
+		returnCode
+		----------
+		* 1: event may be queued.
+		* 0: event was absorbed (dropped or coalesced).
+		"""
+		if self._overflow == 'coalesce':
+			cell = self._ticks.get(self._tick_instrument(event))
+			if cell is not None:
+				cell[0] = event
+				self.coalesced += 1
+				return 0
+		if self._overflow != 'block':
+			if self._is_heartbeat(event):
+				self.dropped += 1
+				return 0
+			for cell in self._queue:
+				if self._is_heartbeat(cell[0]):
+					self._queue.remove(cell)
+					self.dropped += 1
+					return 1
+		# only the event thread makes room, never wait for it on itself.
+		while len(self._queue) >= self._capacity and self._active_flag \
+				and current_thread() is not self._thrd:
+			self._cond.wait(0.1)
+		if len(self._queue) >= self._capacity:
+			self.dropped += 1
+			return 0
+		return 1
 
 	def put(self, event):
 		""" 
-		put an event into queue 
+		put an event into queue, see the overflow policies.
 
 		parameters
 		----------
 		* event: a BaseEvent or its subclass instance.
 		"""
-		self._queue.put(event)
+		with self._cond:
+			if len(self._queue) >= self._capacity and \
+					not self._make_room(event):
+				return
+			cell = [event]
+			self._queue.append(cell)
+			instrument = self._tick_instrument(event)
+			if instrument is not None:
+				self._ticks[instrument] = cell
+			self._cond.notify_all()
+
+	def _take(self):
+		"""
+		wait for events, pop up to _batch of them.
+
+		returns
+		-------
+		* list; events, empty on timeout or shutdown.
+		"""
+		with self._cond:
+			if not self._queue and self._active_flag:
+				self._cond.wait(0.1)
+			events = []
+			while self._queue and len(events) < self._batch:
+				cell = self._queue.popleft()
+				instrument = self._tick_instrument(cell[0])
+				if self._ticks.get(instrument) is cell:
+					del self._ticks[instrument]
+				events.append(cell[0])
+			if events:
+				self._cond.notify_all() # room for blocked put().
+			return events
 
 	def open(self):
 		""" open the queue. """
 		self._active_flag = True
 		self._thrd.start()
+		for subscriber in self._conflating.itervalues():
+			subscriber.open()
 
-	def kill(self):
-		""" suspend engine. """
+	def kill(self, drain=False):
+		"""
+		suspend engine, and wait for the event thread to return.
+
+		parameters
+		----------
+		* drain: boolean; whether to distribute the events still queued
+		  before returning, default False (they are discarded).
+		"""
 		if self._active_flag:
-			self._active_flag = False
+			with self._cond:
+				self._active_flag = False
+				self._cond.notify_all()
 			self._thrd.join()
-
-	def bind(self, event_head, func):
+		if drain:
+			events = self._take()
+			while events:
+				self._dispatch(events)
+				events = self._take()
+		else:
+			with self._cond:
+				self._queue.clear()
+				self._ticks.clear()
+		for subscriber in self._conflating.itervalues():
+			subscriber.kill()
+
+	def bind(self, event_head, func, conflate=False, instruments=None,
+			 deliver_to=None):
 		""" 
 		Register a speecific function as a listener to some
 		type of events, events of this type will be distributed
@@ -512,25 +1061,58 @@ class EventQueue(object):
 		* event_head: string; an 'ETYPE_###' declaration.
 		* func: function; noticing that **kwargs has only event. 
 		  i.e. f(event).
+		* conflate: boolean; default False, func receives every event in
+		  order on the event thread. True for slow listeners: func runs
+		  on its own thread and receives only the latest tick of each
+		  instrument, see ConflatingSubscriber().
+		* instruments: string or list; instrument(s) whose events func
+		  receives, a string may join several by comma, e.g.
+		  'EUR_USD,USD_CAD'. Default None, events of all instruments.
+		* deliver_to: EventQueue() object; default None. If given, the
+		  events are put into this queue, which is the subscriber's own
+		  and calls func on its thread, instead of calling func on the
+		  event thread of this queue.
 
 		"""
-		if event_head not in self._listeners:
-			self._listeners[event_head] = []
-
-		if func not in self._listeners[event_head]:
-			self._listeners[event_head].append(func)
+		if isinstance(instruments, basestring):
+			instruments = [i.strip() for i in instruments.split(',')]
+		keys = [(event_head, i) for i in instruments or [None]]
+
+		if deliver_to is not None:
+			deliver_to.bind(event_head, func, conflate)
+			func = deliver_to.put
+		elif conflate:
+			if func not in self._conflating:
+				self._conflating[func] = ConflatingSubscriber(func)
+				if self._active_flag:
+					self._conflating[func].open()
+			func = self._conflating[func].push
+
+		for key in keys:
+			handlers = self._listeners.setdefault(key, [])
+			if func not in handlers:
+				handlers.append(func)
 
 		return self._listeners
 
+	def _dispatch(self, events):
+		"""
+		call the listeners of each event, in order; those of all
+		instruments first, then those of the event's instrument.
+		"""
+		listeners = self._listeners
+		for event in events:
+			for f in listeners.get((event.head, None), ()):
+				f(event)
+			instrument = self._event_instrument(event)
+			if instrument is not None:
+				for f in listeners.get((event.head, instrument), ()):
+					f(event)
+
 	def distribute(self):
-		""" distribute events by listeners mapping. """
+		""" distribute events by listeners mapping, a batch per wake-up. """
 		while self._active_flag:
-			try:
-				event = self._queue.get()
-				if event.head in self._listeners:
-					[f(event) for f in self._listeners[event.head]]
-			except Empty:
-				pass
+			self._dispatch(self._take())
 
 #----------------------------------------------------------------------
 # OANDA Api class
@@ -573,8 +1155,17 @@ class PyApi(object):
 	  boolean, string, string, string, dictionary, integer;
 	  just private references to the items in Config. See the docs of Config().
 	* _session: requests.session() object.
-	* _curr_bar: Bar() object; the current bar data maintained when requests
-	  stream data. It is dynamically updated and reset on new market impulses.
+	* _aggregator: BarAggregator() object; open bars of every streamed
+	  instrument and granularity, updated on new market impulses.
+	* _lock: threading.Lock() object; guards _aggregator, shared by the
+	  market event thread and the clock thread.
+	* _clock: threading.Thread object; closes bars at their boundaries,
+	  see start_clock().
+	* _clock_on: boolean; whether the clock runs.
+	* _clock_stopped: threading.Event() object; set to wake and end
+	  the clock thread.
+	* _grace: float; seconds the clock waits past a bar's end before
+	  closing it, for ticks that arrive late.
 
 	examples
 	--------
@@ -608,10 +1199,15 @@ class PyApi(object):
 
 	_session = requests.session()
 
-	# pointer to the bar that was currently maintained.
-	_curr_bar = None
+	# open bars of the stream.
+	_aggregator = None
+	_lock = None
+	_clock = None
+	_clock_on = False
+	_clock_stopped = None
+	_grace = 2.
 
-	def __init__(self, config, queues):
+	def __init__(self, config, queues, granularities=('M1',), grace=2.):
 		"""
 		Constructor. 
 
@@ -624,9 +1220,17 @@ class PyApi(object):
 			'bar': q2  # ETYPE_BAR
 		}
 		as containers of the events loaded from the stream. 
+		* granularities: list; granularities of the bars built from the
+		  stream, keys of GRANULARITY_SECONDS, default 1 minute only.
+		* grace: float; seconds the clock waits past a bar's end before
+		  closing it, default 2. Ticks stamped before the close of a
+		  bar that arrive later than that are dropped.
 
 		"""
 		self._event_queues = queues
+		self._aggregator = BarAggregator(granularities)
+		self._lock = Lock()
+		self._grace = grace
 		if config.body:
 			self._config = config
 			self._ssl = config.body['ssl']
@@ -715,23 +1319,17 @@ class PyApi(object):
 			msg = '[API]: Failed to put market event; ' + str(e)
 			return -1
 
-	def _put_bar_event(self, bar=-1):
+	def _put_bar_event(self, bar):
 		"""
-		put currently maintained bar into event queue.
+		put a closed bar into event queue.
 
 		parameters:
 		----------
 		* bar: Bar() object; the data that is to be put into BarEvent()
-		event object. -1 as Default: point to the currently maintained bar,
-		i.e. self._curr_bar.
+		event object.
 		"""
 		try:
-			if bar == -1:
-				if self._curr_bar:
-					event = BarEvent(data = self._curr_bar)
-			else:
-				event = BarEvent(data = bar)
-
+			event = BarEvent(data = bar)
 			self._event_queues['bar'].put(event)
 			return 1
 		except Exception,e:
@@ -773,6 +1371,7 @@ class PyApi(object):
 			resp = s.send(prepped, stream=True, verify=True)
 			assert resp.status_code == 200
 			print '[API]: Stream established.'
+			self.start_clock()
 		except AssertionError:
 			msg = '[API]: Bad request, unexpected response status: ' + \
 				  str(resp.status_code)
@@ -781,16 +1380,19 @@ class PyApi(object):
 			msg = '[API]: Bad request.' + str(e)
 			raise OANDA_RequestError(msg)
 
-		# Iter-lines in resp.
-		for line in resp.iter_lines(90):
-			if line:
-				try:
-					data = json.loads(line)
-					#!! put market impulse into the event queue.
-					self._put_market_event(data)
-				except Exception,e:
-					print '[API]: Stream iterLine Error, ' + str(e)
-					pass
+		# Iter-lines in resp, the clock stops with the stream.
+		try:
+			for line in resp.iter_lines(90):
+				if line:
+					try:
+						data = json.loads(line)
+						#!! put market impulse into the event queue.
+						self._put_market_event(data)
+					except Exception,e:
+						print '[API]: Stream iterLine Error, ' + str(e)
+						pass
+		finally:
+			self.stop_clock()
 
 	#----------------------------------------------------------------------
 	# get methods.
@@ -1026,7 +1628,7 @@ class PyApi(object):
 	def on_market_impulse(self, event):
 		"""
 		call back function on market impulses.
-		filter/clean tick data 
+		filter/clean tick data, put the bars it closes into the bar queue.
 
 		parameters
 		----------
@@ -1034,50 +1636,82 @@ class PyApi(object):
 
 		returnCode
 		----------
-		* 0: a tick was appended to current bar.
-		* 1: pop current bar, start a new bar.
+		* 0: a tick was appended to current bars.
+		* 1: bars were closed and put into the bar queue.
+		* -1: an empty heartbeat, no bar ended.
 		"""
+		# bars are published under the lock, so the clock thread can
+		# not interleave its bars with these.
 		if event.is_heartbeat == False: # Not an empty heartbeat.
 			tick = Tick(event.body)
-			if not self._curr_bar: # create a new bar.
-				bar = Bar(tick, tick.dt)
-				self._curr_bar = bar
-			else: 
-				bar = self._curr_bar
-
-			if tick.dt < bar.end and tick.dt >= bar.start:
-				bar.push(tick)
-				return 0
-			else:
-				self._put_bar_event() 
-				#!!! this line should be excuted before 
-				#!!! the reset of self._curr_bar pointer.
-				new_start = bar.end
-				self._curr_bar = Bar(tick, new_start) # create a new bar.
-				return 1
-
+			with self._lock:
+				bars = self._aggregator.push(tick)
+				for bar in bars:
+					self._put_bar_event(bar)
 		else: # empty heartbeat.
 			hb = HeartBeat(event.body)
-			if not self._curr_bar:
-				pass
-			else:
-				bar = self._curr_bar
-
-			if hb.dt < bar.end and hb.dt >= bar.start:
-				pass # this is only an empty heartbeat.
+			with self._lock:
+				bars = self._aggregator.flush(int(hb.time) // 1000000)
+				for bar in bars:
+					self._put_bar_event(bar)
+			if not bars:
 				return -1
-			else:
-				if bar:
-					self._put_bar_event() 
-					#!!! this line should be excuted before 
-					#!!! the reset of self._curr_bar pointer.
-					new_start = bar.end
-					tick = Tick({'tick':
-						{
-							'ask': bar.ask_close,
-							'bid': bar.bid_close,
-							'instrument': bar.instrument,
-							'time': 0 # only a place holder.
-						}})
-					self._curr_bar = Bar(tick, new_start)
-					return 1
+		return 1 if bars else 0
+
+	#----------------------------------------------------------------------
+	# bar clock
+
+	def on_clock(self, now=None):
+		"""
+		close and publish every bar that ended by now - grace, for all
+		instruments and granularities.
+
+		parameters
+		----------
+		* now: float; Unix timestamp, default time.time().
+
+		returns
+		-------
+		* integer; number of bars published.
+		"""
+		if now is None:
+			now = time.time()
+		with self._lock:
+			bars = self._aggregator.flush(int(now - self._grace))
+			for bar in bars:
+				self._put_bar_event(bar)
+		return len(bars)
+
+	def _run_clock(self, stopped):
+		"""
+		clock thread, wakes at every boundary of the finest bars, until
+		stopped (a threading.Event) is set.
+		"""
+		span = self._aggregator.spans[0]
+		while True:
+			now = time.time() - self._grace
+			# just past the boundary, so int(time) reaches it.
+			if stopped.wait(span - now % span + 0.001):
+				return
+			self.on_clock()
+
+	def start_clock(self):
+		"""
+		start closing bars at their boundaries plus grace, instead of
+		waiting for a later tick or heartbeat. Called by make_stream(),
+		stopped when its stream ends.
+		"""
+		if not self._clock_on:
+			self._clock_on = True
+			self._clock_stopped = Event()
+			self._clock = Thread(target=self._run_clock, name='_THRD_CLOCK',
+								 args=(self._clock_stopped,))
+			self._clock.daemon = True
+			self._clock.start()
+
+	def stop_clock(self):
+		""" stop the clock thread. """
+		if self._clock_on:
+			self._clock_on = False
+			self._clock_stopped.set()
+			self._clock.join()
@@ -0,0 +1,127 @@
+import numpy as np
+
+from statics import BarColNames, CurrencyType, CURRENCY_CODE_MAPPING
+from errors import KernelDataError
+
+__author__ = 'zed'
+
+# ----------------------------------------------------------------------
+# Currency conversion.
+
+
+def split_instrument(instrument):
+    """
+    :param instrument: string; name of instrument, e.g. 'EUR_USD'.
+    :return: tuple; (base, quote) ISO codes, e.g. ('EUR', 'USD').
+    """
+    base, quote = instrument.split('_')
+    return base, quote
+
+
+class ConversionMatrix(object):
+    """
+    Per-bar rates of every currency of a bar panel into an account base
+    currency: rates[t, k] is the value of one unit of currencies[k] at
+    bar t, in base currency.
+
+    Built once per panel. Starting from the base currency (rate 1), each
+    pair whose one side is known gives its other side, as a whole
+    column operation:
+        - [X/Y: price], Y known: rate(X) = price * rate(Y).
+        - [X/Y: price], X known: rate(Y) = rate(X) / price.
+    So direct pairs, their inverses and crosses through any chain of
+    pairs are all covered; e.g. for a USD account, HKD comes from
+    USD_HKD, JPY from EUR_JPY and EUR_USD.
+
+    <example>
+        rates = ConversionMatrix(panel, CurrencyType.USD).quote_rates()
+        pnl_usd = pnl_quote * rates     # bars x panel instruments
+
+    <privates>
+        - base: string; ISO code of the base currency.
+        - currencies: list; ISO codes, columns of rates.
+        - rates: np.ndarray; bars x currencies, nan where no pair
+          quotes a path to base at that bar.
+        - pairs: list; (base, quote) of each panel instrument.
+    """
+
+    def __init__(self, panel, base):
+        """
+        Constructor.
+        :param panel: dataset.BarPanel object.
+        :param base: CurrencyType(Enum) object; account base currency.
+        :return:
+        """
+        if base.__class__ != CurrencyType:
+            msg = '[CURRENCY::ConversionMatrix]: Invalid base currency. '
+            raise KernelDataError(msg)
+        self.base = CURRENCY_CODE_MAPPING[base]
+        self.pairs = [split_instrument(i) for i in panel.instruments]
+        self.currencies = sorted(
+            set(c for pair in self.pairs for c in pair) | set([self.base]))
+        column = dict((c, k) for k, c in enumerate(self.currencies))
+
+        close = panel.field(BarColNames.close.value)
+        self.rates = np.empty((len(panel), len(self.currencies)))
+        self.rates.fill(np.nan)
+        self.rates[:, column[self.base]] = 1.0
+
+        known, changed = set([self.base]), True
+        while changed:
+            changed = False
+            for k, (x, y) in enumerate(self.pairs):
+                if y in known and x not in known:
+                    self.rates[:, column[x]] = \
+                        close[:, k] * self.rates[:, column[y]]
+                    known.add(x)
+                    changed = True
+                elif x in known and y not in known:
+                    self.rates[:, column[y]] = \
+                        self.rates[:, column[x]] / close[:, k]
+                    known.add(y)
+                    changed = True
+
+    def __len__(self):
+        return len(self.rates)
+
+    def rate(self, currency):
+        """
+        :param currency: CurrencyType(Enum) object, or string ISO code.
+        :return: np.ndarray; per-bar value of one unit, in base currency.
+        """
+        if currency.__class__ == CurrencyType:
+            currency = CURRENCY_CODE_MAPPING[currency]
+        if currency not in self.currencies:
+            msg = '[CURRENCY::ConversionMatrix]: {} is not quoted. '.format(
+                currency)
+            raise KernelDataError(msg)
+        return self.rates[:, self.currencies.index(currency)]
+
+    def quote_rates(self):
+        """
+        Quote currency rate of each panel instrument, so that quote
+        currency amounts (pnl, price * volume) times these rates are in
+        base currency.
+        :return: np.ndarray; bars x panel instruments.
+        """
+        missing = set(y for x, y in self.pairs) & set(self.unreachable())
+        if missing:
+            msg = '[CURRENCY::ConversionMatrix]: No path from {} to {}. ' \
+                .format(sorted(missing), self.base)
+            raise KernelDataError(msg)
+        return np.column_stack([self.rate(y) for x, y in self.pairs])
+
+    def base_rates(self):
+        """
+        Base currency rate of each panel instrument, so that volumes
+        times these rates are in account base currency (margin).
+        :return: np.ndarray; bars x panel instruments.
+        """
+        return np.column_stack([self.rate(x) for x, y in self.pairs])
+
+    def unreachable(self):
+        """
+        :return: list; ISO codes with no path to base at any bar.
+        """
+        return [c for k, c in enumerate(self.currencies)
+                if np.isnan(self.rates[:, k]).all()]
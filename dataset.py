@@ -0,0 +1,269 @@
+import os
+import uuid
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+from statics import BarColNames
+from utils import encode_instrument
+from errors import KernelDataError
+
+__author__ = 'zed'
+
+# ----------------------------------------------------------------------
+# Shared bar dataset.
+
+# POSIX shared memory is mounted here on Linux; fall back to temp dir.
+SHM_ROOT = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+DATASET_PREFIX = 'oanda-bars-'
+
+
+class BarDataset(object):
+    """
+    Bar columns placed in shared memory.
+    Every numeric/datetime column of a bar frame is written once to an
+    .npy file under SHM_ROOT; any process can attach to the dataset by
+    name and gets read-only memory-mapped views, so N workers cost one
+    copy of RAM. Pickles as its name only.
+
+    Usable directly as Kernel.data: len(data), data[column] (pd.Series
+    over the mapped column), data.index and data.iterrows().
+
+    <example>
+        ds = BarDataset.from_frame(api.get_bars('EUR_USD', 'M1', 5000))
+        Kernel.sweep(DMA, grid, ds)     # workers attach by ds.name
+        ds.unlink()
+
+    <privates>
+        - name: string; dataset name.
+        - root: string; directory holding all datasets.
+        - columns: list; column names, in frame order.
+        - arrays: dict; {column: read-only np.memmap}.
+    """
+
+    def __init__(self, name, root=None):
+        """
+        Constructor, attach to an existing dataset.
+        :param name: string; dataset name.
+        :param root: string; directory holding datasets.
+            <Default>: None; SHM_ROOT.
+        :return:
+        """
+        self.name = name
+        self.root = root or SHM_ROOT
+        path = self.path()
+        try:
+            with open(os.path.join(path, 'columns')) as f:
+                self.columns = f.read().splitlines()
+        except IOError:
+            msg = '[DATASET::BarDataset]: No dataset named {}. '.format(name)
+            raise KernelDataError(msg)
+        self.arrays = dict(
+            (col, np.load(os.path.join(path, '{}.npy'.format(i)),
+                          mmap_mode='r'))
+            for i, col in enumerate(self.columns))
+
+    @classmethod
+    def attach(cls, name, root=None):
+        """
+        Reload constructor, same as BarDataset(name, root).
+        :return: BarDataset object.
+        """
+        return cls(name, root)
+
+    @classmethod
+    def from_frame(cls, data, name=None, root=None):
+        """
+        Write the numeric and datetime columns of a bar frame to shared
+        memory, then attach to them. Object columns are left out.
+        :param data: pd.DataFrame object; bar data.
+        :param name: string; dataset name. <Default>: None; random.
+        :param root: string; <Default>: None; SHM_ROOT.
+        :return: BarDataset object.
+        """
+        name = name or uuid.uuid4().hex
+        path = os.path.join(root or SHM_ROOT, DATASET_PREFIX + name)
+        os.makedirs(path)
+        columns = [col for col in data.columns
+                   if data[col].dtype.kind in 'biufM']
+        for i, col in enumerate(columns):
+            values = np.ascontiguousarray(data[col].values)
+            np.save(os.path.join(path, '{}.npy'.format(i)), values)
+        with open(os.path.join(path, 'columns'), 'w') as f:
+            f.write('\n'.join(columns))
+        return cls(name, root)
+
+    def __reduce__(self):
+        # Workers re-attach by name instead of receiving the columns.
+        return BarDataset, (self.name, self.root)
+
+    def path(self):
+        """
+        :return: string; directory of this dataset.
+        """
+        return os.path.join(self.root, DATASET_PREFIX + self.name)
+
+    def unlink(self):
+        """
+        Remove the dataset from shared memory. Views that are already
+        mapped stay valid until they are released.
+        :return:
+        """
+        shutil.rmtree(self.path(), ignore_errors=True)
+
+    def __len__(self):
+        return len(self.arrays[self.columns[0]]) if self.columns else 0
+
+    def __getitem__(self, column):
+        """
+        :param column: string; column name.
+        :return: pd.Series object; over the read-only mapped column.
+        """
+        return pd.Series(self.arrays[column], name=column)
+
+    @property
+    def index(self):
+        return pd.Index(np.arange(len(self)))
+
+    def values(self, column):
+        """
+        :param column: string; column name.
+        :return: np.memmap object; read-only view.
+        """
+        return self.arrays[column]
+
+    def slice(self, start, stop):
+        """
+        :param start: int; first bar.
+        :param stop: int; bar after the last.
+        :return: pd.DataFrame object; over views of the mapped columns.
+        """
+        return pd.DataFrame(dict((col, self.arrays[col][start:stop])
+                                 for col in self.columns),
+                            columns=self.columns)
+
+    def iterrows(self, start=0, stop=None):
+        """
+        Iterate over bars, like pd.DataFrame.iterrows().
+        :param start: int; first bar.
+            <Default>: 0.
+        :param stop: int; bar after the last.
+            <Default>: None; to the end.
+        :return: generator; (index, {column: value}) tuples.
+        """
+        arrays = [self.arrays[col] for col in self.columns]
+        is_time = [a.dtype.kind == 'M' for a in arrays]
+        for i in xrange(*slice(start, stop).indices(len(self))):
+            yield i, dict(
+                (col, pd.Timestamp(a[i]) if t else a[i])
+                for col, a, t in zip(self.columns, arrays, is_time))
+
+    def to_frame(self):
+        """
+        :return: pd.DataFrame object; a copy of all columns.
+        """
+        return pd.DataFrame(dict((col, np.array(self.arrays[col]))
+                                 for col in self.columns),
+                            columns=self.columns)
+
+
+# ----------------------------------------------------------------------
+# Aligned multi-instrument bars.
+
+
+class BarPanel(object):
+    """
+    Time-aligned bars of many instruments, as one 3-D array
+    (bars x instruments x fields). Bars missing for an instrument are
+    forward filled; before its first bar the values are nan.
+
+    Usable as Kernel.data for Kernel.run_portfolio().
+
+    <example>
+        panel = BarPanel.from_frames(
+            dict((i, api.get_bars(i, 'M1', 5000)) for i in pairs))
+        close = panel.field(BarColNames.close.value)  # bars x instruments
+
+    <privates>
+        - values: np.ndarray; float64, bars x instruments x fields.
+        - index: pd.Index object; bar times.
+        - instruments: list; instrument names, in panel order.
+        - fields: list; field names, e.g. 'closeMid'.
+        - codes: np.ndarray; int32 instrument codes, in panel order.
+    """
+
+    def __init__(self, values, index, instruments, fields):
+        """
+        Constructor.
+        :param values: array-like; bars x instruments x fields.
+        :param index: array-like; bar times.
+        :param instruments: list; instrument names.
+        :param fields: list; field names.
+        :return:
+        """
+        self.values = np.asarray(values, dtype=np.float64)
+        if self.values.shape[1:] != (len(instruments), len(fields)):
+            msg = '[DATASET::BarPanel]: Values do not match instruments ' \
+                  'and fields. '
+            raise KernelDataError(msg)
+        self.index = pd.Index(index)
+        self.instruments = list(instruments)
+        self.fields = list(fields)
+        self.codes = np.array([encode_instrument(i) for i in instruments],
+                              dtype=np.int32)
+
+    @classmethod
+    def from_frame(cls, data):
+        """
+        Reload constructor, from a frame with (instrument, field)
+        MultiIndex columns, indexed by time.
+        :param data: pd.DataFrame object.
+        :return: BarPanel object.
+        """
+        instruments = list(data.columns.get_level_values(0).unique())
+        fields = list(data.columns.get_level_values(1).unique())
+        columns = pd.MultiIndex.from_product([instruments, fields])
+        values = data.reindex(columns=columns).ffill().values
+        return cls(values.reshape(len(data), len(instruments), len(fields)),
+                   data.index, instruments, fields)
+
+    @classmethod
+    def from_frames(cls, frames, fields=None):
+        """
+        Reload constructor, align one bar frame per instrument on the
+        union of their times.
+        :param frames: dict; {instrument: pd.DataFrame object}, bar data
+            with a BarColNames.time column.
+        :param fields: list; fields to keep.
+            <Default>: None; numeric columns present in every frame.
+        :return: BarPanel object.
+        """
+        time = BarColNames.time.value
+        if fields is None:
+            fields = [col for col in frames.values()[0].columns
+                      if col != time and all(
+                          col in f and f[col].dtype.kind in 'biuf'
+                          for f in frames.values())]
+        data = pd.concat(
+            dict((instrument, frame.set_index(time)[fields])
+                 for instrument, frame in frames.iteritems()), axis=1)
+        return cls.from_frame(data.sort_index())
+
+    def __len__(self):
+        return len(self.values)
+
+    def field(self, name):
+        """
+        :param name: string; field name.
+        :return: np.ndarray; bars x instruments view.
+        """
+        return self.values[:, :, self.fields.index(name)]
+
+    def to_frame(self):
+        """
+        :return: pd.DataFrame object; (instrument, field) columns.
+        """
+        columns = pd.MultiIndex.from_product([self.instruments, self.fields])
+        return pd.DataFrame(self.values.reshape(len(self), -1),
+                            index=self.index, columns=columns)
@@ -9,6 +9,18 @@ class ApiClientError(Exception):
     pass
 
 
+class OANDA_RequestError(Exception):
+    pass
+
+
+class OANDA_EnvError(Exception):
+    pass
+
+
+class OANDA_DataConstructorError(Exception):
+    pass
+
+
 class KernelOrderError(Exception):
     pass
 
@@ -28,3 +40,6 @@ class KernelAccountError(Exception):
 class KernelBacktestError(Exception):
     pass
 
+
+class KernelDataError(Exception):
+    pass
@@ -0,0 +1,440 @@
+from collections import deque
+
+import numpy as np
+from scipy.signal import lfilter
+
+__author__ = 'zed'
+
+# ----------------------------------------------------------------------
+# Incremental indicators.
+"""
+Fixed-memory indicator state objects.
+
+Every indicator keeps O(window) state, has an O(1) (amortized)
+update(price) that returns the current value, and a vectorized
+compute(array) that gives the same values over a whole series.
+update() and compute() perform the same floating point operations in
+the same order, so a strategy can switch between on_bar() and on_data()
+without changing its signals.
+
+Windows that are not full yet use all observations so far, the same as
+np.mean(history[-window:]) over a growing history list.
+
+The same objects serve backtest strategies (kernel.StrategyTemplate)
+and live handlers (strat.BaseStrategy.on_bar), since both feed floats.
+"""
+
+
+class RingBuffer(object):
+    """
+    Fixed-size float ring buffer.
+
+    <privates>
+        - values: np.ndarray; storage of length size.
+        - count: int; number of values pushed so far.
+    """
+
+    def __init__(self, size):
+        """
+        Constructor.
+        :param size: int; capacity.
+        :return:
+        """
+        self.values = np.zeros(size)
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, len(self.values))
+
+    def push(self, value):
+        """
+        Write value, overwriting the oldest one once full.
+        :param value: double.
+        :return: double; the value that fell out, 0 if not full yet.
+        """
+        i = self.count % len(self.values)
+        old = self.values[i]
+        self.values[i] = value
+        self.count += 1
+        return old
+
+    def oldest(self):
+        """
+        :return: double; the value that the next push() overwrites.
+        """
+        return self.values[self.count % len(self.values)]
+
+
+def _window_sums(cum_sum, window):
+    """
+    Sums over trailing windows, from a cumulative sum.
+    :param cum_sum: np.ndarray; cumulative sum along axis 0.
+    :param window: int.
+    :return: np.ndarray.
+    """
+    total = cum_sum.copy()
+    total[window:] -= cum_sum[:-window]
+    return total
+
+
+def _counts(n, window):
+    """
+    :return: np.ndarray; number of observations in each trailing window.
+    """
+    return np.minimum(np.arange(1, n + 1), window).astype(np.float64)
+
+
+class SMA(object):
+    """
+    Simple moving average.
+    Keeps the running total and a ring of past running totals, so
+    update() is (total_t - total_{t-window}) / n, exactly what
+    compute() gets from one np.cumsum().
+    """
+
+    def __init__(self, window):
+        """
+        :param window: int; averaging window.
+        """
+        self.window = window
+        self.reset()
+
+    def reset(self):
+        self.total = 0.0
+        self.totals = RingBuffer(self.window)
+        self.value = np.nan
+
+    @property
+    def ready(self):
+        return self.totals.count >= self.window
+
+    def update(self, price):
+        """
+        :param price: double.
+        :return: double; current average.
+        """
+        lagged = self.totals.oldest() if self.ready else 0.0
+        self.total += price
+        self.totals.push(self.total)
+        self.value = (self.total - lagged) / min(self.totals.count,
+                                                 self.window)
+        return self.value
+
+    def compute(self, array):
+        """
+        :param array: array-like; prices, along axis 0.
+        :return: np.ndarray; averages, same shape.
+        """
+        values = np.asarray(array, dtype=np.float64)
+        total = _window_sums(np.cumsum(values, axis=0), self.window)
+        counts = _counts(len(values), self.window)
+        return total / counts.reshape((-1,) + (1,) * (values.ndim - 1))
+
+    @staticmethod
+    def compute_many(array, windows):
+        """
+        Averages for several windows from a single cumulative sum.
+        :param array: array-like; prices.
+        :param windows: list; int windows.
+        :return: dict; {window: np.ndarray}.
+        """
+        values = np.asarray(array, dtype=np.float64)
+        cum_sum = np.cumsum(values)
+        return dict((w, _window_sums(cum_sum, w) / _counts(len(values), w))
+                    for w in set(windows))
+
+
+class EWMA(object):
+    """
+    Exponentially weighted moving average.
+    y_t = alpha * x_t + (1 - alpha) * y_{t-1}, y_{-1} = x_0.
+    compute() runs the same recursion through scipy.signal.lfilter().
+    """
+
+    def __init__(self, alpha=None, span=None):
+        """
+        :param alpha: double; smoothing factor in (0, 1].
+        :param span: double; alternative, alpha = 2 / (span + 1).
+        """
+        self.alpha = alpha if alpha is not None else 2.0 / (span + 1)
+        self.reset()
+
+    def reset(self):
+        self.value = np.nan
+        self.count = 0
+
+    @property
+    def ready(self):
+        return self.count > 0
+
+    def update(self, price):
+        """
+        :param price: double.
+        :return: double; current average.
+        """
+        previous = self.value if self.count else price
+        self.value = self.alpha * price + (1 - self.alpha) * previous
+        self.count += 1
+        return self.value
+
+    def compute(self, array):
+        """
+        :param array: array-like; prices, along axis 0.
+        :return: np.ndarray; averages, same shape.
+        """
+        values = np.asarray(array, dtype=np.float64)
+        if not len(values):
+            return values.copy()
+        decay = 1 - self.alpha
+        initial = (decay * values[0])[np.newaxis]
+        out, _ = lfilter([self.alpha], [1, -decay], values, axis=0,
+                         zi=initial)
+        return out
+
+
+class RollingStd(object):
+    """
+    Rolling standard deviation.
+    Running sums of x - shift and (x - shift)^2, shift being the first
+    price, keep the sums small so cancellation stays negligible.
+    """
+
+    def __init__(self, window, ddof=1):
+        """
+        :param window: int.
+        :param ddof: int; delta degrees of freedom. <Default>: 1.
+        """
+        self.window = window
+        self.ddof = ddof
+        self.reset()
+
+    def reset(self):
+        self.shift = None
+        self.sma = SMA(self.window)
+        self.sma_sq = SMA(self.window)
+        self.value = np.nan
+
+    @property
+    def ready(self):
+        return self.sma.ready
+
+    def __finish(self, mean, mean_sq, counts):
+        var = (mean_sq - mean * mean) * counts / (counts - self.ddof)
+        return np.sqrt(np.maximum(var, 0))
+
+    def update(self, price):
+        """
+        :param price: double.
+        :return: double; current standard deviation, nan while fewer
+            than ddof + 1 prices were seen.
+        """
+        if self.shift is None:
+            self.shift = price
+        x = price - self.shift
+        mean = self.sma.update(x)
+        mean_sq = self.sma_sq.update(x * x)
+        n = float(min(self.sma.totals.count, self.window))
+        self.value = self.__finish(mean, mean_sq, n) \
+            if n > self.ddof else np.nan
+        return self.value
+
+    def compute(self, array):
+        """
+        :param array: array-like; prices.
+        :return: np.ndarray.
+        """
+        values = np.asarray(array, dtype=np.float64)
+        if not len(values):
+            return values.copy()
+        x = values - values[0]
+        counts = _counts(len(values), self.window)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out = self.__finish(self.sma.compute(x), self.sma.compute(x * x),
+                                counts)
+        out[counts <= self.ddof] = np.nan
+        return out
+
+
+class MACD(object):
+    """
+    Moving Average Convergence-Divergence.
+    macd = EWMA(fast) - EWMA(slow); signal = EWMA(macd);
+    histogram = macd - signal.
+    """
+
+    def __init__(self, fast=12, slow=26, signal=9):
+        """
+        :param fast, slow, signal: int; EWMA spans.
+        """
+        self.fast = EWMA(span=fast)
+        self.slow = EWMA(span=slow)
+        self.signal = EWMA(span=signal)
+        self.value = np.nan
+
+    def reset(self):
+        for ewma in [self.fast, self.slow, self.signal]:
+            ewma.reset()
+        self.value = np.nan
+
+    @property
+    def ready(self):
+        return self.fast.ready
+
+    def update(self, price):
+        """
+        :param price: double.
+        :return: tuple; (macd, signal, histogram).
+        """
+        macd = self.fast.update(price) - self.slow.update(price)
+        signal = self.signal.update(macd)
+        self.value = (macd, signal, macd - signal)
+        return self.value
+
+    def compute(self, array):
+        """
+        :param array: array-like; prices.
+        :return: tuple; (macd, signal, histogram) np.ndarray objects.
+        """
+        macd = self.fast.compute(array) - self.slow.compute(array)
+        signal = self.signal.compute(macd)
+        return macd, signal, macd - signal
+
+
+class RollingExtreme(object):
+    """
+    Rolling maximum or minimum, over a monotonic deque of
+    (index, price) pairs; update() is amortized O(1).
+    """
+
+    def __init__(self, window, use_max=True):
+        """
+        :param window: int.
+        :param use_max: boolean; True for maximum, False for minimum.
+        """
+        self.window = window
+        self.use_max = use_max
+        self.reset()
+
+    def reset(self):
+        self.candidates = deque()
+        self.count = 0
+        self.value = np.nan
+
+    @property
+    def ready(self):
+        return self.count >= self.window
+
+    def update(self, price):
+        """
+        :param price: double.
+        :return: double; current extreme.
+        """
+        sign = 1 if self.use_max else -1
+        while self.candidates and \
+                sign * self.candidates[-1][1] <= sign * price:
+            self.candidates.pop()
+        self.candidates.append((self.count, price))
+        if self.candidates[0][0] <= self.count - self.window:
+            self.candidates.popleft()
+        self.count += 1
+        self.value = self.candidates[0][1]
+        return self.value
+
+    def compute(self, array):
+        """
+        :param array: array-like; prices.
+        :return: np.ndarray.
+        """
+        values = np.asarray(array, dtype=np.float64)
+        if not len(values):
+            return values.copy()
+        # Front padding with the first price keeps partial windows
+        # exact, since the first price is in all of them.
+        w = self.window
+        padded = np.concatenate([np.repeat(values[:1], w - 1), values])
+        # Van Herk/Gil-Werman: blocks of w, running extremes from each
+        # block's start (head) and from its end (tail); a window
+        # starting at i spans tail[i] and head[i + w - 1]. O(n).
+        extreme = np.maximum if self.use_max else np.minimum
+        fill = -np.inf if self.use_max else np.inf
+        blocks = np.append(padded, np.repeat(fill, -len(padded) % w))
+        blocks = blocks.reshape(-1, w)
+        head = extreme.accumulate(blocks, axis=1).ravel()
+        tail = extreme.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+        return extreme(tail[:len(values)], head[w - 1:w - 1 + len(values)])
+
+
+class RollingMax(RollingExtreme):
+
+    def __init__(self, window):
+        RollingExtreme.__init__(self, window, use_max=True)
+
+
+class RollingMin(RollingExtreme):
+
+    def __init__(self, window):
+        RollingExtreme.__init__(self, window, use_max=False)
+
+
+class RollingCov(object):
+    """
+    Rolling covariance of two series, from running sums of the
+    shifted series and their product (see RollingStd).
+    """
+
+    def __init__(self, window, ddof=1):
+        """
+        :param window: int.
+        :param ddof: int; delta degrees of freedom. <Default>: 1.
+        """
+        self.window = window
+        self.ddof = ddof
+        self.reset()
+
+    def reset(self):
+        self.shift = None
+        self.sma_x = SMA(self.window)
+        self.sma_y = SMA(self.window)
+        self.sma_xy = SMA(self.window)
+        self.value = np.nan
+
+    @property
+    def ready(self):
+        return self.sma_x.ready
+
+    def __finish(self, mean_x, mean_y, mean_xy, counts):
+        return (mean_xy - mean_x * mean_y) * counts / (counts - self.ddof)
+
+    def update(self, x, y):
+        """
+        :param x, y: double; one observation of each series.
+        :return: double; current covariance.
+        """
+        if self.shift is None:
+            self.shift = (x, y)
+        dx, dy = x - self.shift[0], y - self.shift[1]
+        mean_x = self.sma_x.update(dx)
+        mean_y = self.sma_y.update(dy)
+        mean_xy = self.sma_xy.update(dx * dy)
+        n = float(min(self.sma_x.totals.count, self.window))
+        self.value = self.__finish(mean_x, mean_y, mean_xy, n) \
+            if n > self.ddof else np.nan
+        return self.value
+
+    def compute(self, x, y):
+        """
+        :param x, y: array-like; the two series.
+        :return: np.ndarray.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        if not len(x):
+            return x.copy()
+        dx, dy = x - x[0], y - y[0]
+        counts = _counts(len(x), self.window)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out = self.__finish(self.sma_x.compute(dx),
+                                self.sma_y.compute(dy),
+                                self.sma_xy.compute(dx * dy), counts)
+        out[counts <= self.ddof] = np.nan
+        return out
@@ -1,14 +1,26 @@
+import copy
 import json
+import heapq
+import itertools
+import multiprocessing
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
 
 from utils import serialize_dict, serialize_merge_dict, \
-    map_to_unrealized_pnl, map_to_holding_values
+    encode_order_types, encode_instrument, decode_instrument, \
+    instrument_names, to_ns, from_ns, NAT_NS
 
 from statics import OrderType, PositionType, PositionStatus, CurrencyType, \
-    TradingExecuteFlag, BarColNames, ORD_POS_MAPPING
+    TradingExecuteFlag, BarColNames, RecordMode, ClosePolicy, \
+    ORD_POS_MAPPING, \
+    ORD_CODE_MAPPING, CODE_ORD_MAPPING, POS_CODES, POS_CODE_MAPPING, \
+    PENDING_ORDER_TYPES
+from indicators import SMA, RollingStd
+from memo import default_cache
+from currency import ConversionMatrix
 from errors import KernelOrderError, KernelPositionError, KernelAccountError, \
-    KernelBacktestError
+    KernelBacktestError, KernelDataError
 __author__ = 'zed'
 
 # ----------------------------------------------------------------------
@@ -78,6 +90,60 @@ class Order:
             raise KernelOrderError(msg)
         return cls(instrument, direction, time, price, volume)
 
+    @classmethod
+    def bracket(cls, instrument, direction, time, price, volume,
+                stop_loss=None, take_profit=None):
+        """
+        Reload constructor for order that opens a position with stop
+        loss and/or take profit levels. The account closes the position
+        once a bar's high/low reaches a level, see
+        Account.check_brackets().
+        :param stop_loss: double; price level. <Default>: None.
+        :param take_profit: double; price level. <Default>: None.
+        :return: Order object.
+        """
+        order = cls.open(instrument, direction, time, price, volume)
+        order.body['stop_loss'] = stop_loss
+        order.body['take_profit'] = take_profit
+        return order
+
+    @classmethod
+    def limit(cls, instrument, direction, time, trigger, volume,
+              stop_loss=None, take_profit=None):
+        """
+        Reload constructor for a limit order resting in Kernel.book,
+        optionally opening with stop loss/take profit levels as
+        bracket() does once it fills.
+        :param direction: OrderType.limit_buy/limit_sell.
+        :param trigger: double; limit price.
+        :return: Order object.
+        """
+        if not (direction in [OrderType.limit_buy, OrderType.limit_sell]):
+            msg = '[KERNEL::Order]: Unable to construct Order object. '
+            raise KernelOrderError(msg)
+        order = cls(instrument, direction, time, trigger, volume)
+        order.body['stop_loss'] = stop_loss
+        order.body['take_profit'] = take_profit
+        return order
+
+    @classmethod
+    def exit(cls, instrument, direction, time, trigger, target_id,
+             volume=None):
+        """
+        Reload constructor for a take profit/stop loss order resting in
+        Kernel.book, guarding one opening position. Exit orders of the
+        same position cancel each other once one fires.
+        :param direction: OrderType.take_profit/stop_loss.
+        :param trigger: double; exit price.
+        :param target_id: int; id of the guarded position.
+        :param volume: int/double; <Default>: None; whole position.
+        :return: Order object.
+        """
+        if not (direction in [OrderType.take_profit, OrderType.stop_loss]):
+            msg = '[KERNEL::Order]: Unable to construct Order object. '
+            raise KernelOrderError(msg)
+        return cls(instrument, direction, time, trigger, volume, target_id)
+
     @classmethod
     def close(cls, instrument, direction, time, price):
         """
@@ -140,19 +206,259 @@ class Order:
         """
         print json.dumps(serialize_dict(self.body), indent=4, sort_keys=True)
 
+# ----------------------------------------------------------------------
+# Position book.
+
+
+class PositionBook(object):
+    """
+    Struct-of-arrays position store.
+    Every position is one row, every field one numpy column. Columns grow
+    by amortized doubling, so a closed trade costs one row of scalars
+    instead of a Position object with a body dict.
+
+    <columns>
+        - position_id: int64; id given by the account, -1 if none.
+        - instrument: int32; code from utils.encode_instrument().
+        - direction: int8; index into POS_CODES.
+        - volume: float64.
+        - open_time, close_time: int64; ns since epoch, NaT if not set.
+        - open_price, close_price, realized_pnl: float64; nan if not set.
+        - stop_loss, take_profit: float64; bracket levels, nan if none.
+
+    <privates>
+        - size: int; number of rows in use (including released rows).
+        - columns: dict; {field: np.ndarray} of length >= size.
+        - free: list; released rows to be reused by append().
+        - shares: list; [number of books sharing columns], one list
+          per group of forks, see fork().
+    """
+    # Column layout.
+    __dtypes = [('position_id', np.int64),
+                ('instrument', np.int32), ('direction', np.int8),
+                ('volume', np.float64), ('open_time', np.int64),
+                ('open_price', np.float64), ('close_time', np.int64),
+                ('close_price', np.float64), ('realized_pnl', np.float64),
+                ('stop_loss', np.float64), ('take_profit', np.float64)]
+    __keys = [name for name, dtype in __dtypes]
+
+    def __init__(self, capacity=64):
+        """
+        Constructor.
+        :param capacity: int; initial number of rows.
+        :return:
+        """
+        self.size = 0
+        self.free = []
+        self.shares = [1]
+        self.columns = dict((name, np.empty(max(capacity, 1), dtype))
+                            for name, dtype in self.__dtypes)
+
+    def fork(self):
+        """
+        Copy-on-write copy. Both books read the same columns until one
+        of them writes, which then copies the columns for itself.
+        :return: PositionBook object.
+        """
+        book = PositionBook.__new__(PositionBook)
+        book.size, book.free = self.size, list(self.free)
+        book.columns, book.shares = self.columns, self.shares
+        self.shares[0] += 1
+        return book
+
+    def __own(self):
+        """
+        Copy shared columns before a write.
+        :return:
+        """
+        if self.shares[0] > 1:
+            self.shares[0] -= 1
+            self.shares = [1]
+            self.columns = dict((name, col.copy())
+                                for name, col in self.columns.iteritems())
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, slot):
+        """
+        :param slot: int; row index, negative counts from the end.
+        :return: Position object; a view on the row.
+        """
+        if slot < 0:
+            slot += self.size
+        if not 0 <= slot < self.size:
+            raise IndexError(slot)
+        return Position.at(self, slot)
+
+    def __iter__(self):
+        for slot in xrange(self.size):
+            yield Position.at(self, slot)
+
+    def __grow(self):
+        """
+        Double the capacity of all columns.
+        :return:
+        """
+        for name in self.__keys:
+            old = self.columns[name]
+            new = np.empty(2 * len(old), old.dtype)
+            new[:self.size] = old[:self.size]
+            self.columns[name] = new
+
+    def __new_slot(self):
+        """
+        :return: int; a released row, or a fresh row at the end.
+        """
+        self.__own()
+        if self.free:
+            return self.free.pop()
+        if self.size == len(self.columns['volume']):
+            self.__grow()
+        self.size += 1
+        return self.size - 1
+
+    def append(self, instrument, direction, volume, open_time, open_price,
+               position_id=-1):
+        """
+        Write an opening position.
+        :param instrument: string; name of instrument.
+        :param direction: PositionType(Enum) object.
+        :param volume: int/double.
+        :param open_time: datetime.datetime object.
+        :param open_price: double.
+        :param position_id: int; <Default>: -1; no id.
+        :return: int; the row written.
+        """
+        slot = self.__new_slot()
+        c = self.columns
+        c['position_id'][slot] = position_id
+        c['instrument'][slot] = encode_instrument(instrument)
+        c['direction'][slot] = POS_CODE_MAPPING[direction]
+        c['volume'][slot] = volume
+        c['open_time'][slot] = to_ns(open_time)
+        c['open_price'][slot] = open_price
+        c['close_time'][slot] = NAT_NS
+        c['close_price'][slot] = np.nan
+        c['realized_pnl'][slot] = np.nan
+        c['stop_loss'][slot] = np.nan
+        c['take_profit'][slot] = np.nan
+        return slot
+
+    def append_row(self, book, slot):
+        """
+        Copy one row of another book to the end of this book.
+        :param book: PositionBook object; source.
+        :param slot: int; source row.
+        :return: int; the row written.
+        """
+        new_slot = self.__new_slot()
+        for name in self.__keys:
+            self.columns[name][new_slot] = book.columns[name][slot]
+        return new_slot
+
+    def merge(self, slot, volume, price):
+        """
+        Add volume to a row, at volume weighted average open price.
+        :param slot: int.
+        :param volume: int/double; volume added.
+        :param price: double; price of the added volume.
+        :return:
+        """
+        self.__own()
+        c = self.columns
+        total = c['volume'][slot] + volume
+        c['open_price'][slot] = (c['open_price'][slot] * c['volume'][slot] +
+                                 price * volume) / total
+        c['volume'][slot] = total
+
+    def split(self, slot, volume):
+        """
+        Split volume off a row, into a copy of it at the end of this book.
+        :param slot: int; row to split.
+        :param volume: int/double; volume of the new row, taken off slot.
+        :return: int; the new row.
+        """
+        new_slot = self.append_row(self, slot)
+        self.columns['volume'][new_slot] = volume
+        self.columns['volume'][slot] -= volume
+        return new_slot
+
+    def close(self, slot, close_time, close_price, realized_pnl):
+        """
+        Write closing fields of a row.
+        :return:
+        """
+        self.__own()
+        c = self.columns
+        c['close_time'][slot] = to_ns(close_time)
+        c['close_price'][slot] = close_price
+        c['realized_pnl'][slot] = realized_pnl
+
+    def set_bracket(self, slot, stop_loss=None, take_profit=None):
+        """
+        Write bracket levels of a row, None for no level.
+        :return:
+        """
+        self.__own()
+        c = self.columns
+        c['stop_loss'][slot] = np.nan if stop_loss is None else stop_loss
+        c['take_profit'][slot] = \
+            np.nan if take_profit is None else take_profit
+
+    def release(self, slot):
+        """
+        Hand a row back for reuse. Its brackets are cleared, so released
+        rows never trigger.
+        :param slot: int.
+        :return:
+        """
+        self.set_bracket(slot)
+        self.free.append(slot)
+
+    def column(self, name):
+        """
+        :param name: string; field name.
+        :return: np.ndarray; view on the rows in use.
+        """
+        return self.columns[name][:self.size]
+
+    def to_frame(self):
+        """
+        Copy the columns into a DataFrame, one row per position.
+        The DataFrame owns its data, so editing it leaves the book as
+        is; instrument and direction are categoricals over their
+        integer codes.
+        :return: pd.DataFrame object.
+        """
+        c = dict((name, self.column(name)) for name in self.__keys)
+        c['instrument'] = pd.Categorical.from_codes(
+            c['instrument'], instrument_names())
+        c['direction'] = pd.Categorical.from_codes(
+            c['direction'], POS_CODES)
+        c['open_time'] = c['open_time'].view('M8[ns]')
+        c['close_time'] = c['close_time'].view('M8[ns]')
+        return pd.DataFrame(c, columns=self.__keys)
+
 # ----------------------------------------------------------------------
 # Position object.
 
 
-class Position:
+class Position(object):
     """
     Json-like position log object.
+    A lightweight view on one row of a PositionBook; standalone
+    positions get a private one-row book, which costs one small array
+    per column, so many positions belong in a shared book (as in
+    Account).
 
     <privates>
+        - book: PositionBook object; where the fields are stored.
+        - slot: int; row index in book.
         - status: status flag.
             - POSITION_STATUS_OPEN = 'POS_OPENING'
             - POSITION_STATUS_CLOSED = 'POS_CLOSED'
-        - body: dict; position content.
+        - body: dict; position content, built from the row on access.
 
             <example>
             body = {
@@ -165,24 +471,34 @@ class Position:
                 'closePrice': 1.8507,
                 'realizedPnL': 5,
     """
-    # Keys of self.body dict.
-    __keys = ['instrument', 'direction', 'volume', 'open_time', 'open_price',
-              'close_time', 'close_price', 'realized_pnl']
-    __keys_open = ['instrument', 'direction', 'volume',
-                   'open_time', 'open_price']
-    __keys_close = ['close_time', 'close_price']
+    __slots__ = ('book', 'slot')
 
-    def __init__(self, order):
+    def __init__(self, order, book=None, position_id=-1):
         """
         Constructor.
         :param order: Order object; with order.direction either buy/short.
+        :param book: PositionBook object; where to store the position.
+            <Default>: None; a private one-row book.
+        :param position_id: int; stable id, kept by the closed rows.
+            <Default>: -1; no id.
         :return:
         """
         if self.__type_check(order):
-            values = order.export_to_position()
-            self.body = dict(zip(self.__keys_open, values))
-            self.status = PositionStatus.open
-            self.direction = self.body['direction']
+            self.book = book if book is not None else PositionBook(1)
+            self.slot = self.book.append(*order.export_to_position(),
+                                         position_id=position_id)
+
+    @classmethod
+    def at(cls, book, slot):
+        """
+        Reload constructor, view on an existing row.
+        :param book: PositionBook object.
+        :param slot: int; row index.
+        :return: Position object.
+        """
+        p = cls.__new__(cls)
+        p.book, p.slot = book, slot
+        return p
 
     @staticmethod
     def __type_check(order):
@@ -195,6 +511,60 @@ class Position:
             raise KernelPositionError(msg)
         return True
 
+    def __field(self, name):
+        return self.book.columns[name][self.slot]
+
+    @property
+    def id(self):
+        return int(self.__field('position_id'))
+
+    @property
+    def instrument(self):
+        return decode_instrument(self.__field('instrument'))
+
+    @property
+    def code(self):
+        return int(self.__field('instrument'))
+
+    @property
+    def direction(self):
+        return POS_CODES[self.__field('direction')]
+
+    @property
+    def volume(self):
+        return self.__field('volume')
+
+    @property
+    def open_price(self):
+        return self.__field('open_price')
+
+    @property
+    def status(self):
+        if self.__field('close_time') == NAT_NS:
+            return PositionStatus.open
+        return PositionStatus.closed
+
+    @property
+    def body(self):
+        """
+        :return: dict; position content, close fields only once closed.
+        """
+        body = {
+            'position_id': self.id,
+            'instrument': self.instrument,
+            'direction': self.direction,
+            'volume': self.volume,
+            'open_time': from_ns(self.__field('open_time')),
+            'open_price': self.open_price
+        }
+        if not self.__is_open():
+            body.update({
+                'close_time': from_ns(self.__field('close_time')),
+                'close_price': self.__field('close_price'),
+                'realized_pnl': self.__field('realized_pnl')
+            })
+        return body
+
     def __is_open(self):
         """
         Check status.
@@ -202,6 +572,17 @@ class Position:
         """
         return self.status == PositionStatus.open
 
+    def move_to(self, book):
+        """
+        Copy this position to the end of another book, release the old
+        row, and point this view at the new row.
+        :param book: PositionBook object.
+        :return:
+        """
+        slot = book.append_row(self.book, self.slot)
+        self.book.release(self.slot)
+        self.book, self.slot = book, slot
+
     def view(self, curr_price=None):
         """
         Print position with/without unrealized pnl.
@@ -221,13 +602,13 @@ class Position:
         """
         :return: double; position's opening value
         """
-        return self.body['open_price'] * self.body['volume']
+        return self.open_price * self.volume
 
     def close_value(self):
         """
         :return: double; position's closing value
         """
-        return self.body['close_price'] * self.body['volume']
+        return self.__field('close_price') * self.volume
 
     def holding_value(self, curr_price):
         """
@@ -237,7 +618,7 @@ class Position:
         """
         # Check status
         if self.__is_open():
-            return curr_price * self.body['volume']
+            return curr_price * self.volume
 
     def unrealized_pnl(self, curr_price):
         """
@@ -249,16 +630,9 @@ class Position:
         if not self.__is_open():
             return
         if self.direction == PositionType.long:
-            return self.body['volume'] * (curr_price - self.body['open_price'])
+            return self.volume * (curr_price - self.open_price)
         elif self.direction == PositionType.short:
-            return self.body['volume'] * (self.body['open_price'] - curr_price)
-
-    def __realized_pnl(self):
-        """
-        Calculate realized pnl.
-        :return: double; unrealized_pnl(self.body['close_price'])
-        """
-        return self.unrealized_pnl(self.body['close_price'])
+            return self.volume * (self.open_price - curr_price)
 
     def close(self, order):
         """
@@ -273,27 +647,136 @@ class Position:
                 assert order.direction == OrderType.fill
             elif self.direction == PositionType.long:
                 assert order.direction == OrderType.sell
-            # Update body.
-            values = order.export_time_price()  # [time, price]
-            self.body.update(dict(zip(self.__keys_close, values)))
+            close_time, close_price = order.export_time_price()
 
             # Realize PnL:
-            self.body['realized_pnl'] = self.__realized_pnl()
+            realized_pnl = self.unrealized_pnl(close_price)
 
             # Close position.
-            self.status = PositionStatus.closed
+            self.book.close(self.slot, close_time, close_price, realized_pnl)
             # Return realized PnL
-            return self.body['realized_pnl']
+            return realized_pnl
         except AssertionError:
             msg = '[KERNEL::Position]: Invalid order type ' \
                   'to close a position.'
             raise KernelPositionError(msg)
 
 
+# ----------------------------------------------------------------------
+# Record buffer.
+
+
+class RecordBuffer(object):
+    """
+    Preallocated columnar time series buffer.
+    Each recorded bar is one row written into numpy columns; reserve()
+    sizes the columns up front, append() doubles them if a run records
+    more rows than reserved.
+
+    <columns>
+        - bar: int64; index of the bar the row was recorded at.
+        - nav: float64.
+        - long_volume, long_value, short_volume, short_value: float64;
+          summed volumes and holding values of opening positions.
+
+    <privates>
+        - size: int; number of rows written.
+        - columns: dict; {field: np.ndarray} of length >= size.
+        - shares: list; [number of buffers sharing columns], see fork().
+    """
+    # Column layout.
+    dtypes = [('bar', np.int64), ('nav', np.float64),
+              ('long_volume', np.float64), ('long_value', np.float64),
+              ('short_volume', np.float64), ('short_value', np.float64)]
+    keys = [name for name, dtype in dtypes]
+
+    def __init__(self, capacity=0):
+        """
+        Constructor.
+        :param capacity: int; number of rows to preallocate.
+        :return:
+        """
+        self.size = 0
+        self.shares = [1]
+        self.columns = dict((name, np.empty(capacity, dtype))
+                            for name, dtype in self.dtypes)
+
+    def fork(self):
+        """
+        Copy-on-write copy, see PositionBook.fork().
+        :return: RecordBuffer object.
+        """
+        records = RecordBuffer.__new__(RecordBuffer)
+        records.size = self.size
+        records.columns, records.shares = self.columns, self.shares
+        self.shares[0] += 1
+        return records
+
+    def __own(self):
+        """
+        Copy shared columns before a write.
+        :return:
+        """
+        if self.shares[0] > 1:
+            self.shares[0] -= 1
+            self.shares = [1]
+            self.columns = dict((name, col.copy())
+                                for name, col in self.columns.iteritems())
+
+    def __len__(self):
+        return self.size
+
+    def reserve(self, capacity):
+        """
+        Make room for at least capacity rows in total.
+        :param capacity: int.
+        :return:
+        """
+        if capacity <= len(self.columns['bar']):
+            return
+        self.__own()
+        for name in self.keys:
+            old = self.columns[name]
+            new = np.empty(capacity, old.dtype)
+            new[:self.size] = old[:self.size]
+            self.columns[name] = new
+
+    def append(self, *values):
+        """
+        Write one row, values in the order of keys.
+        :return:
+        """
+        self.__own()
+        if self.size == len(self.columns['bar']):
+            self.reserve(max(64, 2 * self.size))
+        for name, value in zip(self.keys, values):
+            self.columns[name][self.size] = value
+        self.size += 1
+
+    def extend(self, **columns):
+        """
+        Write many rows at once.
+        :param columns: np.ndarray objects of equal length, one per key.
+        :return:
+        """
+        n = len(columns['bar'])
+        self.__own()
+        self.reserve(self.size + n)
+        for name in self.keys:
+            self.columns[name][self.size:self.size+n] = columns[name]
+        self.size += n
+
+    def column(self, name):
+        """
+        :param name: string; column name.
+        :return: np.ndarray; view on the rows written.
+        """
+        return self.columns[name][:self.size]
+
 # ----------------------------------------------------------------------
 # Account object.
 
-class Account:
+class Account(object):
     """
     Trading account object.
     Suppose the account base is US dollar, then:
@@ -313,24 +796,84 @@ class Account:
                 pnl-(HKD), margin_used(USD) <- volume*(EUR/USD)
                 (i.e. convert volume to USD)
 
-        <invokes>
-            - utils.map_to_holding_values(): return price*volume of Position,
-              unit is quote currency.
-            - utils.map_to_unrealized_pnl(): return realized pnl on a Position,
-              unit is quote currency.
+        <aggregates>
+            - Opening positions are summed per instrument when they are
+              opened/closed: [long volume, long open value (price*volume),
+              short volume, short open value], unit is quote currency.
+              The sums form one row per instrument code, so nav, margin
+              and position records are dot products with a price vector
+              indexed by instrument code, rather than O(positions).
+
+        <conversion>
+            - Quote currency amounts are converted to base by a vector of
+              quote currency rates indexed by instrument code, see
+              set_rates() and currency.ConversionMatrix. Volume * price *
+              quote rate is volume in base, so margin follows the notes
+              above. Without rates, quotes are taken as base currency.
 
         <privates>
             * init_cash: double; initial balance.
             * leverage: int; account leverage setting.
             * base: string; base currency of the account.
+            * opening: PositionBook object; rows of opening positions,
+              released on close.
+            * closed: PositionBook object; closed positions in the
+              order they were closed.
+            * records: RecordBuffer object; nav and position summaries.
+            * record_orders: list; executed Order objects.
+            * rejected_orders: list; resting orders that triggered but
+              did not execute, and unexecuted parts of netted orders.
+            * record_mode, record_every: recording policy, see __init__.
+            * close_policy: ClosePolicy(Enum) object; which lot a close
+              order without target closes first.
+            * longs, shorts: OrderedDict; {position id: Position object}
+              of opening positions, oldest first.
+            * lots: dict; {(instrument code, PositionType): OrderedDict}
+              per-instrument lots in the same order, so FIFO, LIFO and
+              targeted closes are O(1).
+            * netting: boolean; one net position per instrument, see
+              __init__.
+            * bracketed: set; ids of opening positions with stop loss or
+              take profit levels.
+            * margin_slack: double; smallest (nav - margin used - margin
+              required) of passed margin checks, inf if none.
+            * margin_shortfall: double; largest of the same over failed
+              margin checks, -inf if none. A run with a balance shifted
+              by x passes and fails the same checks while
+              margin_slack + x >= 0 > margin_shortfall + x.
     """
 
-    def __init__(self, init_cash, leverage, base):
+    def __init__(self, init_cash, leverage, base,
+                 record_mode=RecordMode.every, record_every=1,
+                 close_policy=ClosePolicy.lifo, netting=False):
         """
         Constructor.
         :param init_cash: double/int; initial cash.
         :param leverage: int; leverage.
         :param base: CurrencyType(Enum); base currency of this account.
+        :param record_mode: RecordMode(Enum) object; when record_ts()
+            writes a row.
+            <Values>:
+                - RecordMode.every: every bar.
+                - RecordMode.nth: every record_every-th bar.
+                - RecordMode.change: first bar, and bars where opening
+                  volumes differ from the last row written.
+            <Default>: RecordMode.every.
+        :param record_every: int; step of RecordMode.nth.
+            <Default>: 1.
+        :param close_policy: ClosePolicy(Enum) object; lot closed by a
+            sell/fill order without target_id.
+            <Values>:
+                - ClosePolicy.fifo: oldest lot first.
+                - ClosePolicy.lifo: latest lot first.
+            <Default>: ClosePolicy.lifo.
+        :param netting: boolean; netting mode, as OANDA accounts do.
+            Every instrument holds at most one position, long or short,
+            at volume weighted average price. Buy/short orders add to it,
+            or reduce the opposite one first (realizing pnl) and open
+            with the rest; sell/fill orders reduce it. Every reduction is
+            a closed position record, as in the default mode.
+            <Default>: False; one lot per opening order.
         :return:
         """
         if self.__type_check(init_cash, leverage, base):
@@ -338,11 +881,24 @@ class Account:
             self.__leverage = leverage
             self.__margin_rate = 1.0/leverage
             self.__base = base
+            self.record_mode = record_mode
+            self.record_every = max(1, record_every)
+            self.close_policy = close_policy
+            self.netting = netting
+            self.__bar = 0
 
             # History Containers
-            self.longs, self.shorts, self.closed = [], [], []
-            self.record_longs, self.record_shorts, self.record_nav = [], [], []
+            self.longs, self.shorts = OrderedDict(), OrderedDict()
+            self.__lots = dict()
+            self.__bracketed = set()
+            self.__next_id = 0
+            self.__opening, self.closed = PositionBook(), PositionBook()
+            self.__exposures = np.zeros((0, 4))
+            self.__rates = None
+            self.margin_slack, self.margin_shortfall = np.inf, -np.inf
+            self.records = RecordBuffer()
             self.record_orders = []
+            self.rejected_orders = []
 
     @staticmethod
     def __type_check(init_cash, leverage, base):
@@ -364,6 +920,54 @@ class Account:
         """
         return cls(1000000, 20, CurrencyType.USD)
 
+    def initial_balance(self):
+        """
+        :return: double; initial cash.
+        """
+        return self.__init_cash
+
+    def margin_rate(self):
+        """
+        :return: double; margin rate, 1 / leverage.
+        """
+        return self.__margin_rate
+
+    def base_currency(self):
+        """
+        :return: CurrencyType(Enum) object; base currency.
+        """
+        return self.__base
+
+    def set_rates(self, rates):
+        """
+        Set current quote currency rates, into base currency.
+        :param rates: np.ndarray; rates indexed by instrument code, e.g.
+            a row of currency.ConversionMatrix.quote_rates() scattered by
+            panel codes. None; quotes are in base currency.
+        :return:
+        """
+        self.__rates = rates
+
+    def __rate_of(self, code):
+        """
+        :param code: int; instrument code.
+        :return: double; quote currency rate of the instrument.
+        """
+        if self.__rates is None:
+            return 1.0
+        return float(self.__rates[code])
+
+    def __in_base(self, values):
+        """
+        Convert per-instrument quote currency amounts to base.
+        :param values: np.ndarray; indexed by instrument code.
+        :return: np.ndarray.
+        """
+        if self.__rates is None:
+            return values
+        # Nan rates of instruments not held count nothing.
+        return np.where(values != 0, values * self.__rates[:len(values)], 0.)
+
     def view(self, curr_prices=None):
         """
         View account.
@@ -375,8 +979,8 @@ class Account:
             'leverage': self.__leverage,
             'marginRate': self.__margin_rate,
             'balance': self.curr_balance,
-            'longPositions': [p.body for p in self.longs],
-            'shortPositions': [p.body for p in self.shorts],
+            'longPositions': [p.body for p in self.longs.itervalues()],
+            'shortPositions': [p.body for p in self.shorts.itervalues()],
             'closedPositions': [p.body for p in self.closed]
         }
         if curr_prices:
@@ -394,54 +998,442 @@ class Account:
         :return:
         """
         self.curr_balance = self.__init_cash
-        self.longs, self.shorts, self.closed = [], [], []
+        self.longs, self.shorts = OrderedDict(), OrderedDict()
+        self.__lots = dict()
+        self.__bracketed = set()
+        self.__next_id = 0
+        self.__opening, self.closed = PositionBook(), PositionBook()
+        self.__exposures = np.zeros((0, 4))
+        self.__rates = None
+        self.margin_slack, self.margin_shortfall = np.inf, -np.inf
         # Historical log
-        self.record_nav, self.record_orders = [], []
-        self.record_longs, self.record_shorts = [], []
+        self.__bar = 0
+        self.records = RecordBuffer()
+        self.record_orders = []
+        self.rejected_orders = []
+
+    def fork(self):
+        """
+        Branch the account at its current state, e.g. to run several
+        what-if continuations from one decision bar. Position books and
+        records are copy-on-write forks, so branching costs the opening
+        positions and per-instrument sums, not the history; executed
+        orders are shared objects in a new list.
+        :return: Account object.
+        """
+        account = copy.copy(self)
+        account.__opening = self.__opening.fork()
+        account.closed = self.closed.fork()
+        account.records = self.records.fork()
+        account.record_orders = list(self.record_orders)
+        account.rejected_orders = list(self.rejected_orders)
+        account.__exposures = self.__exposures.copy()
+        account.__bracketed = set(self.__bracketed)
+
+        # Views on the forked opening book, shared by sides and lots.
+        views = dict((i, Position.at(account.__opening, p.slot))
+                     for i, p in itertools.chain(self.longs.iteritems(),
+                                                 self.shorts.iteritems()))
+        account.longs = OrderedDict((i, views[i]) for i in self.longs)
+        account.shorts = OrderedDict((i, views[i]) for i in self.shorts)
+        account.__lots = dict(
+            (key, OrderedDict((i, views[i]) for i in lots))
+            for key, lots in self.__lots.iteritems())
+        return account
+
+    def reserve(self, n_bars):
+        """
+        Preallocate record columns for a run of n_bars bars.
+        :param n_bars: int.
+        :return:
+        """
+        if self.record_mode == RecordMode.every:
+            self.records.reserve(n_bars)
+        elif self.record_mode == RecordMode.nth:
+            self.records.reserve(n_bars // self.record_every + 1)
+
+    @property
+    def record_nav(self):
+        """
+        :return: np.ndarray; recorded nav, a view on the record column.
+        """
+        return self.records.column('nav')
+
+    def __prices(self, curr_prices):
+        """
+        Price vector over the rows of the exposure table.
+        :param curr_prices: dict; {instrument: current price} pairs.
+            Or np.ndarray; prices indexed by instrument code.
+        :return: np.ndarray.
+        """
+        n = len(self.__exposures)
+        if isinstance(curr_prices, np.ndarray):
+            return curr_prices[:n]
+        prices = np.zeros(n)
+        quoted = np.zeros(n, dtype=bool)
+        for instrument, price in curr_prices.iteritems():
+            code = encode_instrument(instrument)
+            if code < n:
+                prices[code], quoted[code] = price, True
+        held = self.__exposures[:, 0] + self.__exposures[:, 2] != 0
+        if (held & ~quoted).any():
+            missing = [decode_instrument(c)
+                       for c in np.flatnonzero(held & ~quoted)]
+            msg = '[KERNEL::Account]: No price for {}. '.format(missing)
+            raise KernelAccountError(msg)
+        return prices
+
+    def __row(self, code):
+        """
+        Exposure row of an instrument code, growing the table.
+        :param code: int; instrument code.
+        :return: np.ndarray; view on the row.
+        """
+        n = len(self.__exposures)
+        if code >= n:
+            exposures = np.zeros((code + 1, 4))
+            exposures[:n] = self.__exposures
+            self.__exposures = exposures
+        return self.__exposures[code]
+
+    def __book_open(self, position):
+        """
+        Add an opening position to per-instrument aggregates.
+        :param position: Position object.
+        :return:
+        """
+        exposure = self.__row(position.code)
+        side = 0 if position.direction == PositionType.long else 2
+        exposure[side] += position.volume
+        exposure[side+1] += position.open_value()
+
+    def __book_close(self, position):
+        """
+        Remove a closed position from per-instrument aggregates.
+        :param position: Position object.
+        :return:
+        """
+        exposure = self.__exposures[position.code]
+        side = 0 if position.direction == PositionType.long else 2
+        exposure[side] -= position.volume
+        exposure[side+1] -= position.open_value()
+        # Reset exactly, so no rounding residue is left on a flat side.
+        if not exposure[side]:
+            exposure[side], exposure[side+1] = 0, 0
+
+    def __exposure_of(self, instrument):
+        """
+        :param instrument: string; name of instrument.
+        :return: tuple; (long volume, long cost, short volume, short cost).
+        """
+        code = encode_instrument(instrument)
+        if code >= len(self.__exposures):
+            return 0, 0, 0, 0
+        return tuple(self.__exposures[code].tolist())
+
+    def volumes(self, instrument):
+        """
+        Long and short volume on one instrument.
+        :param instrument: string; name of instrument.
+        :return: tuple; (long_volume, short_volume).
+        """
+        exposure = self.__exposure_of(instrument)
+        return exposure[0], exposure[2]
+
+    def exposure(self, instrument):
+        """
+        Net volume and net open value on one instrument.
+        Its unrealized pnl is net_volume * price - net_cost.
+        :param instrument: string; name of instrument.
+        :return: tuple; (net_volume, net_cost).
+        """
+        long_volume, long_cost, short_volume, short_cost = \
+            self.__exposure_of(instrument)
+        return long_volume - short_volume, long_cost - short_cost
 
     def nav(self, curr_prices):
         """
         Calculate net asset value.
         :param curr_prices: dict; {instrument: current price} pairs.
+            Or np.ndarray; prices indexed by instrument code.
         :return: double; nav.
         """
-        # list of unrealized pnl:
-        unrealized_pnl = map_to_unrealized_pnl(
-            positions=(self.longs+self.shorts),
-            prices=curr_prices)
-        return self.curr_balance + sum(unrealized_pnl)
+        exposures = self.__exposures
+        prices = self.__prices(curr_prices)
+        unrealized_pnl = (exposures[:, 0] - exposures[:, 2]) * prices - \
+            (exposures[:, 1] - exposures[:, 3])
+        return self.curr_balance + float(self.__in_base(unrealized_pnl).sum())
 
     def margin_used(self, curr_prices):
         """
         Calculate margin used.
         :param curr_prices: dict; {instrument: current price} pairs.
+            Or np.ndarray; prices indexed by instrument code.
         :return: double; margin used.
         """
-        holding_values = map_to_holding_values(
-            self.longs+self.shorts, curr_prices)
-        return sum(holding_values) * self.__margin_rate
+        exposures = self.__exposures
+        holding_value = (exposures[:, 0] + exposures[:, 2]) * \
+            self.__prices(curr_prices)
+        return float(self.__in_base(holding_value).sum()) * self.__margin_rate
 
     def margin_available(self, curr_prices):
         """
         Calculate margin available.
         :param curr_prices: dict; {instrument: current price} pairs.
+            Or np.ndarray; prices indexed by instrument code.
         :return: double; margin available.
         """
         return max(0, (self.nav(curr_prices)-self.margin_used(curr_prices)))
 
-    def __to_sell(self):
+    def position(self, position_id):
         """
-        Pop a long position.
-        :return: Position object; or None, if self.longs is [].
+        :param position_id: int; id of an opening position.
+        :return: Position object; or None, if not opening.
         """
-        return self.longs.pop() if self.longs else None
+        return self.longs.get(position_id) or self.shorts.get(position_id)
 
-    def __to_fill(self):
+    def __open_lot(self, order):
         """
-        Pop a short position.
-        :return: Position object; or None, if self.shorts is [].
+        Open a position with a new id.
+        :param order: Order object (buy/short).
+        :return:
+        """
+        p = Position(order, self.__opening, self.__next_id)
+        self.__next_id += 1
+        side = self.longs if p.direction == PositionType.long \
+            else self.shorts
+        side[p.id] = p
+        key = (p.code, p.direction)
+        if key not in self.__lots:
+            self.__lots[key] = OrderedDict()
+        self.__lots[key][p.id] = p
+        self.__book_open(p)
+        stop_loss = order.body.get('stop_loss')
+        take_profit = order.body.get('take_profit')
+        if stop_loss is not None or take_profit is not None:
+            self.set_bracket(p.id, stop_loss, take_profit)
+
+    def set_bracket(self, position_id, stop_loss=None, take_profit=None):
+        """
+        Set stop loss/take profit levels of an opening position.
+        :param position_id: int.
+        :param stop_loss: double; <Default>: None; no level.
+        :param take_profit: double; <Default>: None; no level.
+        :return:
+        """
+        p = self.position(position_id)
+        if p is None:
+            msg = '[KERNEL::Account]: No opening position {}. '.format(
+                position_id)
+            raise KernelAccountError(msg)
+        p.book.set_bracket(p.slot, stop_loss, take_profit)
+        if stop_loss is None and take_profit is None:
+            self.__bracketed.discard(position_id)
+        else:
+            self.__bracketed.add(position_id)
+
+    @property
+    def bracketed(self):
+        """
+        :return: boolean; True if any opening position has brackets.
+        """
+        return bool(self.__bracketed)
+
+    def __by_code(self, values):
+        """
+        :param values: dict; {instrument: value} pairs.
+            Or np.ndarray; values indexed by instrument code.
+        :return: np.ndarray; indexed by instrument code, nan if missing.
+        """
+        if isinstance(values, np.ndarray):
+            return values
+        vector = np.empty(len(self.__exposures))
+        vector.fill(np.nan)
+        for instrument, value in values.iteritems():
+            code = encode_instrument(instrument)
+            if code < len(vector) and value is not None:
+                vector[code] = value
+        return vector
+
+    def check_brackets(self, time, low, high, open_price=None,
+                       ask_low=None, ask_high=None, ask_open=None):
+        """
+        Close opening positions whose stop loss or take profit level lies
+        inside a bar's range, checking all positions at once.
+        Longs exit on the bid side, shorts on the ask side when ask
+        ranges are given. A bar that reaches both levels of a position
+        is taken as a stop loss. Fills are at the level, or at the open
+        if the bar opened beyond it.
+        :param time: datetime.datetime object; bar time.
+        :param low, high: dict/np.ndarray; bar low/high (bid, if asks are
+            given) per instrument, see __by_code().
+        :param open_price: dict/np.ndarray; bar open.
+            <Default>: None; fill at levels.
+        :param ask_low, ask_high: dict/np.ndarray; ask side low/high.
+            <Default>: None; shorts use low/high.
+        :param ask_open: dict/np.ndarray; ask side open, for shorts.
+            <Default>: None; shorts use open_price.
+        :return: list; executed close Order objects.
+        """
+        if not self.__bracketed:
+            return []
+        book = self.__opening
+        c, n = book.columns, book.size
+        codes = c['instrument'][:n]
+        stop, target = c['stop_loss'][:n], c['take_profit'][:n]
+        is_long = c['direction'][:n] == POS_CODE_MAPPING[PositionType.long]
+        low, high = self.__by_code(low)[codes], self.__by_code(high)[codes]
+        if ask_low is not None:
+            low = np.where(is_long, low, self.__by_code(ask_low)[codes])
+            high = np.where(is_long, high, self.__by_code(ask_high)[codes])
+        with np.errstate(invalid='ignore'):
+            hit_stop = np.where(is_long, low <= stop, high >= stop)
+            hit_target = np.where(is_long, high >= target, low <= target)
+        opens = None
+        if open_price is not None:
+            opens = self.__by_code(open_price)[codes]
+            if ask_open is not None:
+                opens = np.where(is_long, opens,
+                                 self.__by_code(ask_open)[codes])
+
+        orders = []
+        for slot in np.flatnonzero(hit_stop | hit_target).tolist():
+            price = stop[slot] if hit_stop[slot] else target[slot]
+            # Below the level is worse for a long stop, better for a
+            # long target; the reverse for shorts.
+            falls = is_long[slot] == bool(hit_stop[slot])
+            if opens is not None and (opens[slot] < price if falls
+                                      else opens[slot] > price):
+                price = opens[slot]
+            direction = OrderType.sell if is_long[slot] else OrderType.fill
+            order = Order.close_partial(
+                decode_instrument(codes[slot]), direction, time, float(price),
+                None, int(c['position_id'][slot]))
+            if self.__close_lots(order):
+                orders.append(order)
+        return orders
+
+    def __close_lot(self, lots, p, order, volume=None):
+        """
+        Close a lot, or split volume off it and close that part.
+        The closed part moves to self.closed, keeping the lot's id.
+        :param lots: OrderedDict; lots of p's instrument and side.
+        :param p: Position object.
+        :param order: Order object (sell/fill).
+        :param volume: int/double; <Default>: None; the whole lot.
+        :return: double; volume closed.
+        """
+        if volume is not None and volume < p.volume:
+            p = Position.at(p.book, p.book.split(p.slot, volume))
+        else:
+            del lots[p.id]
+            side = self.longs if p.direction == PositionType.long \
+                else self.shorts
+            del side[p.id]
+            self.__bracketed.discard(p.id)
+        realized_pnl = p.close(order)
+        p.move_to(self.closed)
+        self.__book_close(p)
+        # Update current balance.
+        self.curr_balance += realized_pnl * self.__rate_of(p.code)
+        return p.volume
+
+    def __net(self, order, curr_prices):
+        """
+        Netting mode: handle a buy/short order.
+        If the opposite side is reduced but the remainder fails margin,
+        order volume is cut to the reduced units and the remainder is
+        recorded in rejected_orders.
+        :param order: Order object (buy/short).
+        :param curr_prices: dict/np.ndarray; see nav().
+        :return: TradingExecuteFlag(Enum[2]) object.
         """
-        return self.shorts.pop() if self.shorts else None
+        instrument, time, price, volume = [
+            order.body[k] for k in ['instrument', 'time', 'price', 'volume']]
+        code = encode_instrument(instrument)
+        side = ORD_POS_MAPPING[order.direction]
+        executed = False
+
+        # Reduce the opposite position first.
+        if side == PositionType.long:
+            other, close_direction = PositionType.short, OrderType.fill
+        else:
+            other, close_direction = PositionType.long, OrderType.sell
+        lots = self.__lots.get((code, other))
+        if lots:
+            close = Order(instrument, close_direction, time, price, volume)
+            volume -= self.__close_lot(lots, lots[next(iter(lots))], close,
+                                       volume)
+            executed = True
+
+        # Open, or add to, this side with the rest.
+        if volume > 0:
+            rest = Order(instrument, order.direction, time, price, volume)
+            if self.__check_margin(rest, curr_prices):
+                lots = self.__lots.get((code, side))
+                if lots:
+                    p = lots[next(iter(lots))]
+                    p.book.merge(p.slot, volume, price)
+                    if order.body.get('stop_loss') is not None or \
+                            order.body.get('take_profit') is not None:
+                        self.set_bracket(p.id, order.body.get('stop_loss'),
+                                         order.body.get('take_profit'))
+                    exposure = self.__row(code)
+                    k = 0 if side == PositionType.long else 2
+                    exposure[k] += volume
+                    exposure[k+1] += volume * price
+                else:
+                    self.__open_lot(rest)
+                executed = True
+            elif executed:
+                # Reduced but could not open the rest: the order
+                # records only the reduced units, the rest is rejected.
+                order.body['volume'] -= volume
+                self.record_rejected_order(rest)
+
+        if executed:
+            return TradingExecuteFlag.good
+        return TradingExecuteFlag.bad
+
+    def __close_lots(self, order):
+        """
+        Close lots for a sell/fill order.
+            - target_id set: that lot, or volume of it.
+            - volume set: that much volume, lot by lot in close_policy
+              order, the last lot split if needed.
+            - neither: one whole lot, by close_policy.
+        :param order: Order object (sell/fill).
+        :return: boolean; True if anything was closed.
+        """
+        direction = PositionType.long if order.direction == OrderType.sell \
+            else PositionType.short
+        lots = self.__lots.get(
+            (encode_instrument(order.body['instrument']), direction))
+        if not lots:
+            return False
+        target, volume = order.body['target'], order.body['volume']
+        if target is not None:
+            if target not in lots:
+                return False
+            self.__close_lot(lots, lots[target], order, volume)
+            return True
+        latest = self.close_policy == ClosePolicy.lifo
+        if volume is None:
+            self.__close_lot(lots, lots[self.__first(lots, latest)], order)
+            return True
+        closed = False
+        while lots and volume > 0:
+            p = lots[self.__first(lots, latest)]
+            volume -= self.__close_lot(lots, p, order, volume)
+            closed = True
+        return closed
+
+    @staticmethod
+    def __first(lots, latest):
+        """
+        :return: int; id of the latest, or oldest, lot.
+        """
+        return next(reversed(lots)) if latest else next(iter(lots))
 
     def __check_margin(self, order, curr_prices):
         """
@@ -450,8 +1442,18 @@ class Account:
         :param curr_prices: dict; {instrument: current price} pairs.
         :return: boolean; enough margin or not.
         """
-        return (self.margin_available(curr_prices) >=
-                order.cash_flow())
+        code = encode_instrument(order.body['instrument'])
+        required = order.cash_flow() * self.__rate_of(code)
+        if np.isnan(required):
+            # No rate into base yet.
+            return False
+        # nav and margin used once each, margin_available() inlined.
+        free = self.nav(curr_prices) - self.margin_used(curr_prices)
+        if max(0, free) >= required:
+            self.margin_slack = min(self.margin_slack, free - required)
+            return True
+        self.margin_shortfall = max(self.margin_shortfall, free - required)
+        return False
 
     def handle_mkt_order(self, order, curr_prices=-1):
         """
@@ -466,46 +1468,27 @@ class Account:
         if order.direction == OrderType.none:   # If NONE order:
             return TradingExecuteFlag.bad
         # Account has single instrument.
-        if curr_prices == -1:
+        if not isinstance(curr_prices, (dict, np.ndarray)):
             curr_prices = order.export_price_dict()
         # Buy/Short, prepare to open position.
         if order.direction in [OrderType.buy, OrderType.short]:
+            if self.netting:
+                return self.__net(order, curr_prices)
             # Check margin.
             if self.__check_margin(order, curr_prices):
-                if order.direction == OrderType.short:
-                    self.shorts.append(Position(order))
-                elif order.direction == OrderType.buy:
-                    self.longs.append(Position(order))
+                self.__open_lot(order)
                 return TradingExecuteFlag.good
             else:
                 # Fail margin check.
                 return TradingExecuteFlag.bad
         # Sell/Fill, prepare to close position.
         else:
-            if order.direction == OrderType.fill:
-                p = self.__to_fill()
-            elif order.direction == OrderType.sell:
-                p = self.__to_sell()
-            else:
-                p = None
-            if p:
-                this_realized_pnl = p.close(order)
-                self.closed.append(p)
-                # Update current balance.
-                self.curr_balance += this_realized_pnl
+            if order.direction in [OrderType.sell, OrderType.fill] and \
+                    self.__close_lots(order):
                 return TradingExecuteFlag.good
             else:
                 return TradingExecuteFlag.bad
 
-    def record_nav_ts(self, curr_prices):
-        """
-        Write current to record_nav timeseries.
-        :param curr_prices: dict; {instrument: current price} pairs.
-        :return:
-        """
-        # there won't be empty record.
-        self.record_nav.append(self.nav(curr_prices))
-
     def record_executed_order(self, order):
         """
 
@@ -514,40 +1497,71 @@ class Account:
         """
         self.record_orders.append(order)
 
-    def record_position_ts(self, curr_prices):
+    def record_rejected_order(self, order):
+        """
+        :param order: Order object; not executed.
+        :return:
+        """
+        self.rejected_orders.append(order)
+
+    def record_ts(self, curr_prices):
         """
-        Write current volumes, holding values
-        to record_longs/shorts timeseries.
+        Write current nav, volumes and holding values to records,
+        following record_mode.
         :param curr_prices: dict; {instrument: current price} pairs.
+            Or np.ndarray; prices indexed by instrument code.
         :return:
         """
-        # Initialize as empty.
-        long_record_one_row = {
-            'instrument': None,
-            'direction': PositionType.long,
-            'volume': 0,
-            'value': 0
-        }
-        short_record_one_row = {
-            'instrument': None,
-            'direction': PositionType.short,
-            'volume': 0,
-            'value': 0
-        }
-        # If opening positions list is non-empty:
-        if self.longs:
-            long_record_one_row['volume'] = sum(
-                [p.body['volume'] for p in self.longs])
-            long_record_one_row['value'] = sum(
-                map_to_holding_values(self.longs, curr_prices))
-        if self.shorts:
-            short_record_one_row['volume'] = sum(
-                [p.body['volume'] for p in self.shorts])
-            short_record_one_row['value'] = sum(
-                map_to_holding_values(self.shorts, curr_prices))
-        # Write to main list.
-        self.record_longs.append(long_record_one_row)
-        self.record_shorts.append(short_record_one_row)
+        bar = self.__bar
+        self.__bar += 1
+        if self.record_mode == RecordMode.nth and bar % self.record_every:
+            return
+        # Sum per-instrument aggregates of opening positions.
+        exposures = self.__exposures
+        prices = self.__in_base(self.__prices(curr_prices))
+        long_volume = float(exposures[:, 0].sum())
+        short_volume = float(exposures[:, 2].sum())
+        long_value = float(np.dot(exposures[:, 0], prices))
+        short_value = float(np.dot(exposures[:, 2], prices))
+        if self.record_mode == RecordMode.change and self.records.size:
+            n = self.records.size - 1
+            if (long_volume == self.records.columns['long_volume'][n] and
+                    short_volume == self.records.columns['short_volume'][n]):
+                return
+        self.records.append(bar, self.nav(curr_prices), long_volume,
+                            long_value, short_volume, short_value)
+
+    def record_columns(self, nav, long_volume, long_value, short_volume,
+                       short_value):
+        """
+        Write whole per-bar series to records at once, following
+        record_mode. Used by columnar kernels.
+        :param nav, long_volume, long_value, short_volume, short_value:
+            np.ndarray objects; one value per bar.
+        :return:
+        """
+        n = len(nav)
+        bar = np.arange(self.__bar, self.__bar + n)
+        if self.record_mode == RecordMode.every:
+            mask = slice(None)
+        elif self.record_mode == RecordMode.nth:
+            mask = bar % self.record_every == 0
+        else:
+            mask = np.ones(n, dtype=bool)
+            mask[1:] = ((long_volume[1:] != long_volume[:-1]) |
+                        (short_volume[1:] != short_volume[:-1]))
+            if self.records.size:
+                last = self.records.size - 1
+                mask[0] = (
+                    long_volume[0] != self.records.columns['long_volume'][last]
+                    or short_volume[0] !=
+                    self.records.columns['short_volume'][last])
+        self.__bar += n
+        self.records.extend(bar=bar[mask], nav=nav[mask],
+                            long_volume=long_volume[mask],
+                            long_value=long_value[mask],
+                            short_volume=short_volume[mask],
+                            short_value=short_value[mask])
 
     def export_executed_orders(self):
         """
@@ -559,25 +1573,359 @@ class Account:
 
     def export_positions(self):
         """
-        Export a frame of all Position objects.
+        Export a frame of all closed positions, wrapping the columns
+        of the closed PositionBook.
         :return: pd.Dataframe object.
         """
-        all_closed_positions = [p.body for p in self.closed]
-        return pd.DataFrame(all_closed_positions)
+        return self.closed.to_frame()
+
+    def export_nav_ts(self):
+        """
+        Export recorded nav, indexed by bar.
+        :return: pd.Series object.
+        """
+        return pd.Series(self.records.column('nav'),
+                         index=self.records.column('bar'), name='nav')
+
+    def __export_side_ts(self, direction, side):
+        """
+        Wrap record columns of one side in a frame, indexed by bar.
+        :param direction: PositionType(Enum) object.
+        :param side: string; 'long' or 'short'.
+        :return: pd.Dataframe object.
+        """
+        return pd.DataFrame({
+            'instrument': None,
+            'direction': direction,
+            'volume': self.records.column(side + '_volume'),
+            'value': self.records.column(side + '_value')
+        }, index=self.records.column('bar'),
+            columns=['instrument', 'direction', 'volume', 'value'])
 
     def export_long_position_ts(self):
         """
         Export time series of long position summaries.
         :return: pd.Dataframe object.
         """
-        return pd.DataFrame(self.record_longs)
+        return self.__export_side_ts(PositionType.long, 'long')
 
     def export_short_position_ts(self):
         """
         Export time series of short position summaries.
         :return: pd.Dataframe object.
         """
-        return pd.DataFrame(self.record_shorts)
+        return self.__export_side_ts(PositionType.short, 'short')
+
+# ----------------------------------------------------------------------
+# Pending order book.
+
+
+class OrderBook(object):
+    """
+    Resting orders (limit buy/sell, take profit, stop loss), indexed by
+    trigger price. Order.price is the trigger.
+
+    Every instrument has two heaps:
+        - falling: orders that fire when price falls to the trigger;
+          limit buy, stop loss of a long, take profit of a short.
+          Max-heap on trigger.
+        - rising: orders that fire when price rises to the trigger;
+          limit sell, take profit of a long, stop loss of a short.
+          Min-heap on trigger.
+    match() only pops orders whose trigger lies inside the bar's
+    [low, high] range, so a bar costs O(fired * log(orders)), however
+    many orders rest. Cancelled orders are dropped when they reach the
+    top of their heap.
+
+    A triggered order becomes a market order: limit buy -> buy,
+    limit sell -> short, with the stop loss/take profit levels of
+    Order.limit(), if any. Take profit/stop loss orders guard one
+    opening position (Order.exit(), target_id): they become a sell
+    for a long, a fill for a short, of that position only, and once
+    one fires, the other orders guarding the position are cancelled
+    (one cancels other).
+
+    <privates>
+        - orders: dict; {order id: (Order object, market OrderType)}.
+        - heaps: dict; {instrument: (falling heap, rising heap)}, heap
+          entries are (key, order id) tuples.
+        - guards: dict; {position id: [order ids]} of resting take
+          profit/stop loss orders.
+        - next_id: int; id of the next placed order.
+    """
+
+    def __init__(self):
+        """
+        Constructor.
+        :return:
+        """
+        self.orders = dict()
+        self.heaps = dict()
+        self.guards = dict()
+        self.next_id = 0
+
+    def __len__(self):
+        return len(self.orders)
+
+    def fork(self):
+        """
+        :return: OrderBook object; a copy, resting Order objects are
+            shared.
+        """
+        book = OrderBook()
+        book.orders = dict(self.orders)
+        book.heaps = dict((i, (list(falling), list(rising)))
+                          for i, (falling, rising) in self.heaps.iteritems())
+        book.guards = dict((i, list(ids))
+                           for i, ids in self.guards.iteritems())
+        book.next_id = self.next_id
+        return book
+
+    def instruments(self):
+        """
+        :return: list; instruments with resting orders.
+        """
+        return [i for i, (falling, rising) in self.heaps.iteritems()
+                if falling or rising]
+
+    def place(self, order, guarded=None):
+        """
+        Rest an order until price reaches its trigger.
+        :param order: Order object; direction in PENDING_ORDER_TYPES,
+            price is the trigger.
+        :param guarded: PositionType(Enum) object; direction of the
+            position a take profit/stop loss order guards.
+        :return: int; order id, for cancel().
+        """
+        if order.direction not in PENDING_ORDER_TYPES:
+            msg = '[KERNEL::OrderBook]: {} does not rest in a book. '.format(
+                order.direction)
+            raise KernelOrderError(msg)
+        trigger = order.body['price']
+        if order.direction == OrderType.limit_buy:
+            falls, direction = True, OrderType.buy
+        elif order.direction == OrderType.limit_sell:
+            falls, direction = False, OrderType.short
+        else:
+            if order.body['target'] is None or guarded is None:
+                msg = '[KERNEL::OrderBook]: {} needs the id of an opening ' \
+                      'position. '.format(order.direction)
+                raise KernelOrderError(msg)
+            is_short = guarded == PositionType.short
+            # Stop loss of a long, or take profit of a short, falls.
+            falls = is_short == (order.direction == OrderType.take_profit)
+            direction = OrderType.fill if is_short else OrderType.sell
+
+        order_id = self.next_id
+        self.next_id += 1
+        self.orders[order_id] = (order, direction)
+        if order.body['target'] is not None:
+            self.guards.setdefault(order.body['target'], []).append(order_id)
+        if order.instrument not in self.heaps:
+            self.heaps[order.instrument] = ([], [])
+        falling, rising = self.heaps[order.instrument]
+        if falls:
+            heapq.heappush(falling, (-trigger, order_id))
+        else:
+            heapq.heappush(rising, (trigger, order_id))
+        return order_id
+
+    def cancel(self, order_id):
+        """
+        :param order_id: int; from place().
+        :return: boolean; True if the order was still resting.
+        """
+        return self.orders.pop(order_id, None) is not None
+
+    def match(self, instrument, time, low, high, open_price=None):
+        """
+        Pop orders triggered inside one bar, as market orders.
+        Falling triggers fire from the highest down, then rising triggers
+        from the lowest up. Fills are at the trigger, or at open_price if
+        the bar opened beyond it.
+        :param instrument: string; name of instrument.
+        :param time: datetime.datetime object; bar time.
+        :param low: double; bar low.
+        :param high: double; bar high.
+        :param open_price: double; bar open.
+            <Default>: None; fill at triggers.
+        :return: list; Order objects, in firing order.
+        """
+        if instrument not in self.heaps:
+            return []
+        falling, rising = self.heaps[instrument]
+        fired = []
+        while falling and -falling[0][0] >= low:
+            key, order_id = heapq.heappop(falling)
+            price = -key
+            if open_price is not None and open_price < price:
+                price = open_price
+            fired.append((order_id, price))
+        while rising and rising[0][0] <= high:
+            price, order_id = heapq.heappop(rising)
+            if open_price is not None and open_price > price:
+                price = open_price
+            fired.append((order_id, price))
+
+        orders = []
+        for order_id, price in fired:
+            if order_id not in self.orders:  # cancelled.
+                continue
+            order, direction = self.orders.pop(order_id)
+            target = order.body['target']
+            # One cancels other.
+            for other in self.guards.pop(target, []):
+                self.orders.pop(other, None)
+            market = Order(instrument=instrument,
+                           direction=direction,
+                           time=time,
+                           price=price,
+                           volume=order.body['volume'],
+                           target_id=target)
+            for key in ['stop_loss', 'take_profit']:
+                if order.body.get(key) is not None:
+                    market.body[key] = order.body[key]
+            orders.append(market)
+        return orders
+
+# ----------------------------------------------------------------------
+# Running metrics and stop rules.
+
+
+class RunningMetrics(object):
+    """
+    Online risk metrics of a run, updated once per bar in O(1).
+
+    <privates>
+        - bars: int; bars processed.
+        - nav: double; current nav.
+        - peak_nav: double; highest nav so far.
+        - drawdown: double; current fall from peak_nav, fraction of peak.
+        - max_drawdown: double; largest drawdown so far.
+        - trades: int; executed orders so far.
+        - sharpe: double; mean / std of bar returns over the last
+          window bars, times sqrt(periods). nan until window is full.
+    """
+
+    def __init__(self, window=500, periods=1):
+        """
+        Constructor.
+        :param window: int; bars in the rolling sharpe window.
+        :param periods: int; bars per year, to annualize sharpe.
+            <Default>: 1; per-bar sharpe.
+        :return:
+        """
+        self.window = window
+        self.periods = periods
+        self.bars, self.trades = 0, 0
+        self.nav = self.peak_nav = np.nan
+        self.drawdown, self.max_drawdown = 0.0, 0.0
+        self.sharpe = np.nan
+        self.__mean = SMA(window)
+        self.__std = RollingStd(window)
+
+    def update(self, nav, trades=0):
+        """
+        Take the nav of one more bar.
+        :param nav: double.
+        :param trades: int; orders executed on this bar.
+        :return:
+        """
+        if self.bars:
+            ret = nav / self.nav - 1
+            mean, std = self.__mean.update(ret), self.__std.update(ret)
+            if self.__std.ready and std > 0:
+                self.sharpe = mean / std * np.sqrt(self.periods)
+        if not nav <= self.peak_nav:
+            self.peak_nav = nav
+        self.drawdown = 1 - nav / self.peak_nav
+        self.max_drawdown = max(self.max_drawdown, self.drawdown)
+        self.nav = nav
+        self.trades += trades
+        self.bars += 1
+
+    def extend(self, nav, trades=0):
+        """
+        Take the navs of many bars at once; same final state as
+        calling update() on each.
+        :param nav: np.ndarray.
+        :param trades: int; orders executed over these bars.
+        :return:
+        """
+        if not len(nav):
+            return
+        head = nav[:-(self.window + 1)]
+        if len(head):
+            peak = np.maximum.accumulate(
+                np.concatenate([[self.peak_nav], head])
+                if self.bars else head)
+            self.max_drawdown = max(self.max_drawdown,
+                                    np.max(1 - head / peak[-len(head):]))
+            self.peak_nav, self.nav = peak[-1], head[-1]
+            self.bars += len(head)
+        for value in nav[len(head):].tolist():
+            self.update(value)
+        self.trades += trades
+
+    def view(self):
+        """
+        Print metrics.
+        :return:
+        """
+        print json.dumps(serialize_dict(self.export()),
+                         indent=4, sort_keys=True)
+
+    def export(self):
+        """
+        :return: dict; current metrics.
+        """
+        return {
+            'bars': self.bars,
+            'nav': self.nav,
+            'peak_nav': self.peak_nav,
+            'drawdown': self.drawdown,
+            'max_drawdown': self.max_drawdown,
+            'trades': self.trades,
+            'sharpe': self.sharpe
+        }
+
+
+class StopRule(object):
+    """
+    Stop-rule hook. The kernel calls the rule with its RunningMetrics
+    after every bar; a True return ends the run early and marks it as
+    pruned. Any callable works; these classes also pickle into sweep
+    workers.
+    """
+
+    def __call__(self, metrics):
+        return False
+
+
+class MaxDrawdownStop(StopRule):
+    """
+    Abort once drawdown exceeds limit, e.g. 0.2 for 20%.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+
+    def __call__(self, metrics):
+        return metrics.drawdown > self.limit
+
+
+class MinSharpeStop(StopRule):
+    """
+    Abort once rolling sharpe falls below threshold, after min_bars.
+    """
+
+    def __init__(self, threshold, min_bars):
+        self.threshold = threshold
+        self.min_bars = min_bars
+
+    def __call__(self, metrics):
+        return metrics.bars >= self.min_bars and \
+            metrics.sharpe < self.threshold
 
 # ----------------------------------------------------------------------
 # Backtest Kernel
@@ -592,12 +1940,19 @@ class Kernel:
         """
 
         :param data: pd.Dataframe object; bar data.
+            Or dataset.BarDataset object; bar data in shared memory.
+            Or dataset.BarPanel object; aligned bars of many
+            instruments, for run_portfolio().
         :param account: Account object;
         :return:
         """
         if self.__type_check(account):
             self.data = data
             self.account = account
+            self.metrics = RunningMetrics()
+            self.book = OrderBook()
+            self.pruned = False
+            self.cursor = 0
 
     @staticmethod
     def __type_check(account):
@@ -624,6 +1979,41 @@ class Kernel:
         :return:
         """
         self.account.clear_all()
+        self.metrics = RunningMetrics()
+        self.book = OrderBook()
+        self.pruned = False
+        self.cursor = 0
+
+    def fork(self, strategy):
+        """
+        Branch a paused run_naive() at its current bar. The branch has
+        its own account (a copy-on-write Account.fork()), order book,
+        metrics and strategy, so resume() on it leaves this kernel as
+        it was; the bars before are not replayed.
+
+        <example>
+            kernel.run_naive(strategy, stop=k)
+            branches = [kernel.fork(strategy) for _ in variants]
+            for (branch, s), variant in zip(branches, variants):
+                variant(s)
+                branch.resume(s)
+
+        :param strategy: Strategy object; the one being run.
+        :return: tuple; (Kernel object, deep copy of strategy).
+        """
+        kernel = Kernel(self.data, self.account.fork())
+        kernel.metrics = copy.deepcopy(self.metrics)
+        kernel.book = self.book.fork()
+        kernel.pruned, kernel.cursor = self.pruned, self.cursor
+        return kernel, copy.deepcopy(strategy)
+
+    def __rows(self, start, stop):
+        """
+        :return: generator; (index, bar) of bars in [start, stop).
+        """
+        if isinstance(self.data, pd.DataFrame):
+            return self.data.iloc[start:stop].iterrows()
+        return self.data.iterrows(start, stop)
 
     def log(self, curr_prices, order):
         """
@@ -632,45 +2022,566 @@ class Kernel:
         :param order:
         :return:
         """
-        self.account.record_nav_ts(curr_prices)
-        self.account.record_position_ts(curr_prices)
+        self.account.record_ts(curr_prices)
+
+    def __submit(self, order, curr_prices):
+        """
+        Rest a pending order in the book, or execute a market order.
+        :param order: Order object.
+        :param curr_prices: dict/np.ndarray; see Account.nav().
+        :return: int; 1 if a trade was executed, else 0.
+        """
+        if order.direction in PENDING_ORDER_TYPES:
+            guarded = None
+            if order.body['target'] is not None:
+                p = self.account.position(order.body['target'])
+                guarded = None if p is None else p.direction
+            self.book.place(order, guarded)
+            return 0
+        trading_executed_flag = self.account.handle_mkt_order(
+            order, curr_prices)
+        # Only record executed orders.
+        if trading_executed_flag == TradingExecuteFlag.good:
+            self.account.record_executed_order(order)
+            return 1
+        return 0
+
+    def __match(self, instrument, time, low, high, open_price, curr_prices):
+        """
+        Execute resting orders of an instrument triggered within a bar;
+        those that do not execute (margin, or the guarded position is
+        gone) go to Account.rejected_orders.
+        :return: int; number of trades executed.
+        """
+        executed = 0
+        for order in self.book.match(instrument, time, low, high,
+                                     open_price):
+            if self.__submit(order, curr_prices):
+                executed += 1
+            else:
+                self.account.record_rejected_order(order)
+        return executed
 
+    def __check_brackets(self, time, ranges):
+        """
+        Close bracketed positions reached within a bar, record orders.
+        :param time: datetime.datetime object; bar time.
+        :param ranges: dict; keyword arguments of
+            Account.check_brackets(), see __bar_ranges().
+        :return: int; number of trades executed.
+        """
+        orders = self.account.check_brackets(time, **ranges)
+        for order in orders:
+            self.account.record_executed_order(order)
+        return len(orders)
 
-    def run_naive(self, strategy):
+    @staticmethod
+    def __bar_ranges(get, close):
+        """
+        Bar range arguments of Account.check_brackets(), bid/ask sides
+        if the bars have them, else mid, else close.
+        :param get: function; get(column name) -> values or None.
+        :param close: close values, used when there is no high/low.
+        :return: dict.
+        """
+        if get(BarColNames.low_bid.value) is not None and \
+                get(BarColNames.low_ask.value) is not None:
+            ranges = {'low': get(BarColNames.low_bid.value),
+                      'high': get(BarColNames.high_bid.value),
+                      'ask_low': get(BarColNames.low_ask.value),
+                      'ask_high': get(BarColNames.high_ask.value),
+                      'open_price': get(BarColNames.open_bid.value),
+                      'ask_open': get(BarColNames.open_ask.value)}
+            # Gaps need both open sides, else fill at levels.
+            if ranges['open_price'] is None or ranges['ask_open'] is None:
+                ranges['open_price'] = ranges['ask_open'] = None
+            return ranges
+        low, high = get(BarColNames.low.value), get(BarColNames.high.value)
+        return {'low': close if low is None else low,
+                'high': close if high is None else high,
+                'open_price': get(BarColNames.open.value)}
+
+    def run_naive(self, strategy, stop_rule=None, stop=None):
         """
         Run backtest on strategy for <single instrument>.
+        on_bar(bar) returns a (OrderType, volume) tuple, or a list of
+        Order objects; those of PENDING_ORDER_TYPES rest in self.book and
+        are matched against the high/low of later bars. Positions opened
+        by Order.bracket() close as soon as a bar's high/low (bid/ask if
+        present) reaches their levels.
         :param strategy: Strategy object.
-        :return:
+        :param stop_rule: callable; StopRule object or f(metrics),
+            True ends the run early and sets self.pruned.
+            <Default>: None; run all bars.
+        :param stop: int; bar to pause before, see resume() and fork().
+            <Default>: None; run all bars.
+        :return: np.ndarray; recorded nav.
         """
         # Clear all records before running.
         self.__clear_all()
+        self.account.reserve(len(self.data))
+        return self.resume(strategy, stop_rule, stop)
+
+    def resume(self, strategy, stop_rule=None, stop=None):
+        """
+        Go on with a paused run_naive() from self.cursor, keeping the
+        account, order book and metrics.
+        :param strategy: Strategy object.
+        :param stop_rule: callable; see run_naive().
+        :param stop: int; bar to pause before.
+            <Default>: None; run the remaining bars.
+        :return: np.ndarray; recorded nav.
+        """
         instrument = strategy.instrument
 
         # Distribute bars.
-        for row in self.data.iterrows():
+        for row in self.__rows(self.cursor, stop):
+            self.cursor += 1
             bar = row[1]    # row is tuple, [0]->index, [1]->data
-            curr_prices = {instrument: bar[BarColNames.close.value]}
+            curr_price = bar[BarColNames.close.value]
+            curr_prices = {instrument: curr_price}
             curr_time = bar[BarColNames.time.value]
 
+            executed = 0
+            # Bracketed positions reached within this bar.
+            if self.account.bracketed:
+                ranges = self.__bar_ranges(
+                    lambda col: None if bar.get(col) is None
+                    else {instrument: bar.get(col)}, {instrument: curr_price})
+                executed += self.__check_brackets(curr_time, ranges)
+            # Resting orders triggered within this bar.
+            if self.book:
+                executed += self.__match(
+                    instrument, curr_time,
+                    bar.get(BarColNames.low.value, curr_price),
+                    bar.get(BarColNames.high.value, curr_price),
+                    bar.get(BarColNames.open.value), curr_prices)
             # Run strategy logic.
-            order_direction, volume = strategy.on_bar(bar)
-            # Make order.
-            order = Order(instrument=instrument,
-                          direction=order_direction,
-                          time=curr_time,
-                          price=bar[BarColNames.close.value],
-                          volume=volume)
-            # Handle order.
-            trading_executed_flag = self.account.handle_mkt_order(
-                order, curr_prices)
+            orders = strategy.on_bar(bar)
+            if isinstance(orders, tuple):
+                # Make order.
+                order_direction, volume = orders
+                orders = [Order(instrument=instrument,
+                                direction=order_direction,
+                                time=curr_time,
+                                price=curr_price,
+                                volume=volume)]
+            # Handle orders.
+            for order in orders:
+                executed += self.__submit(order, curr_prices)
             # Make records.
-            self.log(curr_prices, order)
-            # Only record executed orders.
-            if trading_executed_flag == TradingExecuteFlag.good:
-                self.account.record_executed_order(order)
+            self.log(curr_prices, orders)
+            # Update metrics, stop early if rule fires.
+            self.metrics.update(self.account.nav(curr_prices), executed)
+            if stop_rule and stop_rule(self.metrics):
+                self.pruned = True
+                break
 
         return self.account.record_nav
 
+    def run_vectorized(self, strategy, stop_rule=None):
+        """
+        Run backtest on strategy for <single instrument>, columnar mode.
+        Bar columns are pulled into arrays once, and the strategy emits
+        whole signal/volume arrays by on_data(), so no Series, Order or
+        Position is built for bars that do not trade.
+        Same nav, positions and executed orders as run_naive().
+        :param strategy: Strategy object; implements on_data(data).
+        :param stop_rule: callable; see run_naive().
+            <Default>: None; run all bars, metrics are filled at once.
+        :return: np.ndarray; recorded nav.
+        """
+        # Clear all records before running.
+        self.__clear_all()
+        directions, volumes = strategy.on_data(self.data)
+        return self.__run_signals(strategy.instrument, directions, volumes,
+                                  stop_rule)
+
+    def __run_signals(self, instrument, directions, volumes, stop_rule=None):
+        """
+        Account for whole signal/volume arrays on bar columns.
+        :param instrument: string; name of instrument.
+        :param directions: array-like; OrderType objects or codes.
+        :param volumes: array-like; order volumes.
+        :param stop_rule: callable; see run_naive().
+        :return: np.ndarray; recorded nav.
+        """
+        account = self.account
+
+        # Pull columns once.
+        close = np.asarray(self.data[BarColNames.close.value],
+                           dtype=np.float64).tolist()
+        times = self.data[BarColNames.time.value]
+        codes = encode_order_types(directions).tolist()
+        volumes = np.asarray(volumes).tolist()
+
+        code_buy = ORD_CODE_MAPPING[OrderType.buy]
+        code_short = ORD_CODE_MAPPING[OrderType.short]
+        code_sell = ORD_CODE_MAPPING[OrderType.sell]
+        code_fill = ORD_CODE_MAPPING[OrderType.fill]
+
+        nav = np.empty(len(close))
+        long_volumes = np.empty(len(close))
+        short_volumes = np.empty(len(close))
+        balance = account.curr_balance
+        net_volume, net_cost = 0, 0
+        long_volume, short_volume = 0, 0
+        metrics, n_bars = self.metrics, len(close)
+        for i in xrange(len(close)):
+            code, price = codes[i], close[i]
+            executed = False
+            # Only bars whose order could be executed reach the account.
+            if (code == code_buy or code == code_short or
+                    (code == code_sell and account.longs) or
+                    (code == code_fill and account.shorts)):
+                order = Order(instrument=instrument,
+                              direction=CODE_ORD_MAPPING[code],
+                              time=times.iat[i],
+                              price=price,
+                              volume=volumes[i])
+                trading_executed_flag = account.handle_mkt_order(
+                    order, {instrument: price})
+                if trading_executed_flag == TradingExecuteFlag.good:
+                    executed = True
+                    account.record_executed_order(order)
+                    balance = account.curr_balance
+                    net_volume, net_cost = account.exposure(instrument)
+                    long_volume, short_volume = account.volumes(instrument)
+            nav[i] = balance + net_volume * price - net_cost
+            long_volumes[i], short_volumes[i] = long_volume, short_volume
+            if stop_rule:
+                metrics.update(nav[i], executed)
+                if stop_rule(metrics):
+                    self.pruned, n_bars = True, i + 1
+                    break
+
+        if not stop_rule:
+            metrics.extend(nav, len(account.record_orders))
+        nav, long_volumes, short_volumes = \
+            nav[:n_bars], long_volumes[:n_bars], short_volumes[:n_bars]
+        prices = np.asarray(close[:n_bars])
+        account.record_columns(nav, long_volumes, long_volumes * prices,
+                               short_volumes, short_volumes * prices)
+        return account.record_nav
+
+    def run_sparse(self, strategy, stop_rule=None, warmup=0):
+        """
+        Run backtest on strategy for <single instrument>, event mode.
+        Signals come ahead of time from on_data(), as in run_vectorized(),
+        but accounting only runs on bars with a signal; between those
+        bars the account state is constant, so nav is filled by
+        vectorized mark-to-market. Same nav, positions and executed
+        orders as run_naive(); per-bar python work scales with the
+        number of signals, not bars.
+        :param strategy: Strategy object; implements on_data(data).
+        :param stop_rule: callable; see run_naive(). Checked on signal
+            bars only, after metrics take the bars since the last one.
+            <Default>: None; run all bars, metrics are filled at once.
+        :param warmup: int; leading bars that only feed indicators, their
+            signals are dropped.
+            <Default>: 0.
+        :return: np.ndarray; recorded nav.
+        """
+        # Clear all records before running.
+        self.__clear_all()
+        directions, volumes = strategy.on_data(self.data)
+        if warmup:
+            directions = encode_order_types(directions)
+            directions[:warmup] = ORD_CODE_MAPPING[OrderType.none]
+        return self.__run_events(strategy.instrument, directions, volumes,
+                                 stop_rule)
+
+    def __run_events(self, instrument, directions, volumes, stop_rule=None):
+        """
+        Account for signal/volume arrays on signal bars only.
+        :param instrument: string; name of instrument.
+        :param directions: array-like; OrderType objects or codes.
+        :param volumes: array-like; order volumes.
+        :param stop_rule: callable; see run_sparse().
+        :return: np.ndarray; recorded nav.
+        """
+        account = self.account
+
+        prices = np.asarray(self.data[BarColNames.close.value],
+                            dtype=np.float64)
+        times = self.data[BarColNames.time.value]
+        codes = encode_order_types(directions)
+        volumes = np.asarray(volumes).tolist()
+        events = np.flatnonzero(codes != ORD_CODE_MAPPING[OrderType.none])
+
+        code_sell = ORD_CODE_MAPPING[OrderType.sell]
+        code_fill = ORD_CODE_MAPPING[OrderType.fill]
+
+        # Account state from each start bar on, until the next start.
+        starts = [0]
+        balance = [account.curr_balance]
+        net_volume, net_cost = [0], [0]
+        long_volume, short_volume = [0], [0]
+        metrics, n_bars, last = self.metrics, len(prices), 0
+        for i in events.tolist():
+            code, price = int(codes[i]), float(prices[i])
+            executed = False
+            if not ((code == code_sell and not account.longs) or
+                    (code == code_fill and not account.shorts)):
+                order = Order(instrument=instrument,
+                              direction=CODE_ORD_MAPPING[code],
+                              time=times.iat[i],
+                              price=price,
+                              volume=volumes[i])
+                trading_executed_flag = account.handle_mkt_order(
+                    order, {instrument: price})
+                if trading_executed_flag == TradingExecuteFlag.good:
+                    executed = True
+                    account.record_executed_order(order)
+                    starts.append(i)
+                    balance.append(account.curr_balance)
+                    nv, nc = account.exposure(instrument)
+                    net_volume.append(nv)
+                    net_cost.append(nc)
+                    lv, sv = account.volumes(instrument)
+                    long_volume.append(lv)
+                    short_volume.append(sv)
+            if stop_rule:
+                # Quiet bars, then the signal bar, to the metrics.
+                k = -2 if executed else -1
+                segment = np.append(
+                    balance[k] + net_volume[k] * prices[last:i] - net_cost[k],
+                    balance[-1] + net_volume[-1] * price - net_cost[-1])
+                metrics.extend(segment, executed)
+                last = i + 1
+                if stop_rule(metrics):
+                    self.pruned, n_bars = True, i + 1
+                    break
+
+        counts = np.diff(np.append(starts, n_bars))
+        prices = prices[:n_bars]
+        long_volume = np.repeat(long_volume, counts).astype(np.float64)
+        short_volume = np.repeat(short_volume, counts).astype(np.float64)
+        nav = np.repeat(balance, counts) + \
+            np.repeat(net_volume, counts) * prices - \
+            np.repeat(net_cost, counts)
+        if not stop_rule:
+            metrics.extend(nav, len(account.record_orders))
+        elif not self.pruned:
+            metrics.extend(nav[last:])
+        account.record_columns(nav, long_volume, long_volume * prices,
+                               short_volume, short_volume * prices)
+        return account.record_nav
+
+    def run_portfolio(self, strategy, stop_rule=None):
+        """
+        Run backtest on strategy for <many instruments>.
+        self.data is a dataset.BarPanel; every bar gets one price vector
+        indexed by instrument code, and the account revalues all
+        instruments from it by dot products, no dict lookups. Amounts
+        are converted to the account base currency by the rates of a
+        currency.ConversionMatrix, built once for the panel.
+        :param strategy: Strategy object; implements
+            on_bars(time, prices) -> list of (instrument, OrderType,
+            volume) tuples or Order objects, prices being the close of
+            each panel instrument in panel.instruments order. Orders of
+            PENDING_ORDER_TYPES rest in self.book, and bracketed
+            positions are checked against high/low, as in run_naive().
+        :param stop_rule: callable; see run_naive().
+        :return: np.ndarray; recorded nav.
+        """
+        # Clear all records before running.
+        self.__clear_all()
+        panel, account = self.data, self.account
+        account.reserve(len(panel))
+
+        close = panel.field(BarColNames.close.value)
+        # Prices and quote rates by instrument code; instruments not
+        # quoted yet at price 0. Rates carry forward, and are nan until
+        # a first one, so orders in those instruments fail the margin
+        # check rather than open at no margin.
+        prices = np.zeros((len(panel), len(instrument_names())))
+        prices[:, panel.codes] = np.nan_to_num(close)
+        rates = np.empty_like(prices)
+        rates.fill(np.nan)
+        rates[:, panel.codes] = pd.DataFrame(ConversionMatrix(
+            panel, account.base_currency()).quote_rates()).ffill().values
+        # Bar ranges for resting orders, close if the panel has none.
+        fields = dict((name, panel.field(name) if name in panel.fields
+                       else close) for name in [BarColNames.low.value,
+                                                BarColNames.high.value])
+        low, high = fields[BarColNames.low.value], \
+            fields[BarColNames.high.value]
+        column = dict((name, k) for k, name in enumerate(panel.instruments))
+
+        def column_of(name):
+            if name not in column:
+                msg = '[KERNEL::Kernel]: {} is not in the panel. '.format(
+                    name)
+                raise KernelDataError(msg)
+            return column[name]
+
+        def by_code(name):
+            if name not in panel.fields:
+                return None
+            values = np.empty(prices.shape)
+            values.fill(np.nan)
+            values[:, panel.codes] = panel.field(name)
+            return values
+        ranges = self.__bar_ranges(by_code, by_code(BarColNames.close.value))
+
+        for i, curr_time in enumerate(panel.index):
+            curr_prices = prices[i]
+            account.set_rates(rates[i])
+            executed = 0
+            if account.bracketed:
+                executed += self.__check_brackets(curr_time, dict(
+                    (k, v if v is None else v[i])
+                    for k, v in ranges.iteritems()))
+            for instrument in self.book.instruments():
+                k = column_of(instrument)
+                executed += self.__match(instrument, curr_time, low[i, k],
+                                         high[i, k], None, curr_prices)
+            for order in strategy.on_bars(curr_time, close[i]):
+                if isinstance(order, tuple):
+                    instrument, direction, volume = order
+                    order = Order(
+                        instrument=instrument,
+                        direction=direction,
+                        time=curr_time,
+                        price=close[i, column_of(instrument)],
+                        volume=volume)
+                column_of(order.instrument)
+                executed += self.__submit(order, curr_prices)
+            account.record_ts(curr_prices)
+            # Update metrics, stop early if rule fires.
+            self.metrics.update(account.nav(curr_prices), executed)
+            if stop_rule and stop_rule(self.metrics):
+                self.pruned = True
+                break
+
+        return account.record_nav
+
+    @staticmethod
+    def __expand_grid(param_grid):
+        """
+        :param param_grid: dict; {parameter name: list of values}, every
+            combination. Or list; {parameter name: value} dicts, one per
+            parameter set, in order, for grids that are not products.
+        :return: tuple; (sorted names, list of value tuples).
+        """
+        if isinstance(param_grid, dict):
+            names = sorted(param_grid)
+            return names, list(itertools.product(
+                *[param_grid[n] for n in names]))
+        names = sorted(param_grid[0]) if param_grid else []
+        if not names or any(sorted(params) != names
+                            for params in param_grid):
+            msg = '[KERNEL::Kernel]: Parameter sets must share the same ' \
+                  'names. '
+            raise KernelBacktestError(msg)
+        return names, [tuple(params[n] for n in names)
+                       for params in param_grid]
+
+    def run_batch(self, strategy_cls, param_grid):
+        """
+        Evaluate every parameter combination of a strategy in one pass.
+        The strategy class takes its parameters as arrays, one entry per
+        combination, and returns (bars x parameter sets) signal/volume
+        arrays from on_data_batch(); accounting then steps through the
+        bars where any column trades, once, with state vectors across
+        columns (see __run_batch_events()), so every column reproduces
+        run_naive(). Netting accounts are accounted column by column.
+        <example>
+            k.run_batch(DMA, {'fast': range(5, 15), 'slow': [20, 30]})
+        :param strategy_cls: class; implements classmethod
+            on_data_batch(data, params), params being
+            {parameter name: np.ndarray}.
+        :param param_grid: dict; {parameter name: list of values}.
+            Or list; of parameter sets, see __expand_grid().
+        :return: pd.DataFrame object; nav matrix, one row per bar and one
+            column per parameter set, whatever the account's
+            record_mode. The account keeps records of the last column.
+        """
+        names, combos = self.__expand_grid(param_grid)
+        params = dict((name, np.array([combo[i] for combo in combos]))
+                      for i, name in enumerate(names))
+        instrument = strategy_cls(**dict(zip(names, combos[0]))).instrument
+        directions, volumes = strategy_cls.on_data_batch(self.data, params)
+        directions = np.asarray(directions)
+        codes = encode_order_types(directions.ravel()).reshape(
+            directions.shape)
+        volumes = np.asarray(volumes, dtype=np.float64)
+
+        if not self.account.netting:
+            navs = self.__run_batch_events(codes, volumes)
+        else:
+            navs = np.empty(codes.shape)
+            record_mode = self.account.record_mode
+            self.account.record_mode = RecordMode.every
+            try:
+                for j in xrange(codes.shape[1]):
+                    self.__clear_all()
+                    navs[:, j] = self.__run_events(instrument, codes[:, j],
+                                                   volumes[:, j])
+            finally:
+                self.account.record_mode = record_mode
+        # Positions, orders and records of the last column.
+        self.__clear_all()
+        self.__run_events(instrument, codes[:, -1], volumes[:, -1])
+        columns = pd.MultiIndex.from_tuples(combos, names=names)
+        return pd.DataFrame(navs, index=self.data.index, columns=columns)
+
+    def __run_batch_events(self, codes, volumes):
+        """
+        Account for (bars x columns) signal codes/volumes of one
+        instrument, one step per bar where any column trades, with one
+        state entry per column. A single instrument account's nav and
+        margin only depend on its summed long/short volumes and the net
+        cost of all trades, not on which lots a close picks:
+            nav = initial balance + (long - short) * price - net cost
+        so, as Account.handle_mkt_order() would, per column:
+            - buy/short open if margin available >= volume * price.
+            - sell/fill close up to their volume of longs/shorts.
+        :param codes: np.ndarray; bars x columns, ORD_CODE_MAPPING codes.
+        :param volumes: np.ndarray; bars x columns, order volumes.
+        :return: np.ndarray; bars x columns navs.
+        """
+        account = self.account
+        prices = np.asarray(self.data[BarColNames.close.value],
+                            dtype=np.float64)
+        init_cash, margin_rate = account.initial_balance(), \
+            account.margin_rate()
+        code_buy = ORD_CODE_MAPPING[OrderType.buy]
+        code_short = ORD_CODE_MAPPING[OrderType.short]
+        code_sell = ORD_CODE_MAPPING[OrderType.sell]
+        code_fill = ORD_CODE_MAPPING[OrderType.fill]
+
+        n_bars, n_cols = codes.shape
+        long_volume, short_volume = np.zeros(n_cols), np.zeros(n_cols)
+        net_cost = np.zeros(n_cols)
+        starts, states = [0], [(long_volume, short_volume, net_cost)]
+        trading = (codes != ORD_CODE_MAPPING[OrderType.none]).any(axis=1)
+        for i in np.flatnonzero(trading).tolist():
+            code, volume, price = codes[i], volumes[i], prices[i]
+            nav = init_cash + (long_volume - short_volume) * price - net_cost
+            available = np.maximum(0, nav - (long_volume + short_volume) *
+                                   price * margin_rate)
+            opens = available >= volume * price
+            bought = np.where((code == code_buy) & opens, volume, 0)
+            shorted = np.where((code == code_short) & opens, volume, 0)
+            sold = np.where(code == code_sell,
+                            np.clip(volume, 0, long_volume), 0)
+            filled = np.where(code == code_fill,
+                              np.clip(volume, 0, short_volume), 0)
+            long_volume = long_volume + bought - sold
+            short_volume = short_volume + shorted - filled
+            net_cost = net_cost + (bought - shorted - sold + filled) * price
+            starts.append(i)
+            states.append((long_volume, short_volume, net_cost))
+
+        counts = np.diff(np.append(starts, n_bars))
+        long_volume, short_volume, net_cost = [
+            np.repeat(np.array(column), counts, axis=0)
+            for column in zip(*states)]
+        return init_cash + (long_volume - short_volume) * \
+            prices[:, np.newaxis] - net_cost
+
     def export_positions(self):
         """
 
@@ -684,6 +2595,241 @@ class Kernel:
         """
         return self.account.export_executed_orders()
 
+    def summary(self):
+        """
+        Key statistics of the last run, from self.metrics, which sees
+        every bar whatever the account's record_mode.
+        :return: dict;
+            - final_nav: double; nav of the last bar.
+            - total_return: double; final_nav / initial balance - 1.
+            - max_drawdown: double; largest fall from a nav peak, in
+              fraction of the peak.
+            - trades: int; number of closed positions.
+            - win_rate: double; fraction of closed positions with pnl > 0.
+            - bars: int; bars processed.
+            - pruned: boolean; whether a stop rule ended the run.
+        """
+        init_cash = self.account.initial_balance()
+        metrics = self.metrics
+        final_nav = metrics.nav if metrics.bars else init_cash
+        pnl = self.account.closed.column('realized_pnl')
+        return {
+            'final_nav': final_nav,
+            'total_return': final_nav / init_cash - 1,
+            'max_drawdown': metrics.max_drawdown,
+            'trades': len(pnl),
+            'win_rate': np.mean(pnl > 0) if len(pnl) else np.nan,
+            'bars': self.metrics.bars,
+            'pruned': self.pruned
+        }
+
+    @classmethod
+    def sweep(cls, strategy_cls, param_grid, data, workers=None,
+              mode='run_naive', stop_rule=None):
+        """
+        Run a strategy over every combination of a parameter grid,
+        across a process pool. Bar data is sent to each worker once,
+        by the pool initializer, not once per task. Workers share
+        indicator columns through the disk tier of memo.default_cache,
+        when its root is set.
+        <example>
+            Kernel.sweep(DMA, {'fast': [5, 10], 'slow': [20, 40]}, df)
+        :param strategy_cls: class; strategy, constructed with the
+            parameters as keyword arguments.
+        :param param_grid: dict; {parameter name: list of values}.
+            Or list; of parameter sets, see __expand_grid().
+        :param data: pd.DataFrame object; bar data.
+            Or dataset.BarDataset object; workers then attach to the
+            shared columns by name instead of receiving a copy.
+        :param workers: int; number of worker processes.
+            <Default>: None; number of cpus.
+        :param mode: string; 'run_naive', 'run_vectorized' or
+            'run_sparse'.
+            <Default>: 'run_naive'.
+        :param stop_rule: StopRule object; prunes losing runs early.
+            <Default>: None.
+        :return: pd.DataFrame object; summary() of each run, indexed by
+            parameter set.
+        """
+        if mode not in ['run_naive', 'run_vectorized', 'run_sparse']:
+            msg = '[KERNEL::Kernel]: Unknown sweep mode {}. '.format(mode)
+            raise KernelBacktestError(msg)
+        names, combos = cls.__expand_grid(param_grid)
+        tasks = [(strategy_cls, dict(zip(names, combo)), mode, stop_rule)
+                 for combo in combos]
+
+        pool = multiprocessing.Pool(workers, _init_sweep_worker, (data,))
+        try:
+            rows = pool.map(_run_sweep_task, tasks, chunksize=1)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        index = pd.MultiIndex.from_tuples(combos, names=names)
+        return pd.DataFrame(rows, index=index)
+
+    def run_partitioned(self, strategy, chunks=None, workers=None):
+        """
+        Run one long backtest as time chunks in parallel processes, for
+        strategies with bounded lookback. Each chunk starts with a fresh
+        account, after strategy.max_lookback warm-up bars whose signals
+        are dropped, and is run by run_sparse(). Chunk navs are shifted
+        by the pnl of the chunks before, and positions/orders are
+        appended in time order, so the result is that of a serial
+        run_sparse().
+        Chunks run at once, so each starts from the initial balance, not
+        from the balance the chunks before leave. Signals of on_data()
+        do not see the account, so only margin checks can tell: a chunk
+        whose margin checks would pass or fail differently with the
+        shifted balance (see Account.margin_slack) raises, and the run
+        has to be serial.
+        Strategy attributes:
+            - max_lookback: int; bars of history that determine its
+              signals.
+            - flat_at_boundary: boolean; True if it holds no position at
+              chunk boundaries. Optional boundaries(data) gives the bars
+              where it is flat (e.g. session opens); chunk starts snap to
+              them. A chunk that ends with open positions raises.
+            - instrument: string; name of instrument.
+        :param strategy: Strategy object; implements on_data(data).
+        :param chunks: int; number of chunks.
+            <Default>: None; number of workers.
+        :param workers: int; number of worker processes.
+            <Default>: None; number of cpus.
+        :return: np.ndarray; recorded nav.
+        """
+        if not getattr(strategy, 'flat_at_boundary', False) or \
+                getattr(strategy, 'max_lookback', None) is None:
+            msg = '[KERNEL::Kernel]: Strategy does not declare ' \
+                  'max_lookback and flat_at_boundary. '
+            raise KernelBacktestError(msg)
+        self.__clear_all()
+        n_bars = len(self.data)
+        chunks = chunks or workers or multiprocessing.cpu_count()
+        starts = np.linspace(0, n_bars, chunks + 1).astype(int)[:-1]
+        if hasattr(strategy, 'boundaries'):
+            flat = np.asarray(strategy.boundaries(self.data), dtype=int)
+            starts = flat[np.clip(np.searchsorted(flat, starts), 0,
+                                  len(flat) - 1)]
+        starts = np.unique(np.append(starts, 0))
+        stops = np.append(starts[1:], n_bars)
+        tasks = [(strategy, self.account, start, stop, strategy.max_lookback)
+                 for start, stop in zip(starts.tolist(), stops.tolist())]
+
+        pool = multiprocessing.Pool(workers, _init_sweep_worker, (self.data,))
+        try:
+            results = pool.map(_run_partition_task, tasks, chunksize=1)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        # Stitch chunks in time order.
+        account = self.account
+        init_cash = account.initial_balance()
+        offset, next_id, columns = 0.0, 0, []
+        for k, result in enumerate(results):
+            if not result['flat'] and k < len(results) - 1:
+                msg = '[KERNEL::Kernel]: Strategy holds positions at ' \
+                      'bar {}, not flat at boundary. '.format(stops[k])
+                raise KernelBacktestError(msg)
+            slack, shortfall = result['margin']
+            if slack + offset < 0 or shortfall + offset >= 0:
+                msg = '[KERNEL::Kernel]: Margin checks from bar {} depend ' \
+                      'on the pnl before it, run serially. '.format(starts[k])
+                raise KernelBacktestError(msg)
+            records = result['records']
+            records['nav'] = records['nav'] + offset
+            columns.append(records)
+            book = result['closed']
+            # Worker codes to codes of this process.
+            codes = np.array([encode_instrument(name)
+                              for name in result['instruments']] or [0])
+            for slot in xrange(len(book)):
+                new_slot = account.closed.append_row(book, slot)
+                c = account.closed.columns
+                c['position_id'][new_slot] += next_id
+                c['instrument'][new_slot] = codes[c['instrument'][new_slot]]
+            if len(book):
+                next_id += int(book.column('position_id').max()) + 1
+            account.record_orders.extend(result['orders'])
+            offset += result['balance'] - init_cash
+
+        account.curr_balance = init_cash + offset
+        records = dict((key, np.concatenate([c[key] for c in columns]))
+                       for key in columns[0])
+        account.record_columns(records['nav'], records['long_volume'],
+                               records['long_value'], records['short_volume'],
+                               records['short_value'])
+        self.metrics.extend(records['nav'], len(account.record_orders))
+        return account.record_nav
+
+# ----------------------------------------------------------------------
+# Sweep workers.
+
+# Bar data of a sweep worker process, set once by the pool initializer.
+_sweep_data = None
+
+
+def _init_sweep_worker(data):
+    """
+    Pool initializer, keep bar data for all tasks of this process.
+    :param data: pd.DataFrame object; bar data.
+    :return:
+    """
+    global _sweep_data
+    _sweep_data = data
+
+
+def _run_sweep_task(task):
+    """
+    Run one parameter set on the worker's bar data.
+    :param task: tuple; (strategy class, parameters dict, run mode,
+        stop rule).
+    :return: dict; Kernel.summary().
+    """
+    strategy_cls, params, mode, stop_rule = task
+    kernel = Kernel.naive(_sweep_data)
+    getattr(kernel, mode)(strategy_cls(**params), stop_rule)
+    return kernel.summary()
+
+
+def _run_partition_task(task):
+    """
+    Run one time chunk of Kernel.run_partitioned() on the worker's bar
+    data.
+    :param task: tuple; (strategy, account, first bar, bar after the
+        last, warm-up bars).
+    :return: dict; record columns, closed positions, executed orders,
+        final balance, whether the account ended flat, margin slack and
+        shortfall, and the instrument names of the book's codes.
+    """
+    strategy, account, start, stop, lookback = task
+    first = max(0, start - lookback)
+    if isinstance(_sweep_data, pd.DataFrame):
+        data = _sweep_data.iloc[first:stop]
+    else:
+        data = _sweep_data.slice(first, stop)
+    # Record every bar; the parent applies the account's record mode.
+    account.record_mode = RecordMode.every
+    kernel = Kernel(data, account)
+    kernel.run_sparse(strategy, warmup=start - first)
+    records = account.records
+    return {
+        'records': dict((key, records.column(key)[start - first:].copy())
+                        for key in records.keys if key != 'bar'),
+        'closed': account.closed,
+        'orders': account.record_orders,
+        'balance': account.curr_balance,
+        'flat': not (account.longs or account.shorts),
+        'margin': (account.margin_slack, account.margin_shortfall),
+        'instruments': instrument_names()
+    }
+
 # ----------------------------------------------------------------------
 # Strategy Template.
 
@@ -691,6 +2837,12 @@ class Kernel:
 class StrategyTemplate:
     """
     Strategy Template object.
+    Take profit and stop loss are part of the signal state machine and
+    are checked on close prices, not bar ranges: on_data() and
+    on_data_batch() replay it as signal arrays for run_vectorized(),
+    run_sparse() and run_batch(), which do not check brackets. For
+    intrabar exits, open with Order.bracket() under run_naive() or
+    run_portfolio().
 
     """
 
@@ -699,9 +2851,10 @@ class StrategyTemplate:
 
         """
         self.instrument = instrument
-        self.history = []
         self.slow = slow
         self.fast = fast
+        self.slow_ma = SMA(slow)
+        self.fast_ma = SMA(fast)
         self.has_long = 0
         self.open_price = 0
         self.take_profit = 0
@@ -712,14 +2865,10 @@ class StrategyTemplate:
         :param bar: dict;
         :return: OrderType(Enum) object.
         """
-
-        self.history.append(bar)
         curr_price = bar[BarColNames.close.value]
         # ---------------------------- #
-        slow = np.mean([b[BarColNames.close.value]
-                        for b in self.history[-1*self.slow:]])
-        fast = np.mean([b[BarColNames.close.value]
-                        for b in self.history[-1*self.fast:]])
+        slow = self.slow_ma.update(curr_price)
+        fast = self.fast_ma.update(curr_price)
         if fast > slow and (not self.has_long):
             self.has_long = 1
             self.open_price = curr_price
@@ -738,3 +2887,135 @@ class StrategyTemplate:
 
         # ---------------------------- #
         return OrderType.none, 0
+
+    def on_data(self, data):
+        """
+        Receive the whole bar frame, return signal, volume arrays.
+        Columnar counterpart of on_bar(), for Kernel.run_vectorized().
+        :param data: pd.DataFrame object; bar data.
+        :return: tuple; (np.ndarray of ORD_CODE_MAPPING codes,
+            np.ndarray of volumes).
+        """
+        close = np.asarray(data[BarColNames.close.value], dtype=np.float64)
+        digest = default_cache.digest(close)
+        slow_ma = default_cache.cached(close, 'SMA', (int(self.slow),),
+                                       self.slow_ma.compute, digest).tolist()
+        fast_ma = default_cache.cached(close, 'SMA', (int(self.fast),),
+                                       self.fast_ma.compute, digest).tolist()
+
+        code_buy = ORD_CODE_MAPPING[OrderType.buy]
+        code_sell = ORD_CODE_MAPPING[OrderType.sell]
+        codes = np.zeros(len(close), dtype=np.int8)
+        volumes = np.zeros(len(close), dtype=np.int64)
+
+        # Same state machine as on_bar(), on plain floats.
+        for i, curr_price in enumerate(close.tolist()):
+            fast, slow = fast_ma[i], slow_ma[i]
+            if fast > slow and (not self.has_long):
+                self.has_long = 1
+                self.open_price = curr_price
+                codes[i], volumes[i] = code_buy, 10000
+            elif fast > slow and curr_price - self.open_price >= 0.01:
+                self.has_long = 1
+                self.open_price = 0
+                codes[i], volumes[i] = code_sell, 10000
+            elif curr_price - self.open_price <= -0.005:
+                self.has_long = 1
+                self.open_price = 0
+                codes[i], volumes[i] = code_sell, 10000
+            elif fast < slow:
+                self.has_long = 0
+                codes[i], volumes[i] = code_sell, 10000
+        return codes, volumes
+
+    @classmethod
+    def on_data_batch(cls, data, params):
+        """
+        Signal, volume arrays for many parameter sets in one pass.
+        Moving averages missing from the indicator cache come from a single
+        cumulative sum, and the on_bar() state machine steps all parameter
+        sets at once.
+        :param data: pd.DataFrame object; bar data.
+        :param params: dict; {'fast': np.ndarray, 'slow': np.ndarray}, one
+            entry per parameter set.
+        :return: tuple; (codes, volumes), np.ndarray objects of shape
+            (bars, parameter sets).
+        """
+        close = np.asarray(data[BarColNames.close.value], dtype=np.float64)
+        fast_windows = [(int(w),) for w in params['fast']]
+        slow_windows = [(int(w),) for w in params['slow']]
+
+        def compute_many(values, missing):
+            averages = SMA.compute_many(values, [w for (w,) in missing])
+            return dict(((w,), a) for w, a in averages.iteritems())
+
+        averages = default_cache.cached_many(
+            close, 'SMA', fast_windows + slow_windows, compute_many)
+        fast = np.column_stack([averages[w] for w in fast_windows])
+        slow = np.column_stack([averages[w] for w in slow_windows])
+        rising, falling = fast > slow, fast < slow
+
+        code_buy = ORD_CODE_MAPPING[OrderType.buy]
+        code_sell = ORD_CODE_MAPPING[OrderType.sell]
+        codes = np.zeros(fast.shape, dtype=np.int8)
+        volumes = np.zeros(fast.shape, dtype=np.int64)
+        has_long = np.zeros(fast.shape[1], dtype=bool)
+        open_price = np.zeros(fast.shape[1])
+
+        for i, curr_price in enumerate(close.tolist()):
+            up, down = rising[i], falling[i]
+            buy = up & ~has_long
+            take_profit = ~buy & up & (curr_price - open_price >= 0.01)
+            rest = ~(buy | take_profit)
+            stop_loss = rest & (curr_price - open_price <= -0.005)
+            exit_long = rest & ~stop_loss & down
+            sell = take_profit | stop_loss | exit_long
+            # Same transitions as on_bar().
+            has_long = (has_long | buy | take_profit | stop_loss) & \
+                ~exit_long
+            open_price = np.where(buy, curr_price, open_price)
+            open_price[take_profit | stop_loss] = 0
+            codes[i] = buy * code_buy + sell * code_sell
+            volumes[i] = (buy | sell) * 10000
+        return codes, volumes
+
+
+class BasketTemplate:
+    """
+    Portfolio strategy template, for Kernel.run_portfolio().
+    Moving average crossover on each instrument of a basket: long while
+    the fast average is above the slow one, flat otherwise.
+    """
+
+    def __init__(self, fast, slow, instruments):
+        """
+        :param fast: int; fast window.
+        :param slow: int; slow window.
+        :param instruments: list; instrument names, in panel order.
+        """
+        self.instruments = list(instruments)
+        self.fast, self.slow = fast, slow
+        self.fast_ma = [SMA(fast) for _ in instruments]
+        self.slow_ma = [SMA(slow) for _ in instruments]
+        self.has_long = [False] * len(instruments)
+
+    def on_bars(self, time, prices):
+        """
+        Receive one bar of every instrument, return orders.
+        :param time: pd.Timestamp object; bar time.
+        :param prices: np.ndarray; close of each instrument.
+        :return: list; (instrument, OrderType, volume) tuples.
+        """
+        orders = []
+        for k, curr_price in enumerate(prices.tolist()):
+            if curr_price != curr_price:  # not quoted yet.
+                continue
+            fast = self.fast_ma[k].update(curr_price)
+            slow = self.slow_ma[k].update(curr_price)
+            if fast > slow and not self.has_long[k]:
+                self.has_long[k] = True
+                orders.append((self.instruments[k], OrderType.buy, 10000))
+            elif fast < slow and self.has_long[k]:
+                self.has_long[k] = False
+                orders.append((self.instruments[k], OrderType.sell, 10000))
+        return orders
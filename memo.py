@@ -0,0 +1,237 @@
+import os
+import hashlib
+import weakref
+from collections import OrderedDict
+import numpy as np
+
+__author__ = 'zed'
+
+# ----------------------------------------------------------------------
+# Memoized indicator columns.
+
+
+def fingerprint(array):
+    """
+    Content hash of an array; equal data gives equal fingerprints.
+    :param array: array-like.
+    :return: string; hex digest.
+    """
+    values = np.ascontiguousarray(array)
+    digest = hashlib.sha1(values.dtype.str + repr(values.shape))
+    digest.update(values.data)
+    return digest.hexdigest()
+
+
+class IndicatorCache(object):
+    """
+    Cache of indicator columns, keyed by
+    (dataset fingerprint, indicator name, parameters).
+    Two tiers:
+        - memory: LRU, evicted by total bytes of cached arrays.
+        - disk (optional): one .npy file per key under root, read back
+        memory-mapped. Entries survive the process, so workers of
+        Kernel.sweep() and later sessions share them.
+    Cached arrays are read-only; copy before writing into them.
+
+    Input data is hashed once per buffer, not once per lookup: see
+    digest(). Bar data is taken as immutable; after writing into an
+    array in place, call forget() on it.
+
+    <example>
+        memo.default_cache.root = 'cache/indicators'
+        Kernel.sweep(DMA, grid, data)   # computes and stores
+        Kernel.sweep(DMA, grid, data)   # loads, no indicator work
+
+    <privates>
+        - max_bytes: int; memory budget of the LRU tier.
+        - root: string; directory of the disk tier, None to disable.
+        - entries: OrderedDict; {key: np.ndarray}, oldest first.
+        - nbytes: int; bytes held by entries.
+        - hits, misses: int; lookup counters.
+        - digests: dict; {(address, shape, strides, dtype): (weak
+          reference to the owning array, fingerprint)}.
+    """
+
+    def __init__(self, max_bytes=256 * 2 ** 20, root=None):
+        """
+        Constructor.
+        :param max_bytes: int; memory budget in bytes.
+            <Default>: 256MB.
+        :param root: string; directory of the disk tier.
+            <Default>: None; memory only.
+        :return:
+        """
+        self.max_bytes = max_bytes
+        self.root = root
+        self.digests = dict()
+        self.clear()
+
+    def clear(self):
+        """
+        Drop the memory tier; files of the disk tier are kept.
+        """
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def __buffer(array):
+        """
+        :return: tuple; (buffer key, array owning the memory).
+        """
+        owner = array
+        while isinstance(owner.base, np.ndarray):
+            owner = owner.base
+        key = (array.__array_interface__['data'][0], array.shape,
+               array.strides, array.dtype.str)
+        return key, owner
+
+    def digest(self, array):
+        """
+        fingerprint() of an array, memoized by its buffer while the
+        array owning the buffer is alive; so a run hashes its bar data
+        once, and later lookups on the same data cost a dict lookup.
+        :param array: np.ndarray.
+        :return: string; hex digest.
+        """
+        array = np.asarray(array)
+        key, owner = self.__buffer(array)
+        entry = self.digests.get(key)
+        if entry is not None and entry[0]() is owner:
+            return entry[1]
+        digests = self.digests
+
+        def drop(ref, key=key):
+            if key in digests and digests[key][0] is ref:
+                del digests[key]
+        self.digests[key] = (weakref.ref(owner, drop), fingerprint(array))
+        return self.digests[key][1]
+
+    def forget(self, array):
+        """
+        Drop the memoized digest of an array written in place.
+        :param array: np.ndarray.
+        """
+        self.digests.pop(self.__buffer(np.asarray(array))[0], None)
+
+    @staticmethod
+    def key(digest, name, params):
+        """
+        :param digest: string; fingerprint() of the input data.
+        :param name: string; indicator name, e.g. 'SMA'.
+        :param params: tuple; indicator parameters, plain python scalars.
+        :return: string; cache key.
+        """
+        return hashlib.sha1(
+            '{}|{}|{!r}'.format(digest, name, params)).hexdigest()
+
+    def __file(self, key):
+        return os.path.join(self.root, key + '.npy')
+
+    def __keep(self, key, value):
+        """
+        Put into the memory tier, evicting the least recently used.
+        """
+        if value.nbytes > self.max_bytes:
+            return
+        self.entries[key] = value
+        self.nbytes += value.nbytes
+        while self.nbytes > self.max_bytes:
+            _, old = self.entries.popitem(last=False)
+            self.nbytes -= old.nbytes
+
+    def get(self, key):
+        """
+        :param key: string; from key().
+        :return: np.ndarray, or None if not cached in any tier.
+        """
+        value = self.entries.pop(key, None)
+        if value is not None:
+            self.entries[key] = value  # most recently used.
+            self.hits += 1
+            return value
+        if self.root is not None and os.path.exists(self.__file(key)):
+            value = np.load(self.__file(key), mmap_mode='r')
+            self.__keep(key, value)
+            self.hits += 1
+            return value
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """
+        Store an array in every tier.
+        :param key: string; from key().
+        :param value: array-like.
+        :return: np.ndarray; the read-only cached array.
+        """
+        value = np.array(value)
+        value.flags.writeable = False
+        if self.root is not None:
+            if not os.path.isdir(self.root):
+                try:
+                    os.makedirs(self.root)
+                except OSError:  # made by another worker.
+                    pass
+            # Write aside then rename, so readers never see half a file.
+            tmp = '{}.{}.tmp'.format(self.__file(key), os.getpid())
+            with open(tmp, 'wb') as f:
+                np.save(f, value)
+            os.rename(tmp, self.__file(key))
+        self.__keep(key, value)
+        return value
+
+    def cached(self, array, name, params, compute, digest=None):
+        """
+        Look up an indicator column, computing it on a miss.
+        :param array: np.ndarray; input data.
+        :param name: string; indicator name.
+        :param params: tuple; indicator parameters.
+        :param compute: function; compute(array) -> np.ndarray.
+        :param digest: string; fingerprint(array), if already known.
+        :return: np.ndarray; read-only.
+        """
+        key = self.key(digest or self.digest(array), name, params)
+        value = self.get(key)
+        if value is None:
+            value = self.put(key, compute(array))
+        return value
+
+    def cached_many(self, array, name, params_list, compute_many,
+                    digest=None):
+        """
+        Look up several parameter sets of one indicator, computing all
+        misses in a single call.
+        :param array: np.ndarray; input data.
+        :param name: string; indicator name.
+        :param params_list: list; of parameter tuples.
+        :param compute_many: function; compute_many(array, missing
+            parameter tuples) -> {params: np.ndarray}.
+        :param digest: string; fingerprint(array), if already known.
+        :return: dict; {params: np.ndarray}.
+        """
+        digest = digest or self.digest(array)
+        keys = dict((p, self.key(digest, name, p)) for p in set(params_list))
+        values = dict((p, self.get(k)) for p, k in keys.iteritems())
+        missing = [p for p, v in values.iteritems() if v is None]
+        if missing:
+            for p, v in compute_many(array, missing).iteritems():
+                values[p] = self.put(keys[p], v)
+        return values
+
+    def view(self):
+        """
+        Print cache state.
+        """
+        print '[CACHE]: {} entries, {:.1f}/{:.1f}MB, ' \
+              '{} hits, {} misses.'.format(
+                len(self.entries), self.nbytes / 2.0 ** 20,
+                self.max_bytes / 2.0 ** 20, self.hits, self.misses)
+
+
+# Process-wide cache used by utils, timeseries and strategies.
+default_cache = IndicatorCache()
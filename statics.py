@@ -38,6 +38,13 @@ class BarColNames(Enum):
     low = 'lowMid'
     time = 'datetime'
     volume = 'volume'
+    # Bid/ask candles.
+    open_bid = 'openBid'
+    open_ask = 'openAsk'
+    high_bid = 'highBid'
+    low_bid = 'lowBid'
+    high_ask = 'highAsk'
+    low_ask = 'lowAsk'
 
 
 class OrderType(Enum):
@@ -46,7 +53,7 @@ class OrderType(Enum):
     fill = 'ORD_FILL'
     sell = 'ORD_SELL'
 
-    # TODO: extended orders
+    # Extended orders, resting in kernel.OrderBook until triggered.
     limit_buy = 'ORD_LIMIT_BUY'
     limit_sell = 'ORD_LIMIT_SELL'
     take_profit = 'ORD_TAKE_PROFIT'
@@ -70,19 +77,62 @@ class TradingExecuteFlag(Enum):
     bad = 'TRADE_FAILED'
 
 
+class RecordMode(Enum):
+    every = 'REC_EVERY_BAR'
+    nth = 'REC_EVERY_NTH_BAR'
+    change = 'REC_ON_CHANGE'
+
+
+class ClosePolicy(Enum):
+    fifo = 'CLOSE_FIRST_IN_FIRST_OUT'
+    lifo = 'CLOSE_LAST_IN_FIRST_OUT'
+
+
 class CurrencyType(Enum):
     USD = 'CURRENCY_US_DOLLAR'
     EUR = 'CURRENCY_EURO'
     JPY = 'CURRENCY_JAPAN_YEN'
     CNY = 'CURRENCY_CHN_YUAN'
     CAD = 'CURRENCY_CANADA_DOLLAR'
+    GBP = 'CURRENCY_BRITISH_POUND'
+    AUD = 'CURRENCY_AUSTRALIA_DOLLAR'
+    NZD = 'CURRENCY_NEW_ZEALAND_DOLLAR'
+    CHF = 'CURRENCY_SWISS_FRANC'
+    HKD = 'CURRENCY_HONGKONG_DOLLAR'
+
+
+# Order types that rest in an order book until price reaches them.
+PENDING_ORDER_TYPES = [
+    OrderType.limit_buy,
+    OrderType.limit_sell,
+    OrderType.take_profit,
+    OrderType.stop_loss
+]
 
+# ISO codes, as in instrument names such as 'EUR_USD'.
+CURRENCY_CODE_MAPPING = dict((c, c.name) for c in CurrencyType)
 
 ORD_POS_MAPPING = {
     OrderType.buy: PositionType.long,
     OrderType.short: PositionType.short
 }
 
+# Integer signal codes, used by columnar strategies (on_data).
+ORD_CODE_MAPPING = {
+    OrderType.none: 0,
+    OrderType.buy: 1,
+    OrderType.short: 2,
+    OrderType.sell: 3,
+    OrderType.fill: 4
+}
+
+CODE_ORD_MAPPING = dict((v, k) for k, v in ORD_CODE_MAPPING.items())
+
+# Integer direction codes, used by PositionBook.
+POS_CODES = [PositionType.long, PositionType.short]
+
+POS_CODE_MAPPING = dict((k, v) for v, k in enumerate(POS_CODES))
+
 
 def serialize_dict(dic):
     """
@@ -6,6 +6,7 @@ from datetime import datetime, timedelta
 from api import Config, PyApi
 from api import HeartBeat, Tick, Bar
 from api import MarketEvent, SignalEvent, EventQueue
+from indicators import SMA
 
 from errors import (OANDA_RequestError, OANDA_EnvError, 
 OANDA_DataConstructorError)
@@ -114,6 +115,42 @@ class BuyAndHold(BaseStrategy):
 
 
 
+class MovingAverageCross(BaseStrategy):
+	"""
+	Toy live crossover on mid close prices, using the same incremental
+	indicators as the backtest strategies.
+
+	"""
+	instrument = 'EUR_USD'
+
+	def __init__(self, api, fast=12, slow=26, units=100):
+		"""
+
+		"""
+
+		self.api = api
+		self.units = units
+		self.fast = SMA(fast)
+		self.slow = SMA(slow)
+		self.has_long = False
+
+	def on_bar(self, event):
+		"""
+
+		"""
+		bar = event.body
+		mid = (bar.bid_close + bar.ask_close) / 2.0
+		fast, slow = self.fast.update(mid), self.slow.update(mid)
+		if not self.slow.ready:
+			return
+		if fast > slow and not self.has_long:
+			self.market_buy(self.units)
+			self.has_long = True
+		elif fast < slow and self.has_long:
+			self.market_sell(self.units)
+			self.has_long = False
+
+
 def test_stream():
 	"""
 	
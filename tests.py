@@ -1,7 +1,13 @@
 from oanda import *
 import numpy as np
+import pandas as pd
 from statics import *
-from kernel import Order, Position, Account
+from kernel import Order, Position, Account, Kernel, StrategyTemplate, \
+    MaxDrawdownStop, BasketTemplate, RunningMetrics
+from dataset import BarDataset, BarPanel
+from indicators import SMA, EWMA, MACD, RollingStd, RollingMax, \
+    RollingMin, RollingCov
+from errors import KernelBacktestError, KernelDataError
 from datetime import datetime
 
 __author__ = 'zed'
@@ -96,11 +102,520 @@ def test_account():
     acc.view({'EUR_USD': 3.5})
 
 
+def test_partial_close():
+    acc = Account(1000000, 20, CurrencyType.USD,
+                  close_policy=ClosePolicy.fifo)
+    for k in range(3):
+        acc.handle_mkt_order(Order('EUR_USD', OrderType.buy,
+                                   datetime(2015, 9, 1 + k), 1.1 + k * 0.01,
+                                   1000))
+    print acc.longs.keys()
+    # 1500 FIFO: lot 0 closes, lot 1 is split.
+    acc.handle_mkt_order(Order('EUR_USD', OrderType.sell,
+                               datetime(2015, 9, 5), 1.2, 1500))
+    print [(p.id, p.volume) for p in acc.longs.values()]
+    acc.handle_mkt_order(Order.close_partial(
+        'EUR_USD', OrderType.sell, datetime(2015, 9, 6), 1.2, 200, 2))
+    print acc.position(2).volume, acc.export_positions()
+
+
+def test_netting():
+    acc = Account(1000000, 20, CurrencyType.USD, netting=True)
+    for k, direction in enumerate([OrderType.buy, OrderType.buy,
+                                   OrderType.short, OrderType.short]):
+        acc.handle_mkt_order(Order('EUR_USD', direction,
+                                   datetime(2015, 9, 1 + k), 1.1 + k * 0.01,
+                                   1000 * (k + 1)))
+        print [(p.id, p.direction, p.volume, p.open_price)
+               for p in acc.longs.values() + acc.shorts.values()]
+    # Long 3000 @ avg, then short 3000 closes it, short 4000 opens 4000.
+    print acc.export_positions()
+    # Short 5000 reduces long 500, the other 4500 fails margin.
+    acc = Account(1000, 1, CurrencyType.USD, netting=True)
+    acc.handle_mkt_order(Order('EUR_USD', OrderType.buy,
+                               datetime(2015, 9, 1), 1.0, 500))
+    order = Order('EUR_USD', OrderType.short, datetime(2015, 9, 2), 1.0,
+                  5000)
+    print acc.handle_mkt_order(order), order.body['volume']
+    print [o.body['volume'] for o in acc.rejected_orders]
+
+
 def test_sma():
     a = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
     print a[-8:]
     print np.mean([x for x in a[-8:]])
 
+def make_bars(n=2000, seed=0):
+    rng = np.random.RandomState(seed)
+    close = 1.1 + np.cumsum(rng.normal(0, 0.0005, n))
+    return pd.DataFrame({
+        BarColNames.close.value: close,
+        BarColNames.time.value: pd.date_range('2015-09-01', periods=n,
+                                              freq='min'),
+        BarColNames.volume.value: rng.randint(1, 100, n)
+    })
+
+
+def test_run_vectorized():
+    df = make_bars()
+    k1 = Kernel.naive(df)
+    nav1 = k1.run_naive(StrategyTemplate(12, 26))
+    k2 = Kernel.naive(df)
+    nav2 = k2.run_vectorized(StrategyTemplate(12, 26))
+    print np.allclose(nav1, nav2)
+    print k1.export_positions().equals(k2.export_positions())
+    print len(k1.export_executed_orders()) == \
+        len(k2.export_executed_orders())
+
+
+def test_run_sparse():
+    df = make_bars(20000)
+    k1, k2 = Kernel.naive(df), Kernel.naive(df)
+    nav1 = k1.run_vectorized(StrategyTemplate(60, 240))
+    nav2 = k2.run_sparse(StrategyTemplate(60, 240))
+    print np.allclose(nav1, nav2), len(k2.account.record_orders)
+    print k1.summary() == k2.summary()
+
+
+class HourlyStrategy(object):
+    """
+    Long while the fast SMA is above the slow one, flat at the last bar
+    of every hour.
+    """
+    instrument = 'EUR_USD'
+    flat_at_boundary = True
+
+    def __init__(self, fast=10, slow=30):
+        self.fast, self.slow = fast, slow
+        self.max_lookback = slow
+
+    @staticmethod
+    def minutes(data):
+        return pd.DatetimeIndex(data[BarColNames.time.value]).minute
+
+    def boundaries(self, data):
+        return np.flatnonzero(self.minutes(data) == 0)
+
+    def on_data(self, data):
+        close = np.asarray(data[BarColNames.close.value], dtype=np.float64)
+        long_ = ((SMA(self.fast).compute(close) >
+                  SMA(self.slow).compute(close)) &
+                 (self.minutes(data) != 59))
+        step = np.diff(np.append(0, long_.astype(np.int8)))
+        codes = np.zeros(len(close), dtype=np.int8)
+        codes[step > 0] = ORD_CODE_MAPPING[OrderType.buy]
+        codes[step < 0] = ORD_CODE_MAPPING[OrderType.sell]
+        return codes, np.where(step != 0, 10000, 0)
+
+
+def test_run_partitioned():
+    df = make_bars(20000)
+    k1, k2 = Kernel.naive(df), Kernel.naive(df)
+    nav1 = k1.run_sparse(HourlyStrategy())
+    nav2 = k2.run_partitioned(HourlyStrategy(), chunks=4)
+    print np.allclose(nav1, nav2), len(k1.account.record_orders) == \
+        len(k2.account.record_orders)
+    print k1.summary() == k2.summary()
+    # Margin binds: either the same result, or refused.
+    k1 = Kernel(df, Account(11000, 1, CurrencyType.USD))
+    k2 = Kernel(df, Account(11000, 1, CurrencyType.USD))
+    nav1 = k1.run_sparse(HourlyStrategy())
+    try:
+        nav2 = k2.run_partitioned(HourlyStrategy(), chunks=4)
+        print np.allclose(nav1, nav2)
+    except KernelBacktestError:
+        print 'serial only'
+
+
+def test_fork():
+    df = make_bars(3000)
+    k1, k2 = Kernel.naive(df), Kernel.naive(df)
+    k1.run_naive(StrategyTemplate(12, 26))
+    s = StrategyTemplate(12, 26)
+    k2.run_naive(s, stop=1500)
+    branch, s2 = k2.fork(s)
+    branch.resume(s2)
+    print np.allclose(k1.account.record_nav, branch.account.record_nav)
+    print len(k2.account.record_nav), len(branch.account.record_nav)
+    print len(k1.account.closed) == len(branch.account.closed)
+
+
+def test_bar_aggregator():
+    from api import Tick, BarAggregator
+    agg = BarAggregator(['S5', 'M1', 'M5'])
+    rng = np.random.RandomState(0)
+    closed = []
+    for k in range(0, 900, 2):
+        for pair in ['EUR_USD', 'USD_JPY']:
+            mid = 1.1 + rng.normal(0, 0.0005)
+            closed += agg.push(Tick({'tick': {
+                'instrument': pair, 'bid': mid, 'ask': mid + 0.0002,
+                'time': str((1443657600 + k) * 1000000)}}))
+    closed += agg.flush(1443657600 + 900)
+    for g in agg.granularities:
+        bars = [b for b in closed
+                if b.granularity == g and b.instrument == 'EUR_USD']
+        print g, len(bars), bars[0].start, bars[0].end
+    print agg.ohlc.shape, agg.instruments
+    # A coarse bar left open by flush() closes before the next fine
+    # bar rolls into it: M5 00:00 closes at 1.1, not at the 00:07 tick.
+    agg = BarAggregator(['M1', 'M5'])
+    t0 = 1443657600
+    closed = []
+    for t, bid in [(30, 1.1), (None, None), (420, 1.2), (490, 1.3)]:
+        if t is None:
+            closed += agg.flush(t0 + 60)
+            continue
+        closed += agg.push(Tick({'tick': {
+            'instrument': 'EUR_USD', 'bid': bid, 'ask': bid + 0.0002,
+            'time': str((t0 + t) * 1000000)}}))
+    print [(b.granularity, str(b.start), b.bid_high, b.bid_close)
+           for b in closed]
+
+
+def test_bar_clock():
+    from api import Tick, BarAggregator
+    agg = BarAggregator(['S5', 'M1'])
+    t0 = 1443657600
+    agg.push(Tick({'tick': {'instrument': 'EUR_USD', 'bid': 1.1,
+                            'ask': 1.1002, 'time': str(t0 * 1000000)}}))
+    print len(agg.flush(t0 + 4)), len(agg.flush(t0 + 5))
+    print [(b.granularity, str(b.end)) for b in agg.flush(t0 + 60)]
+    # A tick of a bar the clock already closed is counted, not lost.
+    agg.push(Tick({'tick': {'instrument': 'EUR_USD', 'bid': 1.1,
+                            'ask': 1.1002, 'time': str(t0 * 1000000)}}))
+    print agg.dropped
+
+
+def test_event_queue():
+    from api import EventQueue, MarketEvent
+    def tick(pair, bid):
+        return MarketEvent({'tick': {'instrument': pair, 'bid': bid,
+                                     'ask': bid + 0.0002, 'time': '0'}})
+    q = EventQueue(capacity=3, batch=2, overflow='coalesce')
+    seen = []
+    q.bind('ETYPE_MKT', lambda e: seen.append(e.body['tick']['bid']))
+    q.put(tick('EUR_USD', 1.1))
+    q.put(MarketEvent({'heartbeat': {'time': '0'}}, is_heartbeat=True))
+    q.put(tick('USD_JPY', 120.0))
+    q.put(tick('EUR_USD', 1.2))     # replaces the queued EUR_USD tick.
+    q.put(tick('GBP_USD', 1.5))     # takes the heartbeat's room.
+    print len(q), q.coalesced, q.dropped
+    q.kill(drain=True)
+    print seen
+    # Not open: nothing makes room, so 'block' drops instead of waiting.
+    q = EventQueue(capacity=2)
+    for bid in [1.1, 1.2, 1.3]:
+        q.put(tick('EUR_USD', bid))
+    print len(q), q.dropped
+
+
+def test_conflation():
+    from threading import Event
+    from api import (ConflatingSubscriber, MarketEvent, BarEvent, Bar,
+                     SignalEvent)
+    seen, done = [], Event()
+    def on_event(event):
+        seen.append(event)
+        if len(seen) == 6:
+            done.set()
+    sub = ConflatingSubscriber(on_event)
+    # Queued before open(), so delivery happens in one go.
+    for k in range(100):
+        for pair in ['EUR_USD', 'USD_JPY']:
+            sub.push(MarketEvent({'tick': {'instrument': pair, 'bid': k,
+                                           'ask': k, 'time': '0'}}))
+    for g in ['M1', 'M5', 'M1']:
+        sub.push(BarEvent(Bar.from_ohlc('EUR_USD', g, 0, [1.1] * 8)))
+    sub.push(SignalEvent())
+    sub.push(SignalEvent())
+    sub.open()
+    print done.wait(5)
+    sub.kill()
+    # One latest tick per instrument, one bar per granularity, and
+    # both signals: 6 events, 198 ticks and 1 bar conflated.
+    print [(e.head, getattr(e, 'instrument', None)) for e in seen]
+    print [e.body['tick']['bid'] for e in seen[:2]], sub.conflated
+
+
+def test_topic_dispatch():
+    from api import EventQueue, MarketEvent
+    q = EventQueue()
+    got = dict()
+    for pair in ['EUR_USD', 'USD_CAD', 'USD_JPY']:
+        got[pair] = []
+        q.bind('ETYPE_MKT', got[pair].append, instruments=pair)
+    both = []
+    q.bind('ETYPE_MKT', both.append, instruments='EUR_USD,USD_CAD')
+    for k in range(30):
+        pair = ['EUR_USD', 'USD_CAD', 'USD_JPY'][k % 3]
+        q.put(MarketEvent({'tick': {'instrument': pair, 'bid': k,
+                                    'ask': k, 'time': '0'}}))
+    q.kill(drain=True)
+    print [len(got[p]) for p in sorted(got)], len(both)
+
+
+def test_run_portfolio():
+    pairs = ['EUR_USD', 'GBP_USD', 'AUD_USD']
+    panel = BarPanel.from_frames(
+        dict((pair, make_bars(seed=k)) for k, pair in enumerate(pairs)))
+    k = Kernel.naive(panel)
+    nav = k.run_portfolio(BasketTemplate(12, 26, panel.instruments))
+    print len(nav) == len(panel), k.summary()
+    print k.account.export_executed_orders().groupby('instrument').size()
+    # Orders for an instrument outside the panel.
+    try:
+        Kernel.naive(panel).run_portfolio(
+            BasketTemplate(12, 26, ['EUR_USD', 'GBP_USD', 'USD_CAD']))
+    except KernelDataError as e:
+        print e
+
+
+def test_conversion_matrix():
+    from currency import ConversionMatrix
+    pairs = ['EUR_USD', 'USD_JPY', 'EUR_HKD']
+    panel = BarPanel.from_frames(
+        dict((pair, make_bars(seed=k)) for k, pair in enumerate(pairs)))
+    matrix = ConversionMatrix(panel, CurrencyType.JPY)
+    close = panel.field(BarColNames.close.value)
+    eur_usd = close[:, panel.instruments.index('EUR_USD')]
+    usd_jpy = close[:, panel.instruments.index('USD_JPY')]
+    print np.allclose(matrix.rate('EUR'), eur_usd * usd_jpy)
+    print np.allclose(matrix.rate(CurrencyType.USD), usd_jpy)
+    print matrix.quote_rates().shape, matrix.unreachable()
+    k = Kernel(panel, Account(1000000, 20, CurrencyType.JPY))
+    k.run_portfolio(BasketTemplate(12, 26, panel.instruments))
+    print k.summary()
+
+
+class GridStrategy(object):
+    """
+    Rests a ladder of limit buys under the first price, each taking
+    profit one step above its limit.
+    """
+    instrument = 'EUR_USD'
+
+    def __init__(self, levels=1000, step=0.0001):
+        self.levels, self.step = levels, step
+        self.placed = False
+
+    def on_bar(self, bar):
+        price = bar[BarColNames.close.value]
+        time = bar[BarColNames.time.value]
+        if self.placed:
+            return OrderType.none, 0
+        self.placed = True
+        orders = []
+        for k in range(1, self.levels + 1):
+            limit = price - k * self.step
+            orders.append(Order.limit(self.instrument, OrderType.limit_buy,
+                                      time, limit, 1000,
+                                      take_profit=limit + self.step))
+        return orders
+
+
+class ExitStrategy(object):
+    """
+    Buys once, then guards the position with a resting take profit and
+    stop loss; one cancels the other.
+    """
+    instrument = 'EUR_USD'
+
+    def __init__(self, stop=0.002, target=0.002):
+        self.stop, self.target = stop, target
+        self.bars = 0
+
+    def on_bar(self, bar):
+        self.bars += 1
+        price = bar[BarColNames.close.value]
+        time = bar[BarColNames.time.value]
+        if self.bars == 1:
+            return OrderType.buy, 1000
+        if self.bars == 2:   # the first position has id 0.
+            return [Order.exit(self.instrument, OrderType.take_profit, time,
+                               price + self.target, 0),
+                    Order.exit(self.instrument, OrderType.stop_loss, time,
+                               price - self.stop, 0)]
+        return OrderType.none, 0
+
+
+def test_order_book():
+    k = Kernel.naive(make_bars(5000))
+    k.run_naive(GridStrategy())
+    print len(k.book), len(k.account.record_orders)
+    print k.summary()
+    k.run_naive(ExitStrategy())
+    # One exit fired and cancelled the other; nothing left open.
+    print len(k.book), len(k.account.closed), len(k.account.longs), \
+        len(k.account.rejected_orders)
+
+
+class BracketStrategy(object):
+    """
+    Buys every 50 bars with a fixed stop loss and take profit.
+    """
+    instrument = 'EUR_USD'
+
+    def __init__(self, stop=0.001, target=0.002):
+        self.stop, self.target = stop, target
+        self.bars = 0
+
+    def on_bar(self, bar):
+        self.bars += 1
+        if self.bars % 50:
+            return OrderType.none, 0
+        price = bar[BarColNames.close.value]
+        return [Order.bracket(self.instrument, OrderType.buy,
+                              bar[BarColNames.time.value], price, 1000,
+                              price - self.stop, price + self.target)]
+
+
+def test_intrabar_brackets():
+    df = make_bars(5000)
+    spread = np.abs(np.random.RandomState(1).normal(0, 0.0005, len(df)))
+    df[BarColNames.high.value] = df[BarColNames.close.value] + spread
+    df[BarColNames.low.value] = df[BarColNames.close.value] - spread
+    k = Kernel.naive(df)
+    k.run_naive(BracketStrategy())
+    pnl = k.account.export_positions()
+    print len(pnl), len(k.account.longs), k.summary()
+
+
+def test_position_book():
+    acc = Account.usd_std()
+    for i in range(1000):
+        acc.handle_mkt_order(Order('EUR_USD', OrderType.buy,
+                                   datetime(2015, 9, 1), 1.1, 100))
+        acc.handle_mkt_order(Order.close('EUR_USD', OrderType.sell,
+                                         datetime(2015, 9, 2), 1.2))
+    positions = acc.export_positions()
+    print len(acc.closed) == len(positions) == 1000
+    print np.allclose(positions['realized_pnl'], 10)
+    acc.closed[-1].view()
+
+
+def test_bar_dataset():
+    df = make_bars()
+    ds = BarDataset.from_frame(df)
+    try:
+        attached = BarDataset.attach(ds.name)
+        print len(attached) == len(df)
+        print attached.values(BarColNames.close.value).flags.writeable
+        k = Kernel.naive(attached)
+        nav = k.run_vectorized(StrategyTemplate(12, 26))
+        print np.allclose(nav, Kernel.naive(df).run_naive(
+            StrategyTemplate(12, 26)))
+    finally:
+        ds.unlink()
+
+
+def test_indicators():
+    prices = make_bars(500)[BarColNames.close.value].values
+    for ind in [SMA(20), EWMA(span=20), RollingStd(20), RollingMax(20),
+                RollingMin(20)]:
+        online = np.array([ind.update(p) for p in prices])
+        print ind.__class__.__name__, np.array_equal(
+            online, ind.compute(prices)) or np.allclose(
+            online, ind.compute(prices), equal_nan=True)
+    macd = MACD()
+    online = np.array([macd.update(p) for p in prices])
+    print np.allclose(online.T, macd.compute(prices))
+    cov = RollingCov(20)
+    online = np.array([cov.update(p, p * 2) for p in prices])
+    print np.allclose(online, cov.compute(prices, prices * 2),
+                      equal_nan=True)
+
+
+def test_stop_rule():
+    df = make_bars(5000)
+    k = Kernel.naive(df)
+    k.run_naive(StrategyTemplate(12, 26), MaxDrawdownStop(0.0001))
+    print k.pruned, k.metrics.bars < len(df)
+    k.metrics.view()
+    print k.summary()
+    # extend() on more than window + 1 bars, fresh and then running.
+    nav = 1e6 + np.cumsum(np.random.RandomState(0).normal(0, 100, 2000))
+    m1, m2 = RunningMetrics(), RunningMetrics()
+    for value in nav.tolist():
+        m1.update(value)
+    m2.extend(nav[:1200])
+    m2.extend(nav[1200:])
+    print m1.bars == m2.bars, m1.peak_nav == m2.peak_nav, \
+        np.isclose(m1.max_drawdown, m2.max_drawdown), \
+        np.isclose(m1.sharpe, m2.sharpe)
+
+
+def test_timeseries():
+    import timeseries as ts
+    rng = np.random.RandomState(0)
+    navs = 1e6 + np.cumsum(rng.normal(0, 500, (300, 3)), axis=0)
+    bench = 1.1 + np.cumsum(rng.normal(0, 0.001, 300))
+    frame = pd.DataFrame(navs)
+    # Plain loops per curve.
+    ewma, dd = np.empty_like(navs), np.empty_like(navs)
+    for j in range(navs.shape[1]):
+        peak, value = navs[0, j], navs[0, j]
+        for i in range(len(navs)):
+            value = 0.2 * navs[i, j] + 0.8 * value
+            ewma[i, j] = value
+            peak = max(peak, navs[i, j])
+            dd[i, j] = 1 - navs[i, j] / peak
+    print np.allclose(ts.ewma(navs, com=4), ewma)
+    m, signal, hist = ts.macd(navs[:, 0])
+    print np.allclose(m, ts.ewma(navs[:, 0], span=12) -
+                      ts.ewma(navs[:, 0], span=26)), \
+        np.allclose(hist, m - signal)
+    r = frame.pct_change().values[1:]
+    print np.allclose(ts.returns(navs), r), \
+        np.allclose(ts.cov(navs), frame.pct_change().cov().values)
+    print np.allclose(ts.normalize(navs), navs / navs[0]), \
+        np.allclose(ts.cumulative_return(navs)[-1], navs[-1] / navs[0] - 1)
+    print np.allclose(ts.drawdown(navs), dd), \
+        np.allclose(ts.max_drawdown(navs), dd.max(axis=0))
+    print np.allclose(ts.sharpe(navs), [
+        r[:, j].mean() / r[:, j].std(ddof=1) * np.sqrt(252)
+        for j in range(r.shape[1])])
+    rb = np.diff(bench) / bench[:-1]
+    fits = [np.polyfit(rb, r[:, j], 1) for j in range(r.shape[1])]
+    alpha, beta = ts.alpha_beta(navs, bench)
+    print np.allclose(beta, [f[0] for f in fits]), \
+        np.allclose(alpha, [f[1] * 252 for f in fits])
+    print np.allclose(ts.max_drawdown(navs[:, 1]), dd[:, 1].max())
+
+
+def test_run_batch():
+    df = make_bars()
+    k = Kernel.naive(df)
+    navs = k.run_batch(StrategyTemplate, {'fast': [5, 8], 'slow': [20, 30]})
+    k.run_naive(StrategyTemplate(8, 30))
+    print np.allclose(navs[(8, 30)], k.account.record_nav)
+    # Every bar in the matrix, whatever the account records.
+    k = Kernel(df, Account(1000000, 20, CurrencyType.USD,
+                           record_mode=RecordMode.nth, record_every=10))
+    navs = k.run_batch(StrategyTemplate, {'fast': [5, 8], 'slow': [20, 30]})
+    print navs.shape, len(k.account.record_nav)
+    # Parameter sets that are not a product, slow = fast + 15.
+    navs = k.run_batch(StrategyTemplate, [{'fast': f, 'slow': f + 15}
+                                          for f in [5, 8]])
+    print list(navs.columns)
+
+
+def test_indicator_cache():
+    import tempfile
+    from memo import IndicatorCache, fingerprint
+    prices = make_bars()['closeMid'].values
+    cache = IndicatorCache(max_bytes=prices.nbytes * 2,
+                           root=tempfile.mkdtemp())
+    for w in [5, 10, 20, 5]:
+        cache.cached(prices, 'SMA', (w,), SMA(w).compute)
+    print len(cache), cache.hits, cache.misses
+    cache.clear()
+    key = cache.key(fingerprint(prices), 'SMA', (10,))
+    print np.allclose(cache.get(key), SMA(10).compute(prices))
+    # Hashed once per buffer.
+    print cache.digest(prices) == fingerprint(prices), len(cache.digests)
+
+
 if __name__ == '__main__':
     test_sma()
     # test_order()
@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 import time
 import matplotlib
@@ -6,6 +7,8 @@ import matplotlib.ticker as mticker
 import matplotlib.dates as mdates
 
 from api import Config, PyApi, EventQueue
+from indicators import SMA, EWMA, MACD
+from memo import default_cache
 from datetime import datetime, timedelta
 
 
@@ -101,6 +104,30 @@ def get_data(oApi, count=500, granularity='M30', instrument='EUR_USD'):
 
 #----------------------------------------------------------------------
 # Statistical Methods; Algorithms.
+"""
+Performance metrics are vectorized over NAV curves. A series is either
+one curve (1-D, e.g. the nav returned by Kernel.run_naive()) or many
+curves (2-D, bars x curves, e.g. a nav matrix of a sweep); statistics
+are taken along axis 0, so a 2-D input gives one value per curve.
+"""
+
+def _curves(series):
+	"""
+	Float array view of one or many curves.
+	"""
+	return np.asarray(series, dtype=np.float64)
+
+def _alpha(com=None, span=None, halflife=None):
+	"""
+	Smoothing factor of an EWMA, from center of mass, span or halflife.
+	"""
+	if com is not None:
+		return 1.0 / (1 + com)
+	if span is not None:
+		return 2.0 / (span + 1)
+	if halflife is not None:
+		return 1 - np.exp(np.log(0.5) / halflife)
+	raise ValueError('[TIMESERIES]: one of com, span, halflife is required.')
 
 def sma(series, window):
 	"""
@@ -115,39 +142,70 @@ def sma(series, window):
 	* series: list-like object.
 	* window: SMA window.
 	"""
-	return pd.rolling_mean(pd.Series(series),window)
+	series = pd.Series(series)
+	values = default_cache.cached(
+		series.values, 'SMA', (window,), SMA(window).compute).copy()
+	values[:window-1] = np.nan
+	return pd.Series(values, index=series.index)
 
-def ewma(series, com, span, halflife):
+def ewma(series, com=None, span=None, halflife=None):
 	"""
-	Exponentially weighted moving average.
+	Exponentially weighted moving average, along axis 0.
+	y_t = alpha * x_t + (1 - alpha) * y_{t-1}.
 
+	parameters
+	----------
+	* series: array-like; one curve or bars x curves.
+	* com: float; center of mass, alpha = 1 / (1 + com).
+	* span: float; alpha = 2 / (span + 1).
+	* halflife: float; alpha = 1 - exp(log(0.5) / halflife).
 	"""
-	pass
+	alpha = _alpha(com, span, halflife)
+	return default_cache.cached(
+		_curves(series), 'EWMA', (alpha,), EWMA(alpha=alpha).compute).copy()
 
-def macd(series, fast, slow):
+def macd(series, fast=12, slow=26, signal=9):
 	"""
-	Moving Average Convergence-Divergence.
+	Moving Average Convergence-Divergence, along axis 0.
 
+	parameters
+	----------
+	* series: array-like; one curve or bars x curves.
+	* fast, slow, signal: int; EWMA spans.
+
+	returns
+	-------
+	* (macd, signal, histogram) tuple of arrays.
 	"""
-	pass
+	compute = lambda values: np.array(MACD(fast, slow, signal).compute(values))
+	return tuple(default_cache.cached(
+		_curves(series), 'MACD', (fast, slow, signal), compute).copy())
 
-def cov(series):
+def returns(series):
 	"""
+	Simple returns between consecutive bars, one row shorter.
+	"""
+	values = _curves(series)
+	return values[1:] / values[:-1] - 1
 
+def cov(series):
 	"""
-	pass
+	Covariance matrix of returns across curves (bars x curves).
+	"""
+	return np.atleast_2d(np.cov(returns(series), rowvar=False))
 
 def normalize(series):
 	"""
-
+	Rebase curves to start at 1.
 	"""
-	pass
+	values = _curves(series)
+	return values / values[0]
 
 def cumulative_return(series):
 	"""
-
+	Cumulative return since the first bar, at every bar.
 	"""
-	pass
+	return normalize(series) - 1
 
 def aggregate(series):
 	"""
@@ -155,23 +213,58 @@ def aggregate(series):
 	"""
 	pass
 
-def max_drawdown(series):
+def drawdown(series):
+	"""
+	Fall from the running peak, in fraction of the peak, at every bar.
 	"""
+	values = _curves(series)
+	return 1 - values / np.maximum.accumulate(values, axis=0)
 
+def max_drawdown(series):
 	"""
-	pass
+	Largest drawdown of each curve.
+	"""
+	return drawdown(series).max(axis=0)
 
-def sharpe(series):
+def sharpe(series, periods=252, risk_free=0.0):
 	"""
+	Annualized Sharpe ratio of each curve.
 
+	parameters
+	----------
+	* series: array-like; one curve or bars x curves.
+	* periods: int; bars per year, e.g. 252 for D, 362880 for M1
+	  (252 days * 1440 minutes).
+	* risk_free: float; annual risk free rate.
 	"""
-	pass
+	excess = returns(series) - risk_free / float(periods)
+	with np.errstate(divide='ignore', invalid='ignore'):
+		return excess.mean(axis=0) / excess.std(axis=0, ddof=1) * \
+			np.sqrt(periods)
 
-def alpha_beta(series):
+def alpha_beta(series, benchmark, periods=252):
 	"""
+	Regress returns of each curve on benchmark returns.
 
+	parameters
+	----------
+	* series: array-like; one curve or bars x curves.
+	* benchmark: array-like; one curve, same number of bars.
+	* periods: int; bars per year, alpha is annualized.
+
+	returns
+	-------
+	* (alpha, beta) tuple.
 	"""
-	pass
+	r = returns(series)
+	rb = returns(benchmark)
+	if r.ndim > 1:
+		rb = rb[:, np.newaxis]
+	rb_dev = rb - rb.mean(axis=0)
+	beta = (rb_dev * (r - r.mean(axis=0))).sum(axis=0) / \
+		(rb_dev ** 2).sum(axis=0)
+	alpha = (r.mean(axis=0) - beta * rb.mean(axis=0)) * periods
+	return alpha, beta
 
 def bayesian(series):
 	"""
@@ -1,7 +1,10 @@
+import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
 
-from statics import BarColNames
+from statics import BarColNames, ORD_CODE_MAPPING
+from indicators import SMA
+from memo import default_cache
 
 __author__ = 'zed'
 
@@ -9,6 +12,13 @@ __author__ = 'zed'
 # ----------------------------------------------------------------------
 # Utils Methods
 
+# Integer value of NaT, i.e. the empty int64 timestamp.
+NAT_NS = np.iinfo(np.int64).min
+
+# Instrument codes shared by all position books of a process.
+_instrument_codes = dict()
+_instrument_names = []
+
 
 def serialize_dict(dic):
     """
@@ -120,4 +130,66 @@ def sma(series, window):
     :param window:
     :return:
     """
-    return pd.rolling_mean(pd.Series(series), window)
+    series = pd.Series(series)
+    values = default_cache.cached(
+        series.values, 'SMA', (window,), SMA(window).compute).copy()
+    values[:window-1] = np.nan
+    return pd.Series(values, index=series.index)
+
+
+def encode_order_types(directions):
+    """
+    Map a signal array to integer codes of ORD_CODE_MAPPING.
+    :param directions: array-like; OrderType objects or integer codes.
+    :return: np.ndarray of int8.
+    """
+    directions = np.asarray(directions)
+    if directions.dtype.kind in 'iu':
+        return directions.astype(np.int8)
+    return np.array([ORD_CODE_MAPPING[d] for d in directions],
+                    dtype=np.int8)
+
+
+def encode_instrument(instrument):
+    """
+    Map an instrument name to its integer code, registering new names.
+    :param instrument: string; name of instrument.
+    :return: int.
+    """
+    if instrument not in _instrument_codes:
+        _instrument_codes[instrument] = len(_instrument_names)
+        _instrument_names.append(instrument)
+    return _instrument_codes[instrument]
+
+
+def decode_instrument(code):
+    """
+    :param code: int; instrument code.
+    :return: string; name of instrument.
+    """
+    return _instrument_names[code]
+
+
+def instrument_names():
+    """
+    :return: list; registered instrument names, indexed by code.
+    """
+    return list(_instrument_names)
+
+
+def to_ns(time):
+    """
+    :param time: datetime.datetime/pd.Timestamp object, or None.
+    :return: int; nanoseconds since epoch, NAT_NS for None.
+    """
+    if time is None:
+        return NAT_NS
+    return pd.Timestamp(time).value
+
+
+def from_ns(value):
+    """
+    :param value: int; nanoseconds since epoch.
+    :return: pd.Timestamp object; NaT for NAT_NS.
+    """
+    return pd.Timestamp(value)